@@ -0,0 +1,285 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import argparse
+import functools
+import logging
+
+from openstack_billing_db import billing, fetch, metrics, model, snapshots
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_FILE = "/tmp/openstack_invoices_{invoice_month}.csv"
+
+# Instances of the database, reduced to a single shard like the shards of
+# `billing`, set in each worker process once rather than sent along with
+# every month.
+_worker_shard = None
+
+
+def get_month_period(invoice_month) -> tuple[datetime, datetime]:
+    """Returns the start and the exclusive end of a month. (YYYY-MM)"""
+    start = datetime.strptime(invoice_month, "%Y-%m")
+    if start.month == 12:
+        return start, start.replace(year=start.year + 1, month=1)
+    return start, start.replace(month=start.month + 1)
+
+
+def parse_months(arg) -> list[str]:
+    """Returns the months of a comma separated list, or of a range.
+
+    A range is given as FIRST..LAST, both included. (YYYY-MM)
+    """
+    if ".." not in arg:
+        months = [m.strip() for m in arg.split(",") if m.strip()]
+        for month in months:
+            get_month_period(month)
+        return months
+
+    first, last = arg.split("..")
+    month, _ = get_month_period(first.strip())
+    last_month, _ = get_month_period(last.strip())
+    if month > last_month:
+        raise Exception(f"Range of months {arg} ends before it starts.")
+
+    months = []
+    while month <= last_month:
+        months.append(month.strftime("%Y-%m"))
+        _, month = get_month_period(months[-1])
+    return months
+
+
+def _set_worker_shard(shard):
+    global _worker_shard
+    _worker_shard = shard
+
+
+def _get_runtimes_of_month(period, excluded_intervals, runtime_engine):
+    start, end = period
+    return billing._get_runtimes_of_shard(
+        _worker_shard, start, end, excluded_intervals[period], runtime_engine
+    )
+
+
+def get_runtimes_of_months(
+    database, periods, excluded_intervals, runtime_engine="reference", workers=1
+) -> dict[tuple, list[model.InstanceRuntime]]:
+    """Returns the runtimes of every instance during each period.
+
+    With several workers, periods are computed in parallel, each worker
+    receiving the instances only once.
+    """
+    if workers <= 1:
+        instances = billing.get_all_instances(database)
+        return {
+            (start, end): billing.get_runtimes(
+                instances, start, end, excluded_intervals[(start, end)], runtime_engine
+            )
+            for start, end in periods
+        }
+
+    (shard,) = billing.shard_projects(database.projects, 1)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_set_worker_shard,
+        initargs=(shard,),
+    ) as executor:
+        results = executor.map(
+            functools.partial(
+                _get_runtimes_of_month,
+                excluded_intervals=excluded_intervals,
+                runtime_engine=runtime_engine,
+            ),
+            periods,
+        )
+        return {
+            period: [
+                model.InstanceRuntime(
+                    total_seconds_running=running, total_seconds_stopped=stopped
+                )
+                for running, stopped in runtimes
+            ]
+            for period, runtimes in zip(periods, results)
+        }
+
+
+def backfill(
+    months,
+    load_database,
+    get_rates,
+    output_file=DEFAULT_OUTPUT_FILE,
+    outages_data=None,
+    runtime_engine="reference",
+    workers=1,
+) -> list[str]:
+    """Writes the invoice of each month, loading the database only once.
+
+    `load_database(start, end)` loads the database for the whole range of
+    months, and `get_rates(invoice_month)` returns the rates of a month.
+    The invoices are written to `output_file`, formatted with the month.
+
+    Returns the paths of the invoices written.
+    """
+    periods = [get_month_period(month) for month in months]
+    with metrics.stage("load_database"):
+        database = load_database(
+            min(start for start, _ in periods), max(end for _, end in periods)
+        )
+    with metrics.stage("query_projects"):
+        projects = database.projects
+    logger.info(f"Loaded {len(projects)} projects with billable instances.")
+
+    with metrics.stage("load_outages"):
+        excluded_intervals = {
+            (start, end): billing.get_excluded_intervals(start, end, outages_data)
+            for start, end in periods
+        }
+    with metrics.stage("compute_runtimes"):
+        runtimes = get_runtimes_of_months(
+            database, periods, excluded_intervals, runtime_engine, workers
+        )
+
+    outputs = []
+    for invoice_month, (start, end) in zip(months, periods):
+        output = output_file.format(invoice_month=invoice_month)
+        with metrics.stage("compute_invoices"):
+            invoices = billing.collect_invoice_data_from_openstack(
+                database,
+                start,
+                end,
+                get_rates(invoice_month),
+                invoice_month=invoice_month,
+                excluded_intervals=excluded_intervals[(start, end)],
+                runtimes=runtimes[(start, end)],
+            )
+        with metrics.stage("write_invoice"):
+            billing.write(invoices, output, invoice_month)
+        logger.info(f"Wrote invoice for {invoice_month} to {output}.")
+        outputs.append(output)
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m openstack_billing_db.backfill",
+        description=(
+            "Regenerate the invoices of several past months from a single"
+            " load of the Nova DB, with the rates and outages of each month"
+            " from nerc-rates"
+        ),
+    )
+    parser.add_argument(
+        "months",
+        type=parse_months,
+        help=(
+            "Invoice months to regenerate, either comma separated or as a"
+            " range FIRST..LAST. (YYYY-MM)"
+        ),
+    )
+    parser.add_argument(
+        "--sql-dump-file",
+        default="",
+        help="Path to SQL Dump of Nova DB.",
+    )
+    parser.add_argument(
+        "--download-sql-dump-from-s3",
+        action="store_true",
+        help="Downloads the latest Nova DB Dump from S3, as main does.",
+    )
+    parser.add_argument(
+        "--read-mysqldump-natively",
+        action="store_true",
+        help=(
+            "Read the SQL dump as generated by mysqldump, rather than"
+            " converting it to SQLite3 compatible format."
+        ),
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default="",
+        help="Directory for caching the loaded SQL dump as an SQLite database.",
+    )
+    parser.add_argument(
+        "--runtime-engine",
+        default="reference",
+        choices=billing.RUNTIME_ENGINES,
+        help="Engine for computing runtimes net of outages.",
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of processes computing the months in parallel.",
+    )
+    parser.add_argument(
+        "--output-file",
+        default=DEFAULT_OUTPUT_FILE,
+        help=(
+            "Output path for the invoice of each month in CSV format, with"
+            " {invoice_month} replaced by the month."
+        ),
+    )
+    parser.add_argument(
+        "--snapshot-cache-dir",
+        default=None,
+        help=(
+            "Cache the rates and outages from nerc-rates in this directory."
+            f" --offline defaults it to {snapshots.DEFAULT_CACHE_DIR}."
+        ),
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Use only cached rates and outages, whatever their age.",
+    )
+
+    args = parser.parse_args()
+    if "{invoice_month}" not in args.output_file:
+        raise Exception("--output-file must contain {invoice_month}.")
+
+    dump_file = args.sql_dump_file
+    if args.download_sql_dump_from_s3:
+        dump_file = fetch.download_latest_dump_from_s3()
+    if not dump_file:
+        raise Exception(
+            "Must provide either --sql-dump-file or --download-sql-dump-from-s3."
+        )
+
+    convert_dump = None
+    if args.read_mysqldump_natively:
+        dump_format = "mysqldump"
+    else:
+        dump_format = "sqlite"
+        convert_dump = fetch.convert_mysqldump_to_sqlite
+
+    def load_database(start, end):
+        return model.Database(
+            start,
+            dump_file,
+            cache_dir=args.cache_dir or None,
+            dump_format=dump_format,
+            end=end,
+            convert=convert_dump,
+        )
+
+    snapshot_cache = None
+    if args.snapshot_cache_dir or args.offline:
+        snapshot_cache = snapshots.SnapshotCache(
+            args.snapshot_cache_dir or snapshots.DEFAULT_CACHE_DIR,
+            offline=args.offline,
+        )
+    nerc_repo_rates = snapshots.load_rates(snapshot_cache)
+
+    backfill(
+        args.months,
+        load_database,
+        functools.partial(billing.Rates.from_nerc_rates, nerc_repo_rates),
+        output_file=args.output_file,
+        outages_data=snapshots.load_outages(snapshot_cache),
+        runtime_engine=args.runtime_engine,
+        workers=args.workers,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+from openstack_billing_db import billing, metrics, model, synthetic
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+START = datetime(year=2024, month=1, day=1)
+END = datetime(year=2024, month=2, day=1)
+ACTIONS = ["create", "start", "stop", "shelve", "unshelve", "reboot", "resize"]
+
+# Stages of the billing pipeline timed by `time_pipeline`.
+PIPELINE_STAGES = ("load_database", "collect_invoices", "write_invoice")
+
+RATES = billing.Rates(
+    rates={
+        "cpu": Decimal("0.013"),
+        "gpu_a100": Decimal("1.803"),
+        "gpu_a100sxm4": Decimal("2.078"),
+        "gpu_v100": Decimal("1.214"),
+        "gpu_a2": Decimal("0.466"),
+        "gpu_k80": Decimal("0.463"),
+    },
+    include_stopped_runtime=False,
+)
+
+
+def generate_instances(count, events_per_instance, seed=0) -> list[model.Instance]:
+    """Generates instances with random events around the benchmark period."""
+    rng = random.Random(seed)
+    flavor = model.Flavor(
+        id=1, service_unit_type="cpu", vcpus=1, memory=4096, storage=20
+    )
+
+    instances = []
+    for _ in range(count):
+        # Nova stores times with a precision of seconds.
+        event_time = START - timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+        events = [model.InstanceEvent(time=event_time, name="create", message="")]
+        for _ in range(events_per_instance - 1):
+            event_time += timedelta(seconds=rng.randint(0, 30 * 24 * 3600))
+            events.append(
+                model.InstanceEvent(
+                    time=event_time,
+                    name=rng.choice(ACTIONS),
+                    message="Error" if rng.random() < 0.02 else "",
+                )
+            )
+
+        deleted_at = None
+        if rng.random() < 0.2:
+            deleted_at = event_time + timedelta(seconds=rng.randint(0, 30 * 24 * 3600))
+
+        instances.append(
+            model.Instance(
+                uuid=uuid.UUID(int=rng.getrandbits(128)).hex,
+                name=f"instance-{len(instances)}",
+                flavor=flavor,
+                events=events,
+                deleted_at=deleted_at,
+            )
+        )
+    return instances
+
+
+def generate_outages(count, seed=0) -> list[tuple[datetime, datetime]]:
+    """Generates disjoint outages within the benchmark period."""
+    rng = random.Random(seed)
+    length = (END - START) / count if count else None
+    return [
+        (
+            START + n * length,
+            START + n * length + timedelta(hours=rng.randint(1, 24)),
+        )
+        for n in range(count)
+    ]
+
+
+def time_runtime_engines(instances, outages, runtime_engines=billing.RUNTIME_ENGINES):
+    """Times each runtime engine, checking that it agrees with the reference.
+
+    Returns the seconds taken by each engine.
+    """
+    timings = {}
+    results = {}
+    for runtime_engine in runtime_engines:
+        started = time.perf_counter()
+        results[runtime_engine] = billing.get_runtimes(
+            instances, START, END, outages, runtime_engine
+        )
+        timings[runtime_engine] = time.perf_counter() - started
+
+    expected = results.get("reference")
+    for runtime_engine, runtimes in results.items():
+        if expected is not None and runtimes != expected:
+            raise Exception(f"Runtimes of {runtime_engine} engine do not match.")
+    return timings
+
+
+def time_pipeline(
+    dump_file, outages, output, runtime_engine="reference", workers=1
+) -> dict:
+    """Times loading a dump, computing the invoices and writing them.
+
+    Returns the seconds taken by each stage, and a hash of the invoices
+    for checking that optimizations do not change them.
+    """
+    metrics.reset()
+    with metrics.stage("load_database"):
+        database = model.Database(START, dump_file, end=END)
+        database.projects
+    with metrics.stage("collect_invoices"):
+        invoices = billing.collect_invoice_data_from_openstack(
+            database,
+            START,
+            END,
+            RATES,
+            runtime_engine=runtime_engine,
+            excluded_intervals=outages,
+            workers=workers,
+        )
+    with metrics.stage("write_invoice"):
+        billing.write(invoices, output, START.strftime("%Y-%m"), generated_at="")
+
+    with open(output, "rb") as f:
+        invoice_sha256 = hashlib.sha256(f.read()).hexdigest()
+    stages = metrics.get_summary()["stages"]
+    return {
+        "seconds": {stage: stages[stage] for stage in PIPELINE_STAGES},
+        "invoice_sha256": invoice_sha256,
+    }
+
+
+def parse_gpu_mix(arg) -> dict[str, float]:
+    """Returns the fraction of instances with each GPU, given as alias=fraction.
+
+    Pairs are comma separated, such as A100=0.05,V100=0.02, and an empty
+    string generates no GPU instances.
+    """
+    gpu_mix = {}
+    for pair in filter(None, (p.strip() for p in arg.split(","))):
+        alias, _, fraction = pair.partition("=")
+        alias = alias.strip()
+        if alias not in synthetic.DEFAULT_GPU_MIX:
+            raise argparse.ArgumentTypeError(
+                f"Unknown GPU {alias}, expected one of"
+                f" {', '.join(synthetic.DEFAULT_GPU_MIX)}."
+            )
+        try:
+            gpu_mix[alias] = float(fraction)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Invalid fraction in {pair}.")
+        if gpu_mix[alias] < 0:
+            raise argparse.ArgumentTypeError(f"Negative fraction in {pair}.")
+
+    if sum(gpu_mix.values()) > 1:
+        raise argparse.ArgumentTypeError("GPU fractions add up to more than 1.")
+    return gpu_mix
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2) -> list[str]:
+    """Returns the regressions of the results from the baseline.
+
+    A stage regresses when it is slower than in the baseline by more than
+    `tolerance`, as a fraction. The invoices regress when they differ.
+    Scales missing from the baseline are skipped.
+    """
+    regressions = []
+    for scale, result in results.items():
+        expected = baseline.get(scale)
+        if expected is None:
+            continue
+
+        if result["invoice_sha256"] != expected["invoice_sha256"]:
+            regressions.append(f"{scale} instances: invoices differ from baseline.")
+        for stage, seconds in result["seconds"].items():
+            baseline_seconds = expected["seconds"].get(stage)
+            if baseline_seconds and seconds > baseline_seconds * (1 + tolerance):
+                regressions.append(
+                    f"{scale} instances: {stage} took {seconds:.3f} seconds,"
+                    f" {seconds / baseline_seconds:.2f}x the baseline."
+                )
+    return regressions
+
+
+def benchmark_engines(args):
+    outages = generate_outages(args.outages)
+    for count in [int(c) for c in args.instances.split(",")]:
+        instances = generate_instances(count, args.events_per_instance)
+        timings = time_runtime_engines(
+            instances, outages, args.runtime_engines.split(",")
+        )
+        reference = timings.get("reference")
+        for runtime_engine, seconds in timings.items():
+            speedup = f" ({reference / seconds:.1f}x)" if reference else ""
+            logger.info(
+                f"{count} instances, {runtime_engine} engine:"
+                f" {seconds:.3f} seconds{speedup}."
+            )
+
+
+def benchmark_pipeline(args):
+    outages = generate_outages(args.outages)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in [int(c) for c in args.instances.split(",")]:
+            dump_file = os.path.join(tmp, f"nova-{count}.sql")
+            synthetic.generate_nova_dump(
+                dump_file,
+                projects=max(count // args.instances_per_project, 1),
+                instances=count,
+                actions_per_instance=args.events_per_instance,
+                gpu_mix=args.gpu_mix,
+                start=START,
+                end=END,
+                outages=outages,
+            )
+            results[str(count)] = time_pipeline(
+                dump_file,
+                outages,
+                os.path.join(tmp, f"invoices-{count}.csv"),
+                args.runtime_engine,
+                args.workers,
+            )
+            for stage, seconds in results[str(count)]["seconds"].items():
+                logger.info(f"{count} instances, {stage}: {seconds:.3f} seconds.")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Saved baseline to {args.save_baseline}.")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            logger.error(regression)
+        if regressions:
+            sys.exit(1)
+        logger.info(f"No regressions from baseline {args.baseline}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m openstack_billing_db.benchmark",
+        description="Benchmarks of the runtime engines and billing pipeline",
+    )
+    subparsers = parser.add_subparsers(required=True)
+
+    engines_parser = subparsers.add_parser(
+        "engines", help="Time the runtime engines on generated instances."
+    )
+    engines_parser.set_defaults(benchmark=benchmark_engines)
+    engines_parser.add_argument(
+        "--runtime-engines",
+        default=",".join(billing.RUNTIME_ENGINES),
+        help="Comma separated runtime engines to benchmark.",
+    )
+
+    pipeline_parser = subparsers.add_parser(
+        "pipeline",
+        help=(
+            "Time loading a generated Nova dump, collecting and writing the invoices."
+        ),
+    )
+    pipeline_parser.set_defaults(benchmark=benchmark_pipeline)
+    pipeline_parser.add_argument(
+        "--instances-per-project",
+        default=10,
+        type=int,
+        help="Average number of instances of each project.",
+    )
+    pipeline_parser.add_argument(
+        "--gpu-mix",
+        default=None,
+        type=parse_gpu_mix,
+        help=(
+            "Fraction of instances with each GPU, as comma separated"
+            " alias=fraction pairs such as A100=0.05,V100=0.02. Defaults to"
+            f" {','.join(f'{a}={f}' for a, f in synthetic.DEFAULT_GPU_MIX.items())}."
+        ),
+    )
+    pipeline_parser.add_argument(
+        "--runtime-engine",
+        default="reference",
+        choices=billing.RUNTIME_ENGINES,
+        help="Engine for computing runtimes net of outages.",
+    )
+    pipeline_parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of processes computing runtimes.",
+    )
+    pipeline_parser.add_argument(
+        "--save-baseline",
+        default=None,
+        help="Save the timings and invoice hashes to this JSON file.",
+    )
+    pipeline_parser.add_argument(
+        "--baseline",
+        default=None,
+        help=(
+            "Compare against timings and invoice hashes saved with"
+            " --save-baseline, exiting with an error on regressions."
+        ),
+    )
+    pipeline_parser.add_argument(
+        "--tolerance",
+        default=0.2,
+        type=float,
+        help="Fraction by which a stage may be slower than the baseline.",
+    )
+
+    for subparser in (engines_parser, pipeline_parser):
+        subparser.add_argument(
+            "--instances",
+            default="1000,10000",
+            help="Comma separated numbers of instances to benchmark with.",
+        )
+        subparser.add_argument(
+            "--events-per-instance",
+            default=10,
+            type=int,
+            help="Number of events of each instance.",
+        )
+        subparser.add_argument(
+            "--outages",
+            default=3,
+            type=int,
+            help="Number of disjoint outages during the billing period.",
+        )
+
+    args = parser.parse_args()
+    args.benchmark(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,129 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import csv
+import functools
+import hashlib
+import itertools
 import logging
 from datetime import datetime, timezone, timedelta
-from dataclasses import dataclass
-from decimal import Decimal, ROUND_HALF_UP
+from dataclasses import dataclass, field
+from decimal import Decimal
 import math
 import os
+from typing import Optional
 
-from openstack_billing_db import model
+from openstack_billing_db import checkpoint, columnar, engines, metrics, model
 
 import boto3
+import botocore.exceptions
 from nerc_rates import outages
 
 logger = logging.getLogger(__name__)
 
 CLUSTER_NAME = "stack"
 
+# Engines for computing runtimes net of outages. The "reference" engine
+# subtracts the runtime during each outage from the runtime during the
+# billing period, and the "vectorized" engine does the same for all
+# instances at once with NumPy, which is only imported when it is used.
+# The "sweep" engine measures the runtime outside of outages in a single
+# pass over the events of each instance.
+RUNTIME_ENGINES = ("reference", "vectorized", "sweep")
+
+# Projects are split into this many shards per worker process, so that
+# one worker with a few large projects does not hold up the others.
+SHARDS_PER_WORKER = 4
+
+# SU types in the order they are written to invoices, with the name of
+# their SU on invoices and the name of their rate in nerc-rates. A new SU
+# type only needs an entry here.
+INVOICE_SU_TYPES = {
+    "cpu": ("OpenStack CPU", "CPU SU Rate"),
+    "gpu_a100sxm4": ("OpenStack GPUA100SXM4", "GPUA100SXM4 SU Rate"),
+    "gpu_a100": ("OpenStack GPUA100", "GPUA100 SU Rate"),
+    "gpu_v100": ("OpenStack GPUV100", "GPUV100 SU Rate"),
+    "gpu_k80": ("OpenStack GPUK80", "GPUK80 SU Rate"),
+    "gpu_a2": ("OpenStack GPUA2", "GPUA2 SU Rate"),
+}
+
+# Decimal places of the integers costs are computed with, milli-cents.
+FIXED_POINT_PLACES = 5
+
+# Lengths of the buckets of usage time series, in seconds.
+USAGE_BUCKETS = {"daily": 24 * 3600, "hourly": 3600}
+
+
+def to_fixed_point(value) -> tuple[int, int]:
+    """Returns an integer and a number of decimal places representing a value.
+
+    Dollar amounts are represented in milli-cents, or in a finer unit when
+    the value has more decimal places, so that the value is exact.
+    """
+    value = Decimal(value)
+    places = max(FIXED_POINT_PLACES, -value.as_tuple().exponent)
+    return int(value.scaleb(places)), places
+
+
+def get_cost_in_cents(su_hours: int, rate) -> int:
+    """Returns the cost of SU hours at a rate, rounded half up to cents.
+
+    Computed with integers only, which gives the same result as rounding
+    the exact Decimal cost with ROUND_HALF_UP.
+    """
+    units, places = to_fixed_point(rate)
+    cost = su_hours * units
+    cents, remainder = divmod(abs(cost), 10 ** (places - 2))
+    if 2 * remainder >= 10 ** (places - 2):
+        cents += 1
+    return cents if cost >= 0 else -cents
+
+
+def get_default_su_names() -> dict[str, str]:
+    return {
+        service_unit_type: su_name
+        for service_unit_type, (su_name, _) in INVOICE_SU_TYPES.items()
+    }
+
 
 @dataclass()
 class Rates(object):
-    cpu: Decimal
-    gpu_a100: Decimal
-    gpu_a100sxm4: Decimal
-    gpu_v100: Decimal
-    gpu_a2: Decimal
-    gpu_k80: Decimal
+    # Rate and name on invoices of each SU type.
+    rates: dict[str, Decimal]
 
     include_stopped_runtime: bool
 
-    cpu_su_name: str = "OpenStack CPU"
-    gpu_a100_su_name: str = "OpenStack GPUA100"
-    gpu_a100sxm4_su_name: str = "OpenStack GPUA100SXM4"
-    gpu_v100_su_name: str = "OpenStack GPUV100"
-    gpu_a2_su_name: str = "OpenStack GPUA2"
-    gpu_k80_su_name: str = "OpenStack GPUK80"
+    su_names: dict[str, str] = field(default_factory=get_default_su_names)
+
+    def get_rate(self, service_unit_type) -> Decimal:
+        return self.rates[service_unit_type]
+
+    def get_su_name(self, service_unit_type) -> str:
+        return self.su_names[service_unit_type]
+
+    def get_su_names(self) -> dict[str, str]:
+        """Returns the name of each SU type written to invoices."""
+        return {
+            service_unit_type: self.get_su_name(service_unit_type)
+            for service_unit_type in INVOICE_SU_TYPES
+        }
+
+    @classmethod
+    def from_nerc_rates(cls, nerc_repo_rates, invoice_month) -> "Rates":
+        """Returns the rates in effect during a month, as found in nerc-rates."""
+
+        def get_decimal_rate(rate_name):
+            return nerc_repo_rates.get_value_at(rate_name, invoice_month, Decimal)
+
+        return cls(
+            rates={
+                service_unit_type: get_decimal_rate(rate_name)
+                for service_unit_type, (_, rate_name) in INVOICE_SU_TYPES.items()
+            },
+            include_stopped_runtime=(
+                nerc_repo_rates.get_value_at(
+                    "Charge for Stopped Instances", invoice_month, bool
+                )
+            ),
+        )
 
 
 @dataclass()
@@ -51,38 +142,61 @@ class ProjectInvoice(object):
 
     rates: Rates
 
-    cpu_su_hours: int = 0
-    gpu_a100sxm4_su_hours: int = 0
-    gpu_a100_su_hours: int = 0
-    gpu_v100_su_hours: int = 0
-    gpu_k80_su_hours: int = 0
-    gpu_a2_su_hours: int = 0
+    # SU hours of each SU type used, accumulated as integers.
+    su_hours: dict[str, int] = field(default_factory=dict)
 
     institution_specific_code: str = "N/A"
 
-    @property
-    def cpu_su_cost(self) -> Decimal:
-        return self.rates.cpu * self.cpu_su_hours
+    def get_su_cost(self, service_unit_type) -> Decimal:
+        """Returns the cost of the SU hours of a type, rounded to cents."""
+        return Decimal(
+            get_cost_in_cents(
+                self.su_hours.get(service_unit_type, 0),
+                self.rates.get_rate(service_unit_type),
+            )
+        ).scaleb(-2)
+
 
-    @property
-    def gpu_a100sxm4_su_cost(self) -> Decimal:
-        return self.rates.gpu_a100sxm4 * self.gpu_a100sxm4_su_hours
+@dataclass()
+class InstanceUsage(object):
+    """Represents the usage of an instance during a bucket of time."""
 
-    @property
-    def gpu_a100_su_cost(self) -> Decimal:
-        return self.rates.gpu_a100 * self.gpu_a100_su_hours
+    bucket_start: str
+    project_id: str
+    instance_uuid: str
+    service_unit_type: str
 
-    @property
-    def gpu_v100_su_cost(self) -> Decimal:
-        return self.rates.gpu_v100 * self.gpu_v100_su_hours
+    seconds_running: int
+    seconds_stopped: int
+    su_hours: int
 
-    @property
-    def gpu_k80_su_cost(self) -> Decimal:
-        return self.rates.gpu_k80 * self.gpu_k80_su_hours
 
-    @property
-    def gpu_a2_su_cost(self) -> Decimal:
-        return self.rates.gpu_a2 * self.gpu_a2_su_hours
+@dataclass(slots=True)
+class InstanceDetail(object):
+    """Represents how an instance contributed to the invoice of its project."""
+
+    instance_uuid: str
+    instance_name: str
+    project_id: str
+    flavor_id: int
+    vcpus: int
+    memory_mb: int
+    gpu_count: int
+    service_unit_type: str
+
+    seconds_running: int
+    seconds_stopped: int
+    # Billable seconds not billed because they were during outages.
+    seconds_excluded: int
+    su_hours: int
+
+
+def get_excluded_intervals(billing_start, billing_end, outages_data=None):
+    if outages_data is None:
+        outages_data = outages.load_from_url()
+    return outages_data.get_outages_during(
+        billing_start.isoformat(), billing_end.isoformat(), CLUSTER_NAME
+    )
 
 
 def get_runtime_for_instance(
@@ -102,62 +216,569 @@ def get_runtime_for_instance(
     return runtime
 
 
-def set_invoice_su_hours(invoice, service_unit_type, su_hours):
-    su_hour_attr = f"{service_unit_type}_su_hours"
-    if hasattr(invoice, su_hour_attr):
-        invoice.__setattr__(
-            su_hour_attr, invoice.__getattribute__(su_hour_attr) + su_hours
+def get_runtimes(
+    instances: list[model.Instance],
+    start: datetime,
+    end: datetime,
+    excluded_intervals: list[tuple[datetime, datetime]],
+    runtime_engine="reference",
+) -> list[model.InstanceRuntime]:
+    if runtime_engine == "reference":
+        return [
+            get_runtime_for_instance(i, start, end, excluded_intervals)
+            for i in instances
+        ]
+    elif runtime_engine == "vectorized":
+        return engines.get_runtimes_vectorized(
+            instances, start, end, excluded_intervals
         )
+    elif runtime_engine == "sweep":
+        window = engines.BillableWindow(start, end, excluded_intervals)
+        return [engines.get_runtime_sweep(i, window) for i in instances]
     else:
+        raise Exception(f"Invalid runtime engine {runtime_engine}.")
+
+
+def shard_projects(projects: list[model.Project], shard_count) -> list[tuple]:
+    """Splits projects, in order, into shards with similar numbers of events.
+
+    Each shard holds the distinct flavors of its instances, and each of its
+    instances is reduced to its uuid, the position of its flavor, its
+    deletion time and the timestamps and state codes of its state changes.
+    Those are much cheaper to send to another process than the dataclasses
+    they are read from, and don't need to be parsed again.
+    """
+    instances = [i for project in projects for i in project.instances]
+    shard_size = sum(len(i.events) + 1 for i in instances) / shard_count
+
+    shards = [({}, [])]
+    shard_events = 0
+    for project in projects:
+        if shard_events >= shard_size * len(shards):
+            shards.append(({}, []))
+        flavors, shard_instances = shards[-1]
+        for i in project.instances:
+            shard_instances.append(
+                (
+                    i.uuid,
+                    flavors.setdefault(i.flavor, len(flavors)),
+                    i.deleted_at,
+                    [
+                        (e.timestamp, e.state)
+                        for e in i.events
+                        if e.state != model.NO_STATE
+                    ],
+                )
+            )
+            shard_events += len(i.events) + 1
+    return [(list(flavors), shard_instances) for flavors, shard_instances in shards]
+
+
+def _get_runtimes_of_shard(shard, start, end, excluded_intervals, runtime_engine):
+    flavors, shard_instances = shard
+    instances = [
+        model.Instance(
+            uuid=uuid,
+            name=uuid,
+            flavor=flavors[flavor],
+            events=[model.InstanceEvent.from_state(*event) for event in events],
+            deleted_at=deleted_at,
+        )
+        for uuid, flavor, deleted_at, events in shard_instances
+    ]
+    return [
+        (r.total_seconds_running, r.total_seconds_stopped)
+        for r in get_runtimes(instances, start, end, excluded_intervals, runtime_engine)
+    ]
+
+
+def get_runtimes_in_parallel(
+    projects: list[model.Project],
+    start: datetime,
+    end: datetime,
+    excluded_intervals: list[tuple[datetime, datetime]],
+    runtime_engine="reference",
+    workers=2,
+) -> list[model.InstanceRuntime]:
+    """Returns the runtimes of the instances of the projects, in order.
+
+    Projects are sharded across a pool of worker processes, and the
+    runtimes of the shards are merged back in the order of the projects.
+    """
+    shards = shard_projects(projects, workers * SHARDS_PER_WORKER)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Results are returned in the order of the shards.
+        results = executor.map(
+            functools.partial(
+                _get_runtimes_of_shard,
+                start=start,
+                end=end,
+                excluded_intervals=excluded_intervals,
+                runtime_engine=runtime_engine,
+            ),
+            shards,
+        )
+        return [
+            model.InstanceRuntime(
+                total_seconds_running=running, total_seconds_stopped=stopped
+            )
+            for shard_runtimes in results
+            for running, stopped in shard_runtimes
+        ]
+
+
+def get_all_instances(database) -> list[model.Instance]:
+    return [i for project in database.projects for i in project.instances]
+
+
+def load_database_from_checkpoint(
+    load_database, start, end, excluded_intervals, checkpoint_file
+):
+    """Returns the database and the runtimes of its instances.
+
+    When the checkpoint file holds a checkpoint that the billing period
+    extends, only the events since the checkpoint are loaded, through
+    `load_database(events_since)`. Otherwise, every event is loaded and the
+    runtimes are computed in full. Either way, the checkpoint file is
+    replaced with a checkpoint at the end of the billing period.
+    """
+    previous = checkpoint.Checkpoint.load(checkpoint_file)
+    if previous is not None:
+        try:
+            previous.check_resumable(
+                engines.BillableWindow(start, end, excluded_intervals)
+            )
+            # Times are stored as naive UTC in the database.
+            events_since = datetime.fromtimestamp(previous.end, timezone.utc)
+            database = load_database(events_since.replace(tzinfo=None))
+            runtimes, current = checkpoint.get_runtimes(
+                get_all_instances(database),
+                start,
+                end,
+                excluded_intervals,
+                previous,
+            )
+            logger.info(f"Resumed from checkpoint at {events_since}.")
+        except checkpoint.CheckpointMismatch as e:
+            logger.warning(f"Not resuming from checkpoint: {e}")
+            previous = None
+
+    if previous is None:
+        database = load_database(None)
+        runtimes, current = checkpoint.get_runtimes(
+            get_all_instances(database), start, end, excluded_intervals
+        )
+
+    current.save(checkpoint_file)
+    return database, runtimes
+
+
+def get_runtimes_differentially(
+    database, start, end, excluded_intervals, checkpoint_file, all_events=False
+) -> list[model.InstanceRuntime]:
+    """Returns the runtimes of the instances of a database.
+
+    Only the instances whose fingerprints differ from the ones the
+    checkpoint file was computed from, or which changed since, are measured
+    again, and only their events are read unless `all_events`. The others
+    carry their runtimes forward. The checkpoint file is then replaced with
+    a checkpoint at the end of the billing period, fingerprinting every
+    instance.
+    """
+    fingerprints = database.get_fingerprints()
+    previous = checkpoint.Checkpoint.load(checkpoint_file)
+    if previous is not None:
+        try:
+            previous.check_resumable(
+                engines.BillableWindow(start, end, excluded_intervals)
+            )
+            if not all_events:
+                unchanged = previous.get_unchanged(fingerprints)
+                database.select_events_of(set(fingerprints) - unchanged)
+            runtimes, current = checkpoint.get_runtimes_differential(
+                get_all_instances(database),
+                fingerprints,
+                start,
+                end,
+                excluded_intervals,
+                previous,
+            )
+            logger.info(
+                f"Reprocessed the changes since checkpoint in {checkpoint_file}."
+            )
+        except checkpoint.CheckpointMismatch as e:
+            logger.warning(f"Not reprocessing from checkpoint: {e}")
+            previous = None
+
+    if previous is None:
+        runtimes, current = checkpoint.get_runtimes_differential(
+            get_all_instances(database),
+            fingerprints,
+            start,
+            end,
+            excluded_intervals,
+        )
+
+    current.save(checkpoint_file)
+    return runtimes
+
+
+def set_invoice_su_hours(invoice, service_unit_type, su_hours):
+    if service_unit_type not in INVOICE_SU_TYPES:
         raise Exception(f"Invalid flavor {service_unit_type}.")
+    invoice.su_hours[service_unit_type] = (
+        invoice.su_hours.get(service_unit_type, 0) + su_hours
+    )
     return invoice
 
 
 def collect_invoice_data_from_openstack(
-    database, billing_start, billing_end, rates, invoice_month=None
+    database,
+    billing_start,
+    billing_end,
+    rates,
+    invoice_month=None,
+    runtime_engine="reference",
+    excluded_intervals=None,
+    runtimes=None,
+    workers=1,
+    details=None,
 ):
+    """Returns the invoice of each project.
+
+    Unless given, as a list ordered like the instances of the projects,
+    runtimes are computed with the runtime engine, in parallel when
+    there are several workers. When `details` is a list, the detail of
+    each instance billed or running during an outage is appended to it.
+    """
     invoices = []
 
-    outages_data = outages.load_from_url()
-    excluded_intervals = outages_data.get_outages_during(
-        billing_start.isoformat(), billing_end.isoformat(), CLUSTER_NAME
-    )
+    if runtimes is None and excluded_intervals is None:
+        excluded_intervals = get_excluded_intervals(billing_start, billing_end)
+
+    if runtimes is None and workers > 1:
+        runtimes = get_runtimes_in_parallel(
+            database.projects,
+            billing_start,
+            billing_end,
+            excluded_intervals,
+            runtime_engine,
+            workers,
+        )
+    elif runtimes is None:
+        # Runtimes are computed for all instances at once, which lets the
+        # vectorized engine process them in a single batch.
+        runtimes = get_runtimes(
+            get_all_instances(database),
+            billing_start,
+            billing_end,
+            excluded_intervals,
+            runtime_engine,
+        )
+    runtimes = iter(runtimes)
 
     for project in database.projects:
-        invoice = ProjectInvoice(
-            project_name=project.uuid,
-            project_id=project.uuid,
-            pi="",
-            institution="",
-            instances=project.instances,
-            invoice_start=billing_start.replace(tzinfo=timezone.utc).isoformat(),
-            invoice_end=billing_end.replace(tzinfo=timezone.utc).isoformat(),
-            rates=rates,
+        invoices.append(
+            get_project_invoice(
+                project, runtimes, billing_start, billing_end, rates, details
+            )
+        )
+    return invoices
+
+
+def get_project_invoice(
+    project, runtimes, billing_start, billing_end, rates, details=None
+):
+    """Returns the invoice of a project, consuming the runtime of each instance.
+
+    When `details` is a list, the detail of each instance billed or
+    running during an outage is appended to it.
+    """
+    invoice = ProjectInvoice(
+        project_name=project.uuid,
+        project_id=project.uuid,
+        pi="",
+        institution="",
+        instances=project.instances,
+        invoice_start=billing_start.replace(tzinfo=timezone.utc).isoformat(),
+        invoice_end=billing_end.replace(tzinfo=timezone.utc).isoformat(),
+        rates=rates,
+    )
+
+    if details is not None:
+        period = engines.BillableWindow(billing_start, billing_end, [])
+
+    instances_billed = 0
+    for i in project.instances:  # type: model.Instance
+        runtime = next(runtimes)
+        runtime_seconds = runtime.total_seconds_running
+        if rates.include_stopped_runtime:
+            runtime_seconds += runtime.total_seconds_stopped
+
+        assert runtime_seconds <= (billing_end - billing_start).total_seconds()
+        runtime_hours = math.ceil(runtime_seconds / 3600)
+
+        if runtime_hours > 0:
+            su = i.service_units
+            su_hours = runtime_hours * su
+
+            invoice = set_invoice_su_hours(invoice, i.service_unit_type, su_hours)
+            instances_billed += 1
+
+        if details is not None:
+            detail = get_instance_detail(project, i, runtime, period, rates)
+            # Instances only running during outages are detailed with 0 SU
+            # hours, so that the outage seconds excluded from them show.
+            if detail.su_hours > 0 or detail.seconds_excluded > 0:
+                details.append(detail)
+
+    # Counted once per project, rather than once per instance.
+    metrics.count("projects_invoiced")
+    metrics.count("instances_billed", instances_billed)
+    metrics.count("events_processed", sum(len(i.events) for i in project.instances))
+    return invoice
+
+
+def get_instance_detail(
+    project, instance, runtime, period: engines.BillableWindow, rates
+) -> InstanceDetail:
+    """Returns the detail of an instance, given its runtime net of outages.
+
+    The seconds excluded are the difference with the runtime during the
+    whole period, a window without excluded intervals, so they are
+    consistent with whichever runtime engine the runtime was computed with.
+    """
+    runtime_seconds = runtime.total_seconds_running
+    gross = engines.measure_transitions(engines.get_transitions(instance), period)
+    gross_seconds = gross.total_seconds_running
+    if rates.include_stopped_runtime:
+        runtime_seconds += runtime.total_seconds_stopped
+        gross_seconds += gross.total_seconds_stopped
+
+    flavor = instance.flavor
+    return InstanceDetail(
+        instance_uuid=instance.uuid,
+        instance_name=instance.name,
+        project_id=project.uuid,
+        flavor_id=flavor.id,
+        vcpus=flavor.vcpus,
+        memory_mb=flavor.memory,
+        gpu_count=flavor.gpu_count,
+        service_unit_type=flavor.service_unit_type,
+        seconds_running=runtime.total_seconds_running,
+        seconds_stopped=runtime.total_seconds_stopped,
+        seconds_excluded=gross_seconds - runtime_seconds,
+        su_hours=math.ceil(runtime_seconds / 3600) * instance.service_units,
+    )
+
+
+def iter_invoice_data_from_openstack(
+    database,
+    billing_start,
+    billing_end,
+    rates,
+    runtime_engine="reference",
+    excluded_intervals=None,
+    details=None,
+):
+    """Yields the invoice of each project, reading projects one at a time.
+
+    Unlike `collect_invoice_data_from_openstack`, runtimes are computed one
+    project at a time, and nothing is kept once an invoice has been
+    yielded, except for the details of instances when `details`
+    is a list, so memory is bounded by the largest project.
+    """
+    if excluded_intervals is None:
+        excluded_intervals = get_excluded_intervals(billing_start, billing_end)
+
+    for project in database.iter_projects():
+        runtimes = get_runtimes(
+            project.instances,
+            billing_start,
+            billing_end,
+            excluded_intervals,
+            runtime_engine,
         )
+        yield get_project_invoice(
+            project, iter(runtimes), billing_start, billing_end, rates, details
+        )
+
+
+def collect_usage_timeseries(
+    database,
+    billing_start,
+    billing_end,
+    rates,
+    bucket="daily",
+    excluded_intervals=None,
+) -> list[InstanceUsage]:
+    """Returns the SU hours of each instance for every bucket of the period.
+
+    SU hours are computed per bucket the same way as for invoices, net of
+    outages, with a single pass over the events of each instance.
+    """
+    if excluded_intervals is None:
+        excluded_intervals = get_excluded_intervals(billing_start, billing_end)
+
+    bucket_seconds = USAGE_BUCKETS[bucket]
+    window = engines.BillableWindow(billing_start, billing_end, excluded_intervals)
+    bucket_starts = [
+        (billing_start + timedelta(seconds=bucket_seconds * n))
+        .replace(tzinfo=timezone.utc)
+        .isoformat()
+        for n in range(math.ceil((window.end - window.start) / bucket_seconds))
+    ]
 
+    usage = []
+    for project in database.projects:
         for i in project.instances:  # type: model.Instance
-            runtime = get_runtime_for_instance(
-                i, billing_start, billing_end, excluded_intervals
+            runtimes = engines.get_runtime_per_bucket(i, window, bucket_seconds)
+            for bucket_start, runtime in zip(bucket_starts, runtimes):
+                runtime_seconds = runtime.total_seconds_running
+                if rates.include_stopped_runtime:
+                    runtime_seconds += runtime.total_seconds_stopped
+                runtime_hours = math.ceil(runtime_seconds / 3600)
+
+                if runtime_hours > 0:
+                    usage.append(
+                        InstanceUsage(
+                            bucket_start=bucket_start,
+                            project_id=project.uuid,
+                            instance_uuid=i.uuid,
+                            service_unit_type=i.service_unit_type,
+                            seconds_running=runtime.total_seconds_running,
+                            seconds_stopped=runtime.total_seconds_stopped,
+                            su_hours=runtime_hours * i.service_units,
+                        )
+                    )
+    return usage
+
+
+def write_usage_timeseries(usage, rates, instance_output, project_output):
+    """Writes the usage of each instance, and the usage summed by project."""
+    with open(instance_output, "w", newline="") as f:
+        csv_usage_writer = csv.writer(
+            f, delimiter=",", quotechar="|", quoting=csv.QUOTE_MINIMAL
+        )
+        csv_usage_writer.writerow(
+            [
+                "Interval Start",
+                "Project - Allocation ID",
+                "Instance ID",
+                "Cluster Name",
+                "SU Type",
+                "Running Seconds",
+                "Stopped Seconds",
+                "SU Hours (GBhr or SUhr)",
+            ]
+        )
+        for u in usage:
+            csv_usage_writer.writerow(
+                [
+                    u.bucket_start,
+                    u.project_id,
+                    u.instance_uuid,
+                    CLUSTER_NAME,
+                    rates.get_su_name(u.service_unit_type),
+                    u.seconds_running,
+                    u.seconds_stopped,
+                    u.su_hours,
+                ]
             )
-            runtime_seconds = runtime.total_seconds_running
-            if rates.include_stopped_runtime:
-                runtime_seconds += runtime.total_seconds_stopped
 
-            assert runtime_seconds <= (billing_end - billing_start).total_seconds()
-            runtime_hours = math.ceil(runtime_seconds / 3600)
+    project_usage = {}
+    for u in usage:
+        key = (u.project_id, u.service_unit_type, u.bucket_start)
+        project_usage[key] = project_usage.get(key, 0) + u.su_hours
 
-            if runtime_hours > 0:
-                su = i.service_units
-                su_hours = runtime_hours * su
+    with open(project_output, "w", newline="") as f:
+        csv_usage_writer = csv.writer(
+            f, delimiter=",", quotechar="|", quoting=csv.QUOTE_MINIMAL
+        )
+        csv_usage_writer.writerow(
+            [
+                "Interval Start",
+                "Project - Allocation ID",
+                "Cluster Name",
+                "SU Type",
+                "SU Hours (GBhr or SUhr)",
+            ]
+        )
+        for (project_id, su_type, bucket_start), su_hours in sorted(
+            project_usage.items()
+        ):
+            csv_usage_writer.writerow(
+                [
+                    bucket_start,
+                    project_id,
+                    CLUSTER_NAME,
+                    rates.get_su_name(su_type),
+                    su_hours,
+                ]
+            )
 
-                invoice = set_invoice_su_hours(invoice, i.service_unit_type, su_hours)
 
-        invoices.append(invoice)
-    return invoices
+def write_instance_details(details: list[InstanceDetail], rates, output):
+    """Writes the detail of each instance to a CSV file."""
+    with open(output, "w", newline="") as f:
+        csv_detail_writer = csv.writer(
+            f, delimiter=",", quotechar="|", quoting=csv.QUOTE_MINIMAL
+        )
+        csv_detail_writer.writerow(
+            [
+                "Instance ID",
+                "Instance Name",
+                "Project - Allocation ID",
+                "Cluster Name",
+                "Flavor ID",
+                "vCPUs",
+                "Memory MB",
+                "GPUs",
+                "SU Type",
+                "Running Seconds",
+                "Stopped Seconds",
+                "Outage Seconds Excluded",
+                "SU Hours (GBhr or SUhr)",
+            ]
+        )
+        for d in details:
+            csv_detail_writer.writerow(
+                [
+                    d.instance_uuid,
+                    d.instance_name,
+                    d.project_id,
+                    CLUSTER_NAME,
+                    d.flavor_id,
+                    d.vcpus,
+                    d.memory_mb,
+                    d.gpu_count,
+                    rates.get_su_name(d.service_unit_type),
+                    d.seconds_running,
+                    d.seconds_stopped,
+                    d.seconds_excluded,
+                    d.su_hours,
+                ]
+            )
 
 
-def write(invoices, output, invoice_month=None):
-    generated_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+def get_invoice_lines(invoice):
+    """Yields the SU hours, SU name, rate and cost of each billed SU type."""
+    for service_unit_type in INVOICE_SU_TYPES:
+        # Each project gets a row for every SU type it used
+        hours = invoice.su_hours.get(service_unit_type, 0)
+        if hours > 0:
+            yield (
+                hours,
+                invoice.rates.get_su_name(service_unit_type),
+                invoice.rates.get_rate(service_unit_type),
+                invoice.get_su_cost(service_unit_type),
+            )
+
+
+def write(invoices, output, invoice_month=None, generated_at=None):
+    """Writes the invoices to a CSV file, as they are iterated over."""
+    if generated_at is None:
+        generated_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
 
     with open(output, "w", newline="") as f:
         csv_invoice_writer = csv.writer(
@@ -186,42 +807,101 @@ def write(invoices, output, invoice_month=None):
         )
 
         for invoice in invoices:
-            for invoice_type in [
-                "cpu",
-                "gpu_a100sxm4",
-                "gpu_a100",
-                "gpu_v100",
-                "gpu_k80",
-                "gpu_a2",
-            ]:
-                # Each project gets two rows, one for CPU and one for GPU
-                hours = invoice.__getattribute__(f"{invoice_type}_su_hours")
-                rate = invoice.rates.__getattribute__(invoice_type)
-                su_name = invoice.rates.__getattribute__(f"{invoice_type}_su_name")
-                cost = invoice.__getattribute__(f"{invoice_type}_su_cost")
-                cost = cost.quantize(Decimal(".01"), rounding=ROUND_HALF_UP)
-
-                if hours > 0:
-                    csv_invoice_writer.writerow(
-                        [
-                            invoice_month,
-                            invoice.invoice_start,
-                            invoice.invoice_end,
-                            invoice.project_name,
-                            invoice.project_id,
-                            invoice.pi,
-                            CLUSTER_NAME,
-                            "",  # Invoice Email
-                            "",  # Invoice Address
-                            invoice.institution,
-                            invoice.institution_specific_code,
-                            hours,
-                            su_name,
-                            rate,  # Rate
-                            cost,  # Cost
-                            generated_at,
-                        ]
-                    )
+            for hours, su_name, rate, cost in get_invoice_lines(invoice):
+                csv_invoice_writer.writerow(
+                    [
+                        invoice_month,
+                        invoice.invoice_start,
+                        invoice.invoice_end,
+                        invoice.project_name,
+                        invoice.project_id,
+                        invoice.pi,
+                        CLUSTER_NAME,
+                        "",  # Invoice Email
+                        "",  # Invoice Address
+                        invoice.institution,
+                        invoice.institution_specific_code,
+                        hours,
+                        su_name,
+                        rate,  # Rate
+                        cost,  # Cost
+                        generated_at,
+                    ]
+                )
+
+
+def _get_stored_sha256(s3, bucket, key) -> Optional[str]:
+    try:
+        head = s3.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+    return head["Metadata"].get("invoice-sha256")
+
+
+def get_invoice_sha256(path) -> str:
+    """Returns a hash of an invoice CSV, leaving out when it was generated.
+
+    Every run writes its own time in the "Generated At" column, so hashing
+    the file itself would tell apart invoices with the same lines.
+    """
+    digest = hashlib.sha256()
+    with open(path, newline="") as f:
+        rows = csv.reader(f, delimiter=",", quotechar="|")
+        header = next(rows, [])
+        generated_at = (
+            header.index("Generated At") if "Generated At" in header else None
+        )
+        for row in itertools.chain([header], rows):
+            if generated_at is not None:
+                del row[generated_at]
+            digest.update(f"{row!r}\n".encode())
+    return digest.hexdigest()
+
+
+def upload_with_copies(s3, path, bucket, key, copy_keys) -> list[str]:
+    """Uploads an invoice once, then copies it to other keys within S3.
+
+    The copies are made concurrently and server-side, without transferring
+    the file again. A copy is skipped when the object already stored at
+    its key has the same lines, as recorded in the invoice-sha256 metadata
+    of the objects uploaded here, even if it was generated at another time.
+
+    Returns the keys that were copied to.
+    """
+    sha256 = get_invoice_sha256(path)
+
+    with metrics.stage("upload"):
+        s3.upload_file(
+            path,
+            Bucket=bucket,
+            Key=key,
+            ExtraArgs={"Metadata": {"invoice-sha256": sha256}},
+        )
+    metrics.count("bytes_uploaded", os.path.getsize(path))
+    logger.info(f"Uploaded to {key}.")
+
+    def copy(copy_key):
+        if _get_stored_sha256(s3, bucket, copy_key) == sha256:
+            logger.info(f"Skipped copy to {copy_key}, content is unchanged.")
+            return False
+
+        s3.copy_object(
+            Bucket=bucket,
+            Key=copy_key,
+            CopySource={"Bucket": bucket, "Key": key},
+            MetadataDirective="COPY",
+        )
+        logger.info(f"Copied to {copy_key}.")
+        return True
+
+    with (
+        metrics.stage("copy"),
+        ThreadPoolExecutor(max_workers=max(len(copy_keys), 1)) as executor,
+    ):
+        copied = list(executor.map(copy, copy_keys))
+    return [copy_key for copy_key, c in zip(copy_keys, copied) if c]
 
 
 def generate_billing(
@@ -233,13 +913,180 @@ def generate_billing(
     upload_to_s3=False,
     sql_dump_file=None,
     upload_to_primary_location=True,
+    cache_dir=None,
+    dump_format="sqlite",
+    convert_dump=None,
+    explain=False,
+    runtime_engine="reference",
+    usage_timeseries=None,
+    checkpoint_file=None,
+    workers=1,
+    stream=False,
+    snapshot_cache=None,
+    record_snapshots=False,
+    columnar_format=None,
+    instance_details=False,
+    database=None,
+    differential=False,
 ):
-    database = model.Database(start, sql_dump_file)
+    """Writes the invoice of the period, and uploads it to S3 if requested.
+
+    The Nova database is loaded from the SQL dump, unless an open
+    `database` is given, such as a live one. When `differential`, only
+    the instances that changed since the checkpoint have their runtimes
+    measured again.
+    """
+    if stream and (checkpoint_file or workers > 1):
+        raise Exception("Streaming cannot be combined with checkpoints or workers.")
+    if stream and (usage_timeseries or instance_details):
+        # Usage time series read every project again once invoices are
+        # written, and instance details are held until the end of the run.
+        raise Exception(
+            "Streaming cannot be combined with usage time series or instance details."
+        )
+    if differential and not checkpoint_file:
+        raise Exception("Differential reprocessing requires a checkpoint file.")
+    if database is not None and checkpoint_file and not differential:
+        raise Exception("Checkpoints can only be resumed from with a SQL dump.")
+
+    def load_database(events_since=None):
+        return model.Database(
+            start,
+            sql_dump_file,
+            cache_dir=cache_dir,
+            dump_format=dump_format,
+            end=end,
+            events_since=events_since,
+            convert=convert_dump,
+        )
+
+    # Every output of the run carries the same time it was generated at.
+    generated_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
 
-    invoices = collect_invoice_data_from_openstack(
-        database, start, end, rates, invoice_month=invoice_month
+    with metrics.stage("load_outages"):
+        outages_data = snapshot_cache.load_outages() if snapshot_cache else None
+        excluded_intervals = get_excluded_intervals(start, end, outages_data)
+
+    details = [] if instance_details else None
+    runtimes = None
+    # Usage time series and instance details need every event, so a
+    # checkpoint would not save any work.
+    resume = checkpoint_file and not (
+        differential or usage_timeseries or instance_details
     )
-    write(invoices, output, invoice_month)
+    if database is None and resume:
+        with metrics.stage("load_database_from_checkpoint"):
+            database, runtimes = load_database_from_checkpoint(
+                load_database, start, end, excluded_intervals, checkpoint_file
+            )
+    elif database is None:
+        with metrics.stage("load_database"):
+            database = load_database()
+    if explain:
+        database.log_query_plans()
+
+    if differential:
+        with metrics.stage("compute_runtimes_differentially"):
+            runtimes = get_runtimes_differentially(
+                database,
+                start,
+                end,
+                excluded_intervals,
+                checkpoint_file,
+                # Usage time series and instance details read every event.
+                all_events=bool(usage_timeseries or instance_details),
+            )
+
+    if stream:
+        # Queries, runtimes and writing are interleaved project by project.
+        with metrics.stage("stream_invoices"):
+            invoices = iter_invoice_data_from_openstack(
+                database,
+                start,
+                end,
+                rates,
+                runtime_engine=runtime_engine,
+                excluded_intervals=excluded_intervals,
+            )
+            if columnar_format:
+                columns = columnar.InvoiceColumns(
+                    generated_at, CLUSTER_NAME, invoice_month
+                )
+                invoices = columns.add_all(invoices, get_invoice_lines)
+            write(invoices, output, invoice_month, generated_at)
+    else:
+        with metrics.stage("query_projects"):
+            projects = database.projects
+        logger.info(f"Loaded {len(projects)} projects with billable instances.")
+        with metrics.stage("compute_invoices"):
+            invoices = collect_invoice_data_from_openstack(
+                database,
+                start,
+                end,
+                rates,
+                invoice_month=invoice_month,
+                runtime_engine=runtime_engine,
+                excluded_intervals=excluded_intervals,
+                runtimes=runtimes,
+                workers=workers,
+                details=details,
+            )
+        with metrics.stage("write_invoice"):
+            write(invoices, output, invoice_month, generated_at)
+        if columnar_format:
+            columns = columnar.InvoiceColumns(generated_at, CLUSTER_NAME, invoice_month)
+            for invoice in invoices:
+                columns.add(invoice, get_invoice_lines(invoice))
+
+    output_without_ext = os.path.splitext(output)[0]
+    columnar_ext = columnar.OUTPUT_FORMATS.get(columnar_format)
+    if columnar_format:
+        with metrics.stage("write_columnar"):
+            columnar.write_table(
+                columns.to_table(),
+                f"{output_without_ext}{columnar_ext}",
+                columnar_format,
+            )
+    if instance_details:
+        with metrics.stage("write_instance_details"):
+            write_instance_details(
+                details, rates, f"{output_without_ext}_instance_details.csv"
+            )
+            if columnar_format:
+                columnar.write_table(
+                    columnar.get_details_table(
+                        details, rates.get_su_names(), CLUSTER_NAME
+                    ),
+                    f"{output_without_ext}_instance_details{columnar_ext}",
+                    columnar_format,
+                )
+
+    if snapshot_cache and record_snapshots:
+        # Records the rates and outages used, which a rerun can pin.
+        snapshot_cache.write_manifest(f"{output_without_ext}_snapshots.json")
+
+    if usage_timeseries:
+        with metrics.stage("usage_timeseries"):
+            usage = collect_usage_timeseries(
+                database,
+                start,
+                end,
+                rates,
+                bucket=usage_timeseries,
+                excluded_intervals=excluded_intervals,
+            )
+            write_usage_timeseries(
+                usage,
+                rates,
+                instance_output=f"{output_without_ext}_{usage_timeseries}_instance_usage.csv",
+                project_output=f"{output_without_ext}_{usage_timeseries}_project_usage.csv",
+            )
+            if columnar_format:
+                columnar.write_table(
+                    columnar.get_usage_table(usage, rates.get_su_names(), CLUSTER_NAME),
+                    f"{output_without_ext}_{usage_timeseries}_instance_usage{columnar_ext}",
+                    columnar_format,
+                )
 
     if upload_to_s3:
         s3_endpoint = os.getenv(
@@ -264,15 +1111,15 @@ def generate_billing(
             aws_secret_access_key=s3_secret,
         )
 
+        copy_locations = []
         if upload_to_primary_location:
             primary_location = (
                 f"Invoices/{invoice_month}/"
                 f"Service Invoices/NERC OpenStack {invoice_month}.csv"
             )
-            s3.upload_file(output, Bucket=s3_bucket, Key=primary_location)
-            logger.info(f"Uploaded to {primary_location}.")
+            copy_locations.append(primary_location)
 
-        # Upload daily copy
+        # Daily copy
         # End time is exclusive, subtract one second to find the inclusive end date
         invoice_date = end - timedelta(seconds=1)
         invoice_date = invoice_date.strftime("%Y-%m-%d")
@@ -280,14 +1127,12 @@ def generate_billing(
             f"Invoices/{invoice_month}/"
             f"Service Invoices/NERC OpenStack {invoice_date}.csv"
         )
-        s3.upload_file(output, Bucket=s3_bucket, Key=daily_location)
-        logger.info(f"Uploaded to {daily_location}.")
+        copy_locations.append(daily_location)
 
-        # Upload archival copy
+        # Archival copy, which is uploaded and then copied to the others
         timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
         archive_location = (
             f"Invoices/{invoice_month}/"
             f"Archive/NERC OpenStack {invoice_month} {timestamp}.csv"
         )
-        s3.upload_file(output, Bucket=s3_bucket, Key=archive_location)
-        logger.info(f"Uploaded to {archive_location}.")
+        upload_with_copies(s3, output, s3_bucket, archive_location, copy_locations)
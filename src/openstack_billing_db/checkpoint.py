@@ -0,0 +1,288 @@
+import collections
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from dataclasses_json import dataclass_json
+import json
+import logging
+import os
+from typing import Optional
+
+from openstack_billing_db import engines, metrics, model, utils
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the meaning of the saved fields changes, so that
+# checkpoints saved by older versions are not resumed from.
+CHECKPOINT_VERSION = 1
+
+
+class CheckpointMismatch(Exception):
+    """The checkpoint cannot be resumed from for the requested period."""
+
+
+@dataclass_json()
+@dataclass()
+class InstanceCheckpoint(object):
+    """Represents the billing state of an instance at the end of a run."""
+
+    uuid: str
+
+    # Code and entry time of the state of the instance at the end of the
+    # run, or None if it had no state yet.
+    state: Optional[int]
+    entered_at: Optional[int]
+
+    seconds_running: float
+    seconds_stopped: float
+
+    # Digest of the fingerprint of the instance the runtimes were computed
+    # from, or None if only the events since a checkpoint were loaded.
+    fingerprint: Optional[str] = None
+
+
+@dataclass_json()
+@dataclass()
+class Checkpoint(object):
+    """Represents the billing state of every instance at the end of a run.
+
+    Runtimes are accumulated from `start` until `end`, net of the excluded
+    intervals, the same way as by the sweep engine.
+    """
+
+    start: float
+    end: float
+    excluded_intervals: list[list[float]]
+    instances: list[InstanceCheckpoint]
+
+    version: int = CHECKPOINT_VERSION
+
+    @classmethod
+    def load(cls, path) -> Optional["Checkpoint"]:
+        if not os.path.exists(path):
+            logger.info(f"No checkpoint found at {path}.")
+            return None
+
+        # Read and written as plain JSON, in the format of `from_json` and
+        # `to_json`, which take seconds for tens of thousands of instances.
+        with open(path, "r") as f:
+            checkpoint = json.load(f)
+        checkpoint["instances"] = [
+            InstanceCheckpoint(**instance) for instance in checkpoint["instances"]
+        ]
+        return cls(**checkpoint)
+
+    def save(self, path):
+        checkpoint = dict(vars(self), instances=[vars(i) for i in self.instances])
+        utils.write_atomically(path, json.dumps(checkpoint))
+        logger.info(f"Saved checkpoint of {len(self.instances)} instances to {path}.")
+
+    def get_unchanged(
+        self, fingerprints: dict[str, model.InstanceFingerprint]
+    ) -> set[str]:
+        """Returns the uuids of the instances that did not change since.
+
+        Those are the instances checkpointed with the fingerprint they have,
+        and which have no event or deletion from the end of the checkpoint.
+        """
+        unchanged = set()
+        for instance in self.instances:
+            fingerprint = fingerprints.get(instance.uuid)
+            if (
+                fingerprint is not None
+                and fingerprint.digest == instance.fingerprint
+                and (fingerprint.changed_at or 0) < self.end
+            ):
+                unchanged.add(instance.uuid)
+        return unchanged
+
+    def check_resumable(self, window: engines.BillableWindow):
+        """Raises CheckpointMismatch unless the window extends the checkpoint.
+
+        The window must have the same start, must not end before the
+        checkpoint and must exclude the same intervals up to its end.
+        """
+        if self.version != CHECKPOINT_VERSION:
+            raise CheckpointMismatch(f"Checkpoint version {self.version}.")
+        if self.start != window.start:
+            raise CheckpointMismatch("Checkpoint starts at a different time.")
+        if self.end > window.end:
+            raise CheckpointMismatch("Checkpoint ends after the billing period.")
+
+        excluded_intervals = [
+            [interval_start, min(interval_end, self.end)]
+            for interval_start, interval_end in window.excluded
+            if interval_start < self.end
+        ]
+        if excluded_intervals != self.excluded_intervals:
+            raise CheckpointMismatch("Outages before the checkpoint have changed.")
+
+
+def get_runtimes(
+    instances: list[model.Instance],
+    start: datetime,
+    end: datetime,
+    excluded_intervals: list[tuple[datetime, datetime]],
+    checkpoint: Optional[Checkpoint] = None,
+) -> tuple[list[model.InstanceRuntime], Checkpoint]:
+    """Returns the runtimes of the instances, and a checkpoint at `end`.
+
+    Without a checkpoint, the instances must have all their events loaded.
+    With one, only the events at or after the end of the checkpoint are
+    needed, and runtimes are accumulated on top of the checkpointed ones.
+    Runtimes are computed the same way as by the sweep engine.
+
+    Raises CheckpointMismatch when the checkpoint cannot be resumed from.
+    """
+    window = engines.BillableWindow(start, end, excluded_intervals)
+
+    checkpointed = {}
+    if checkpoint:
+        checkpoint.check_resumable(window)
+        checkpointed = {i.uuid: i for i in checkpoint.instances}
+        resumed_window = engines.BillableWindow(
+            datetime.fromtimestamp(checkpoint.end, timezone.utc),
+            end,
+            excluded_intervals,
+        )
+
+    runtimes = []
+    instance_checkpoints = []
+    for instance in instances:
+        transitions = engines.get_transitions(instance)
+        previous = checkpointed.get(instance.uuid)
+
+        if previous is None:
+            runtime = engines.measure_transitions(transitions, window)
+        else:
+            if (
+                instance.deleted_at
+                and utils.to_timestamp(instance.deleted_at) < checkpoint.end
+                and len(transitions) > 1
+            ):
+                # The deletion is ordered after every event, including the
+                # ones after the checkpoint, so the time spent in states
+                # entered before the checkpoint cannot be carried over.
+                raise CheckpointMismatch(
+                    f"Instance {instance.uuid} has events after its deletion."
+                )
+
+            if previous.state is not None:
+                transitions.insert(0, (previous.state, previous.entered_at))
+            runtime = engines.measure_transitions(transitions, resumed_window)
+            runtime.total_seconds_running += previous.seconds_running
+            runtime.total_seconds_stopped += previous.seconds_stopped
+
+        instance_checkpoints.append(
+            _get_instance_checkpoint(instance, transitions, window, runtime)
+        )
+        runtimes.append(runtime)
+
+    return runtimes, _get_checkpoint(window, instance_checkpoints)
+
+
+def get_runtimes_differential(
+    instances: list[model.Instance],
+    fingerprints: dict[str, model.InstanceFingerprint],
+    start: datetime,
+    end: datetime,
+    excluded_intervals: list[tuple[datetime, datetime]],
+    checkpoint: Optional[Checkpoint] = None,
+) -> tuple[list[model.InstanceRuntime], Checkpoint]:
+    """Returns the runtimes of the instances, and a checkpoint at `end`.
+
+    `fingerprints` are read from a dump at least as recent as the one the
+    checkpoint was computed from. The runtime of an instance unchanged since
+    the checkpoint, as told by `Checkpoint.get_unchanged`, is carried
+    forward, only adding the time spent since in the state it was left in,
+    so its events need not be loaded. The runtimes of other instances are
+    computed in full, from the events needed for runtimes during
+    [start, end). Either way, runtimes are computed the same way as
+    by the sweep engine.
+
+    Raises CheckpointMismatch when the checkpoint cannot be resumed from.
+    """
+    window = engines.BillableWindow(start, end, excluded_intervals)
+
+    checkpointed = {}
+    if checkpoint:
+        checkpoint.check_resumable(window)
+        unchanged = checkpoint.get_unchanged(fingerprints)
+        checkpointed = {i.uuid: i for i in checkpoint.instances if i.uuid in unchanged}
+        resumed_window = engines.BillableWindow(
+            datetime.fromtimestamp(checkpoint.end, timezone.utc),
+            end,
+            excluded_intervals,
+        )
+        resumed = {
+            state: engines.measure_transitions(
+                [(state, checkpoint.end)], resumed_window
+            )
+            for state in model.STATE_CODES.values()
+        }
+
+    runtimes = []
+    instance_checkpoints = []
+    counts = collections.Counter()
+    for instance in instances:
+        fingerprint = fingerprints.get(instance.uuid)
+        previous = checkpointed.get(instance.uuid)
+
+        if previous is not None:
+            # The instance stayed since the checkpoint in the state it was
+            # left in, so that state is the same for every such instance.
+            runtime = model.InstanceRuntime(
+                previous.seconds_running,
+                previous.seconds_stopped,
+            )
+            if previous.state is not None:
+                runtime += resumed[previous.state]
+            instance_checkpoint = InstanceCheckpoint(
+                uuid=instance.uuid,
+                state=previous.state,
+                entered_at=previous.entered_at,
+                seconds_running=runtime.total_seconds_running,
+                seconds_stopped=runtime.total_seconds_stopped,
+                fingerprint=previous.fingerprint,
+            )
+            counts["instances_carried_forward"] += 1
+        else:
+            transitions = engines.get_transitions(instance)
+            runtime = engines.measure_transitions(transitions, window)
+            instance_checkpoint = _get_instance_checkpoint(
+                instance,
+                transitions,
+                window,
+                runtime,
+                fingerprint.digest if fingerprint else None,
+            )
+            counts["instances_recomputed"] += 1
+
+        instance_checkpoints.append(instance_checkpoint)
+        runtimes.append(runtime)
+
+    for name, value in counts.items():
+        metrics.count(name, value)
+    return runtimes, _get_checkpoint(window, instance_checkpoints)
+
+
+def _get_instance_checkpoint(
+    instance, transitions, window, runtime, fingerprint=None
+) -> InstanceCheckpoint:
+    state = engines.get_state_before(transitions, window.end)
+    return InstanceCheckpoint(
+        uuid=instance.uuid,
+        state=state[0] if state else None,
+        entered_at=state[1] if state else None,
+        seconds_running=runtime.total_seconds_running,
+        seconds_stopped=runtime.total_seconds_stopped,
+        fingerprint=fingerprint,
+    )
+
+
+def _get_checkpoint(window, instance_checkpoints) -> Checkpoint:
+    return Checkpoint(
+        start=window.start,
+        end=window.end,
+        excluded_intervals=[list(interval) for interval in window.excluded],
+        instances=instance_checkpoints,
+    )
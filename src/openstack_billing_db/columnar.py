@@ -0,0 +1,174 @@
+from datetime import datetime, timezone
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Scale of the decimal columns. Costs are rounded to cents when billed,
+# and rates are kept with enough digits for any rate in nerc-rates.
+COST_SCALE = 2
+RATE_SCALE = 10
+
+# Columnar formats the invoice can also be written in, by file extension.
+OUTPUT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise Exception(
+            "Writing Parquet or Arrow output requires pyarrow to be installed."
+        )
+    return pyarrow
+
+
+def _to_datetime(timestamp: str) -> datetime:
+    return datetime.fromisoformat(timestamp).astimezone(timezone.utc)
+
+
+class InvoiceColumns(object):
+    """Accumulates the lines of invoices as columns, with typed values.
+
+    Invoices can be added as they are computed, so that a streamed run
+    only keeps the few values of each invoice line. The time the invoice
+    was generated at is given, so that it matches the CSV invoice.
+    """
+
+    def __init__(self, generated_at: str, cluster_name: str, invoice_month=None):
+        self.invoice_month = invoice_month
+        self.generated_at = _to_datetime(generated_at)
+        self.cluster_name = cluster_name
+
+        self.columns = {
+            "invoice_start": [],
+            "invoice_end": [],
+            "project_name": [],
+            "project_id": [],
+            "pi": [],
+            "institution": [],
+            "institution_specific_code": [],
+            "su_hours": [],
+            "su_type": [],
+            "rate": [],
+            "cost": [],
+        }
+
+    def add(self, invoice, lines):
+        """Adds the SU hours, SU name, rate and cost of each invoice line."""
+        for hours, su_name, rate, cost in lines:
+            self.columns["invoice_start"].append(_to_datetime(invoice.invoice_start))
+            self.columns["invoice_end"].append(_to_datetime(invoice.invoice_end))
+            self.columns["project_name"].append(invoice.project_name)
+            self.columns["project_id"].append(invoice.project_id)
+            self.columns["pi"].append(invoice.pi)
+            self.columns["institution"].append(invoice.institution)
+            self.columns["institution_specific_code"].append(
+                invoice.institution_specific_code
+            )
+            self.columns["su_hours"].append(hours)
+            self.columns["su_type"].append(su_name)
+            self.columns["rate"].append(rate)
+            self.columns["cost"].append(cost)
+
+    def add_all(self, invoices, get_lines):
+        """Adds the invoices as they are iterated over, yielding them."""
+        for invoice in invoices:
+            self.add(invoice, get_lines(invoice))
+            yield invoice
+
+    def to_table(self):
+        pa = _import_pyarrow()
+        rows = len(self.columns["su_hours"])
+        timestamp = pa.timestamp("s", tz="UTC")
+        return pa.table(
+            {
+                "invoice_month": pa.array([self.invoice_month] * rows, pa.string()),
+                "invoice_start": pa.array(self.columns["invoice_start"], timestamp),
+                "invoice_end": pa.array(self.columns["invoice_end"], timestamp),
+                "project_name": pa.array(self.columns["project_name"], pa.string()),
+                "project_id": pa.array(self.columns["project_id"], pa.string()),
+                "pi": pa.array(self.columns["pi"], pa.string()),
+                "cluster_name": pa.array([self.cluster_name] * rows, pa.string()),
+                "institution": pa.array(self.columns["institution"], pa.string()),
+                "institution_specific_code": pa.array(
+                    self.columns["institution_specific_code"], pa.string()
+                ),
+                "su_hours": pa.array(self.columns["su_hours"], pa.int64()),
+                "su_type": pa.array(self.columns["su_type"], pa.string()),
+                "rate": pa.array(self.columns["rate"], pa.decimal128(38, RATE_SCALE)),
+                "cost": pa.array(self.columns["cost"], pa.decimal128(38, COST_SCALE)),
+                "generated_at": pa.array([self.generated_at] * rows, timestamp),
+            }
+        )
+
+
+def get_usage_table(usage, su_names: dict[str, str], cluster_name: str):
+    """Returns the usage of each instance as a table, with typed values."""
+    pa = _import_pyarrow()
+    return pa.table(
+        {
+            "interval_start": pa.array(
+                [_to_datetime(u.bucket_start) for u in usage],
+                pa.timestamp("s", tz="UTC"),
+            ),
+            "project_id": pa.array([u.project_id for u in usage], pa.string()),
+            "instance_id": pa.array([u.instance_uuid for u in usage], pa.string()),
+            "cluster_name": pa.array([cluster_name] * len(usage), pa.string()),
+            "su_type": pa.array(
+                [su_names[u.service_unit_type] for u in usage], pa.string()
+            ),
+            "seconds_running": pa.array(
+                [u.seconds_running for u in usage], pa.float64()
+            ),
+            "seconds_stopped": pa.array(
+                [u.seconds_stopped for u in usage], pa.float64()
+            ),
+            "su_hours": pa.array([u.su_hours for u in usage], pa.int64()),
+        }
+    )
+
+
+def get_details_table(details, su_names: dict[str, str], cluster_name: str):
+    """Returns the detail of each instance as a table."""
+    pa = _import_pyarrow()
+    return pa.table(
+        {
+            "instance_id": pa.array([d.instance_uuid for d in details], pa.string()),
+            "instance_name": pa.array([d.instance_name for d in details], pa.string()),
+            "project_id": pa.array([d.project_id for d in details], pa.string()),
+            "cluster_name": pa.array([cluster_name] * len(details), pa.string()),
+            "flavor_id": pa.array([d.flavor_id for d in details], pa.int64()),
+            "vcpus": pa.array([d.vcpus for d in details], pa.int64()),
+            "memory_mb": pa.array([d.memory_mb for d in details], pa.int64()),
+            "gpu_count": pa.array([d.gpu_count for d in details], pa.int64()),
+            "su_type": pa.array(
+                [su_names[d.service_unit_type] for d in details], pa.string()
+            ),
+            "seconds_running": pa.array(
+                [d.seconds_running for d in details], pa.float64()
+            ),
+            "seconds_stopped": pa.array(
+                [d.seconds_stopped for d in details], pa.float64()
+            ),
+            "seconds_excluded": pa.array(
+                [d.seconds_excluded for d in details], pa.float64()
+            ),
+            "su_hours": pa.array([d.su_hours for d in details], pa.int64()),
+        }
+    )
+
+
+def write_table(table, output, output_format="parquet"):
+    """Writes a table to a Parquet file, or to an Arrow IPC file."""
+    _import_pyarrow()
+    if output_format == "parquet":
+        import pyarrow.parquet
+
+        pyarrow.parquet.write_table(table, output)
+    elif output_format == "arrow":
+        import pyarrow.feather
+
+        pyarrow.feather.write_feather(table, output, compression="uncompressed")
+    else:
+        raise Exception(f"Unknown columnar output format {output_format}.")
+    logger.info(f"Wrote {table.num_rows} rows to {output}.")
@@ -1,12 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import collections
+import io
 import logging
 import os
 import subprocess
+import zlib
 
 import boto3
 
+from openstack_billing_db import metrics
+
 logger = logging.getLogger(__name__)
 
+# Size of each ranged GET when streaming a dump from S3, and how many of
+# them are in flight at once.
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_CONCURRENCY = 8
+
+
+def get_s3_input_client():
+    s3_endpoint = os.getenv(
+        "S3_INPUT_ENDPOINT_URL", "https://holecs.rc.fas.harvard.edu"
+    )
+    s3_key_id = os.getenv("S3_INPUT_ACCESS_KEY_ID")
+    s3_secret = os.getenv("S3_INPUT_SECRET_ACCESS_KEY")
+
+    if not s3_key_id or not s3_secret:
+        raise Exception(
+            "Must provide S3_INPUT_ACCESS_KEY_ID and"
+            " S3_INPUT_SECRET_ACCESS_KEY environment variables."
+        )
+
+    return boto3.client(
+        "s3",
+        endpoint_url=s3_endpoint,
+        aws_access_key_id=s3_key_id,
+        aws_secret_access_key=s3_secret,
+    )
+
+
+def find_latest_dump_key(s3, s3_bucket) -> str:
+    """Returns the key of today's dump of the nova db."""
+    key = None
+    today = datetime.today().strftime("%Y%m%d")
+
+    for ctl in ["nerc-ctl-0", "nerc-ctl-1", "nerc-ctl-2"]:
+        dumps = s3.list_objects_v2(Bucket=s3_bucket, Prefix=f"dbs/{ctl}/nova-{today}")
+
+        if "Contents" in dumps:
+            key = dumps["Contents"][0]["Key"]
+            break
+
+    if not key:
+        raise Exception(f"No database dumps found for {today}")
+    return key
+
 
 def download_latest_dump_from_s3() -> str:
     """Download the dump of the nova db from S3 storage.
@@ -39,51 +88,25 @@ def download_latest_dump_from_s3() -> str:
     }
 
     """
-    s3_endpoint = os.getenv(
-        "S3_INPUT_ENDPOINT_URL", "https://holecs.rc.fas.harvard.edu"
-    )
     s3_bucket = os.getenv("S3_INPUT_BUCKET", "nerc-osp-backups")
-    s3_key_id = os.getenv("S3_INPUT_ACCESS_KEY_ID")
-    s3_secret = os.getenv("S3_INPUT_SECRET_ACCESS_KEY")
-
-    if not s3_key_id or not s3_secret:
-        raise Exception(
-            "Must provide S3_INPUT_ACCESS_KEY_ID and"
-            " S3_INPUT_SECRET_ACCESS_KEY environment variables."
-        )
-
-    s3 = boto3.client(
-        "s3",
-        endpoint_url=s3_endpoint,
-        aws_access_key_id=s3_key_id,
-        aws_secret_access_key=s3_secret,
-    )
-
-    key = None
-    today = datetime.today().strftime("%Y%m%d")
-
-    for ctl in ["nerc-ctl-0", "nerc-ctl-1", "nerc-ctl-2"]:
-        dumps = s3.list_objects_v2(Bucket=s3_bucket, Prefix=f"dbs/{ctl}/nova-{today}")
-
-        if "Contents" in dumps:
-            key = dumps["Contents"][0]["Key"]
-            break
-
-    if not key:
-        raise Exception(f"No database dumps found for {today}")
+    s3 = get_s3_input_client()
+    key = find_latest_dump_key(s3, s3_bucket)
 
     filename = os.path.basename(key)
     download_location = f"/tmp/{filename}"
 
     logger.info(f"Downloading {key} to {download_location}.")
-    s3.download_file(s3_bucket, key, download_location)
+    with metrics.stage("download"):
+        s3.download_file(s3_bucket, key, download_location)
 
     logger.info("Download complete.")
+    metrics.count("bytes_downloaded", os.path.getsize(download_location))
 
     path_without_ext, extension = os.path.splitext(download_location)
     if extension == ".gz":
         logger.info(f"Uncompressing {download_location}")
-        command = subprocess.run(["gzip", "-d", download_location])
+        with metrics.stage("uncompress"):
+            command = subprocess.run(["gzip", "-d", download_location])
         if command.returncode != 0:
             raise Exception(f"Error uncompressing {download_location}.")
 
@@ -95,6 +118,124 @@ def download_latest_dump_from_s3() -> str:
     return download_location
 
 
+def iter_object_chunks(
+    s3, s3_bucket, key, chunk_size=DEFAULT_CHUNK_SIZE, concurrency=DEFAULT_CONCURRENCY
+):
+    """Yields the content of an S3 object in order, in chunks.
+
+    The chunks are fetched with ranged GETs, `concurrency` at a time, and
+    at most twice that many are held in memory. Every GET is conditional
+    on the ETag of the object, so that a dump replaced mid-download fails
+    instead of being mixed with its replacement.
+    """
+    head = s3.head_object(Bucket=s3_bucket, Key=key)
+    size, etag = head["ContentLength"], head["ETag"]
+    logger.info(f"Streaming {key} of {size} bytes.")
+
+    def get_range(offset):
+        last = min(offset + chunk_size, size) - 1
+        response = s3.get_object(
+            Bucket=s3_bucket, Key=key, Range=f"bytes={offset}-{last}", IfMatch=etag
+        )
+        chunk = response["Body"].read()
+        if len(chunk) != last - offset + 1:
+            raise Exception(f"Short read of {key} at offset {offset}.")
+        return chunk
+
+    offsets = iter(range(0, size, chunk_size))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = collections.deque()
+        try:
+            for offset in offsets:
+                pending.append(executor.submit(get_range, offset))
+                if len(pending) >= 2 * concurrency:
+                    break
+
+            while pending:
+                chunk = pending.popleft().result()
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(executor.submit(get_range, offset))
+
+                metrics.count("bytes_downloaded", len(chunk))
+                yield chunk
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _gunzip_chunks(chunks):
+    """Decompresses a gzip stream, of one or more members, chunk by chunk."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            while chunk:
+                if decompressor.eof:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                yield decompressor.decompress(chunk)
+                chunk = decompressor.unused_data
+        if not decompressor.eof:
+            raise Exception("Truncated gzip stream.")
+    finally:
+        chunks.close()
+
+
+class _ChunkStream(io.RawIOBase):
+    """A binary file reading from an iterator of chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._chunk = memoryview(chunk)
+
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._chunks.close()
+        super().close()
+
+
+def open_s3_object(
+    s3, s3_bucket, key, chunk_size=DEFAULT_CHUNK_SIZE, concurrency=DEFAULT_CONCURRENCY
+) -> io.TextIOBase:
+    """Opens an S3 object as a text file, streamed with parallel ranged GETs.
+
+    Objects with a .gz key are decompressed in process as they are read,
+    so nothing is written to disk. Closing the file stops the download.
+    """
+    chunks = iter_object_chunks(s3, s3_bucket, key, chunk_size, concurrency)
+    if key.endswith(".gz"):
+        chunks = _gunzip_chunks(chunks)
+    return io.TextIOWrapper(io.BufferedReader(_ChunkStream(chunks)), encoding="utf-8")
+
+
+def open_latest_dump_from_s3(
+    chunk_size=DEFAULT_CHUNK_SIZE, concurrency=DEFAULT_CONCURRENCY
+) -> io.TextIOBase:
+    """Opens the dump of the nova db from S3 storage, without downloading it.
+
+    Same dump as `download_latest_dump_from_s3`, returned as a text file
+    that can be given directly to `model.Database`.
+    """
+    s3_bucket = os.getenv("S3_INPUT_BUCKET", "nerc-osp-backups")
+    s3 = get_s3_input_client()
+    key = find_latest_dump_key(s3, s3_bucket)
+    return open_s3_object(s3, s3_bucket, key, chunk_size, concurrency)
+
+
 def convert_mysqldump_to_sqlite(path_to_dump) -> str:
     """Converts mysqldump generated SQL file to SQLite compatible.
 
@@ -111,7 +252,7 @@ def convert_mysqldump_to_sqlite(path_to_dump) -> str:
     logger.info("Converting MySQL dump to SQLite compatible.")
 
     destination_path = f"/tmp/{os.path.basename(path_without_ext)}_converted.sql"
-    with open(f"{destination_path}", "w") as f:
+    with metrics.stage("convert"), open(f"{destination_path}", "w") as f:
         command = subprocess.run(["mysql2sqlite", path_to_dump], stdout=f)
 
     if command.returncode != 0:
@@ -0,0 +1,115 @@
+from contextlib import contextmanager
+import json
+import logging
+import resource
+import sys
+import time
+
+from openstack_billing_db import utils
+
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_PREFIX = "openstack_billing"
+
+# Seconds spent in each named stage, and values of each counter keyed by
+# name and labels, since the last reset.
+_stages: dict[str, float] = {}
+_counters: dict[tuple[str, tuple], float] = {}
+
+
+def reset():
+    _stages.clear()
+    _counters.clear()
+
+
+@contextmanager
+def stage(name):
+    """Times a stage of the billing run, adding up repeated stages."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        _stages[name] = _stages.get(name, 0) + seconds
+        logger.info(f"Stage {name} took {seconds:.3f} seconds.")
+
+
+def count(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def get_peak_rss() -> dict[str, int]:
+    """Returns the peak resident set size of this process and its children."""
+
+    def to_bytes(maxrss):
+        # Linux reports kilobytes, macOS bytes.
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+    return {
+        "self": to_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+        "children": to_bytes(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+    }
+
+
+def get_summary(success=True) -> dict:
+    return {
+        "success": success,
+        "finished_at": time.time(),
+        "stages": {name: round(seconds, 6) for name, seconds in _stages.items()},
+        "counters": [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(_counters.items())
+        ],
+        "peak_rss_bytes": get_peak_rss(),
+    }
+
+
+def write_json(path, success=True):
+    utils.write_atomically(path, json.dumps(get_summary(success), indent=2) + "\n")
+    logger.info(f"Wrote metrics summary to {path}.")
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in labels.values()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+def format_prometheus(success=True) -> str:
+    """Returns the metrics in the Prometheus text exposition format."""
+    summary = get_summary(success)
+    samples = {
+        "last_run_success": [({}, int(summary["success"]))],
+        "last_run_timestamp_seconds": [({}, summary["finished_at"])],
+        "stage_duration_seconds": [
+            ({"stage": name}, seconds) for name, seconds in summary["stages"].items()
+        ],
+        "peak_rss_bytes": [
+            ({"process": process}, rss)
+            for process, rss in summary["peak_rss_bytes"].items()
+        ],
+    }
+    for counter in summary["counters"]:
+        samples.setdefault(counter["name"], []).append(
+            (counter["labels"], counter["value"])
+        )
+
+    lines = []
+    for name, values in samples.items():
+        metric = f"{PROMETHEUS_PREFIX}_{name}"
+        lines.append(f"# TYPE {metric} gauge")
+        for labels, value in values:
+            lines.append(f"{metric}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, success=True):
+    # Written atomically, as the textfile collector of the node exporter
+    # may read it at any time.
+    utils.write_atomically(path, format_prometheus(success))
+    logger.info(f"Wrote Prometheus metrics to {path}.")
@@ -1,14 +1,57 @@
+import functools
+import gzip
+import hashlib
+import itertools
 import json
 from abc import abstractmethod
 import datetime
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from dataclasses_json import dataclass_json
 import logging
+import os
+import re
 import sqlite3
-from typing import Optional
+import sys
+from typing import Callable, Iterator, Optional, TextIO, Union
+
+from openstack_billing_db import metrics, mysqldump, utils
 
 logger = logging.getLogger(__name__)
 
+# Bump whenever the layout of the cached SQLite files changes, so that
+# caches built by older versions are not reused.
+CACHE_VERSION = 3
+
+# Formats of SQL dumps that can be loaded. A "sqlite" dump is executed
+# as is, while a "mysqldump" dump is read natively, loading only the
+# tables needed for billing.
+DUMP_FORMATS = ("sqlite", "mysqldump")
+
+# States of an instance, with the actions that move the instance into them.
+VM_STATES = (
+    ("Running", ["unshelve", "create", "start"]),
+    ("Shelved", ["shelve"]),
+    ("Stopped", ["stop"]),
+    ("Deleted", ["delete"]),
+    ("Error", []),
+)
+
+# Actions that can change the state of an instance. Any action whose
+# message is "Error" also moves the instance into the Error state.
+STATE_CHANGING_ACTIONS = tuple(
+    action for _, triggers in VM_STATES for action in triggers
+)
+
+# Small integer codes of the states, by name, and of the state each
+# action moves an instance into, by action.
+STATE_CODES = {state_name: code for code, (state_name, _) in enumerate(VM_STATES)}
+ACTION_STATE_CODES = {
+    action: STATE_CODES[state_name]
+    for state_name, triggers in VM_STATES
+    for action in triggers
+}
+NO_STATE = -1
+
 
 @dataclass
 class State:
@@ -26,8 +69,10 @@ class State:
 
 
 @dataclass_json()
-@dataclass()
+@dataclass(frozen=True)
 class Flavor(object):
+    """The resources of an instance. Immutable, as instances share them."""
+
     id: int
     service_unit_type: str
     vcpus: int
@@ -35,7 +80,7 @@ class Flavor(object):
     storage: int
     gpu_count: int = 0
 
-    @property
+    @functools.cached_property
     def service_units(self):
         # 1 CPU SU = 0 GPU, 1 CPU, 4 GB RAM, 20 GB
         return self.gpu_count or int(
@@ -46,18 +91,81 @@ class Flavor(object):
         )
 
 
-@dataclass()
+@dataclass(slots=True)
 class InstanceEvent(object):
+    """An action on an instance.
+
+    Times given as strings, as returned by SQLite, are parsed once when the
+    event is created. `timestamp` holds the time in seconds since the epoch
+    and `state` the code of the state the event moves the instance into,
+    or NO_STATE if it doesn't change its state.
+    """
+
     time: datetime.datetime
     name: str
     message: str
 
+    timestamp: int = field(init=False, repr=False, compare=False)
+    state: int = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if isinstance(self.time, str):
+            self.time = datetime.datetime.fromisoformat(self.time)
+        self.timestamp = int(utils.to_timestamp(self.time))
+
+        # Names and messages repeat across events, share a single copy.
+        self.name = sys.intern(self.name) if self.name else self.name
+        self.message = sys.intern(self.message) if self.message else self.message
+
+        # Error state can only be determined by the event message
+        if self.message == "Error":
+            self.state = STATE_CODES["Error"]
+        else:
+            self.state = ACTION_STATE_CODES.get(self.name, NO_STATE)
+
+    @classmethod
+    def from_state(cls, timestamp: int, state: int) -> "InstanceEvent":
+        """Returns an event moving an instance into a state, at a timestamp.
+
+        Rebuilds an event from the values parsed from another one, without
+        its action name. The message is only kept for the Error state.
+        """
+        event = cls.__new__(cls)
+        event.time = datetime.datetime.fromtimestamp(
+            timestamp, datetime.timezone.utc
+        ).replace(tzinfo=None)
+        event.name = None
+        event.message = "Error" if state == STATE_CODES["Error"] else None
+        event.timestamp = timestamp
+        event.state = state
+        return event
+
+
+@dataclass
+class InstanceFingerprint(object):
+    """Identifies the row and events of an instance without reading them.
+
+    Changes whenever an event of the instance is added, archived or marked
+    as an error, or the instance is deleted.
+    """
+
+    digest: str
+
+    # Time of the last event or of the deletion of the instance, if any.
+    changed_at: Optional[float] = None
+
 
 @dataclass
 class InstanceRuntime(object):
     total_seconds_running: int = 0
     total_seconds_stopped: int = 0
 
+    def __add__(self, other):
+        return InstanceRuntime(
+            self.total_seconds_running + other.total_seconds_running,
+            self.total_seconds_stopped + other.total_seconds_stopped,
+        )
+
     def __sub__(self, other):
         return InstanceRuntime(
             self.total_seconds_running - other.total_seconds_running,
@@ -75,6 +183,11 @@ class Instance(object):
     deleted_at: Optional[datetime.datetime] = None
     no_delete_action: bool = False
 
+    def __post_init__(self):
+        # SQLite returns times as strings, parse them once.
+        if isinstance(self.deleted_at, str):
+            self.deleted_at = datetime.datetime.fromisoformat(self.deleted_at)
+
     @staticmethod
     def _clamp_time(time, min_time, max_time):
         # Note(knikolla): SQLite gives me a string here, sometimes.
@@ -106,15 +219,17 @@ class Instance(object):
                         current_state = enter_state("Error", clamped_event_time)
                     continue
 
-                for state in vm_states:
-                    if event.name in state.triggers:
-                        if current_state is None:
-                            current_state = state
-                            state.enter(clamped_event_time)
-                        elif state.name != current_state.name:
-                            current_state.exit(clamped_event_time)
-                            current_state = state
-                            state.enter(clamped_event_time)
+                if event.state == NO_STATE:
+                    continue
+
+                state = vm_states[event.state]
+                if current_state is None:
+                    current_state = state
+                    state.enter(clamped_event_time)
+                elif state.name != current_state.name:
+                    current_state.exit(clamped_event_time)
+                    current_state = state
+                    state.enter(clamped_event_time)
 
             # Some VM instances may have a `deleted_at` time, another trigger for the `Deleted` state
             if self.deleted_at:
@@ -127,26 +242,18 @@ class Instance(object):
             current_state.exit(end_time)
 
         def get_state_time(state_name):
-            for state in vm_states:
-                if state.name == state_name:
-                    return state.time_in
+            return vm_states[STATE_CODES[state_name]].time_in
 
         def enter_state(state_name, enter_time) -> State:
-            for state in vm_states:
-                if state.name == state_name:
-                    state.enter(enter_time)
-                    return state
+            state = vm_states[STATE_CODES[state_name]]
+            state.enter(enter_time)
+            return state
 
         runtime = InstanceRuntime()
+        # Indexed by state code
         vm_states = [
             State(state_name, state_triggers)
-            for state_name, state_triggers in (
-                ("Running", ["unshelve", "create", "start"]),
-                ("Shelved", ["shelve"]),
-                ("Stopped", ["stop"]),
-                ("Deleted", ["delete"]),
-                ("Error", []),
-            )
+            for state_name, state_triggers in VM_STATES
         ]
 
         run_state_machine()
@@ -171,28 +278,97 @@ class Project(object):
 
 
 class BaseDatabase(object):
+    # Instances that may have been billable at some point since `start`,
+    # joined with the extra columns that determine their flavor.
+    INSTANCES_QUERY = """
+        select
+            instances.project_id,
+            instances.uuid,
+            instances.hostname,
+            instances.instance_type_id,
+            instances.memory_mb,
+            instances.vcpus,
+            instances.deleted_at,
+            instance_extra.pci_requests
+        from instances
+        left join instance_extra on instances.uuid = instance_extra.instance_uuid
+        where
+            (instances.deleted_at > :start or instances.deleted = 0)
+    """
+
+    PROJECTS_QUERY = f"{INSTANCES_QUERY} order by instances.project_id"
+
+    # Aggregates of the events of the instances returned by INSTANCES_QUERY,
+    # each sought in the index on instance_uuid rather than read as events.
+    FINGERPRINTS_QUERY = """
+        select
+            instances.uuid,
+            instances.deleted_at,
+            (
+                select count(*) from instance_actions
+                where instance_uuid = instances.uuid
+            ) as event_count,
+            (
+                select max(id) from instance_actions
+                where instance_uuid = instances.uuid
+            ) as last_event_id,
+            (
+                select max(created_at) from instance_actions
+                where instance_uuid = instances.uuid
+            ) as last_event_at,
+            (
+                select count(*) from instance_actions
+                where instance_uuid = instances.uuid and message = 'Error'
+            ) as error_count
+        from instances
+        where
+            (instances.deleted_at > :start or instances.deleted = 0)
+    """
+
+    def __init__(self):
+        # Flavors of this database, by the columns they are read from.
+        self._flavors: dict[tuple, Flavor] = {}
+
+    @staticmethod
+    def _format_time(time: datetime.datetime) -> str:
+        """Returns a time as Nova stores it, which SQLite compares as text."""
+        return time.isoformat(sep=" ")
+
     @property
     @abstractmethod
     def projects(self) -> list[Project]:
         """Returns a list of Project, containing instances and events."""
 
+    @abstractmethod
+    def get_fingerprints(self) -> dict[str, InstanceFingerprint]:
+        """Returns the fingerprint of every instance, keyed by instance uuid."""
 
-class Database(BaseDatabase):
-    def __init__(self, start, sql_dump_location: str):
-        self.db_nova = sqlite3.connect(":memory:")
-        self.db_nova.row_factory = sqlite3.Row
-        with open(sql_dump_location, "r") as sql:
-            self.db_nova.executescript(sql.read())
-        self.start = start
+    @staticmethod
+    def _get_fingerprint_from_row(row) -> InstanceFingerprint:
+        # Both times are in the same format, which sorts chronologically.
+        changes = [t for t in (row["last_event_at"], row["deleted_at"]) if t]
+        return InstanceFingerprint(
+            digest=(
+                f"{row['event_count']}:{row['last_event_id']}"
+                f":{row['error_count']}:{row['deleted_at']}"
+            ),
+            changed_at=utils.to_timestamp(max(changes)) if changes else None,
+        )
 
-        self._projects = None
+    def select_events_of(self, uuids: set[str]):
+        """Reads only the events of these instances from then on.
 
-    @property
-    def projects(self) -> list[Project]:
-        if not self._projects:
-            self._projects = self.get_projects()
+        Databases that can read the events of some instances only override
+        this, so that the events of the others are not read at all.
+        """
 
-        return self._projects
+    def iter_projects(self) -> Iterator[Project]:
+        """Yields the same projects as `projects`, one at a time.
+
+        Databases that can read projects lazily override this, so that only
+        one project needs to be held in memory at a time.
+        """
+        yield from self.projects
 
     @staticmethod
     def _get_gpu_flavor_info(pci_info):
@@ -208,94 +384,498 @@ class Database(BaseDatabase):
 
         return (su_type, count)
 
-    def get_events(self, instance_uuid) -> list[InstanceEvent]:
-        cursor = self.db_nova.cursor()
-        cursor.execute(
-            f"select created_at, action, message from instance_actions where"
-            f' instance_uuid = "{instance_uuid}" order by created_at'
+    @staticmethod
+    def _get_event_from_row(event) -> InstanceEvent:
+        return InstanceEvent(
+            time=event["created_at"],
+            name=event["action"],
+            message=event["message"],
         )
-        return [
-            InstanceEvent(
-                time=event["created_at"], name=event["action"], message=event["message"]
-            )
-            for event in cursor.fetchall()
-        ]
 
-    def get_instances(self, project) -> list[Instance]:
-        instances = []
+    def _get_flavor(self, instance_type_id, vcpus, memory_mb, pci_requests) -> Flavor:
+        """Returns the flavor of instances with these columns.
 
-        cursor = self.db_nova.cursor()
-        cursor.execute(
-            f"""
-            select
-                instances.uuid,
-                hostname,
-                instance_type_id,
-                memory_mb,
-                vcpus,
-                instances.deleted_at,
-                pci_requests
-            from instances
-            left join instance_extra on instances.uuid = instance_extra.instance_uuid
-            where
-                instances.project_id = "{project}"
-                and (instances.deleted_at > "{self.start.isoformat()}"
-                    or instances.deleted = 0)
+        Thousands of instances share a handful of combinations of flavor
+        and PCI requests, so the requests are parsed once per combination
+        and the same Flavor is returned for each of them.
         """
+        key = (instance_type_id, vcpus, memory_mb, pci_requests)
+        if key not in self._flavors:
+            self._flavors[key] = self._parse_flavor(*key)
+        return self._flavors[key]
+
+    @staticmethod
+    def _parse_flavor(instance_type_id, vcpus, memory_mb, pci_requests) -> Flavor:
+        try:
+            pci_info = json.loads(pci_requests)
+        except TypeError:
+            pci_info = None
+            logger.warning(
+                f"Could not parse pci requests {pci_requests!r}"
+                f" of flavor {instance_type_id}."
+            )
+        su_type = "cpu"
+        gpu_count = 0
+        if pci_info:
+            # The PCI Requests column of the database contains a JSON
+            # object with the below format. If the instance has an
+            # associated GPU, it will show up in the list of PCI
+            # requests as below.
+            #
+            # [
+            #   {
+            #     "count": 1,
+            #     "spec": [...],
+            #     "alias_name": "V100",
+            #     "is_new": false,
+            #     "numa_policy": "legacy",
+            #     "request_id": null,
+            #     "requester_id": null
+            #   }
+            # ]
+            su_type, gpu_count = BaseDatabase._get_gpu_flavor_info(pci_info)
+
+        flavor = Flavor(
+            id=instance_type_id,
+            service_unit_type=su_type,
+            vcpus=vcpus,
+            memory=memory_mb,
+            storage=20,
+            gpu_count=gpu_count,
+        )
+        # Computed once, rather than for every instance billed.
+        flavor.service_units
+        return flavor
+
+    def _get_instance_from_row(self, instance, events: list[InstanceEvent]) -> Instance:
+        flavor = self._get_flavor(
+            instance["instance_type_id"],
+            instance["vcpus"],
+            instance["memory_mb"],
+            instance["pci_requests"],
         )
 
-        for instance in cursor.fetchall():
-            try:
-                pci_info = json.loads(instance["pci_requests"])
-            except TypeError:
-                pci_info = None
-                logger.warning(
-                    f"Could not parse pci requests from instance {instance}."
-                )
-            su_type = "cpu"
-            gpu_count = 0
-            if pci_info:
-                # The PCI Requests column of the database contains a JSON
-                # object with the below format. If the instance has an
-                # associated GPU, it will show up in the list of PCI
-                # requests as below.
-                #
-                # [
-                #   {
-                #     "count": 1,
-                #     "spec": [...],
-                #     "alias_name": "V100",
-                #     "is_new": false,
-                #     "numa_policy": "legacy",
-                #     "request_id": null,
-                #     "requester_id": null
-                #   }
-                # ]
-                su_type, gpu_count = self._get_gpu_flavor_info(pci_info)
-
-            flavor = Flavor(
-                id=instance["instance_type_id"],
-                service_unit_type=su_type,
-                vcpus=instance["vcpus"],
-                memory=instance["memory_mb"],
-                storage=20,
-                gpu_count=gpu_count,
+        return Instance(
+            uuid=instance["uuid"],
+            name=instance["hostname"],
+            flavor=flavor,
+            events=events,
+            deleted_at=instance["deleted_at"],
+        )
+
+
+class Database(BaseDatabase):
+    # Pragmas applied while loading a dump. The database is either in
+    # memory or a cache file that is only trusted once fully built, so
+    # there is nothing for a journal or syncing to protect.
+    BULK_LOAD_PRAGMAS = (
+        "pragma journal_mode = OFF",
+        "pragma synchronous = OFF",
+        "pragma cache_size = -262144",
+    )
+
+    # Indexes supporting the queries used during billing.
+    INDEXES = (
+        "create index if not exists instance_actions_instance_uuid_created_at_idx"
+        " on instance_actions (instance_uuid, created_at)",
+        # Billable instances are found through one index for either side of
+        # `deleted = 0 or deleted_at > :start`, covering their uuid.
+        "create index if not exists instances_deleted_deleted_at_uuid_idx"
+        " on instances (deleted, deleted_at, uuid)",
+        "create index if not exists instances_deleted_at_uuid_idx"
+        " on instances (deleted_at, uuid)",
+        "create index if not exists instance_extra_instance_uuid_idx"
+        " on instance_extra (instance_uuid)",
+    )
+
+    def __init__(
+        self,
+        start,
+        sql_dump_location: Union[str, TextIO],
+        cache_dir: Optional[str] = None,
+        dump_format: str = "sqlite",
+        end=None,
+        events_since=None,
+        convert: Optional[Callable[[str], str]] = None,
+    ):
+        """Loads the Nova database from an SQL dump.
+
+        When `end` is given, only the events needed to compute runtimes
+        during windows within [start, end) are loaded. When `events_since`
+        is given, only events at or after it are loaded, for resuming from
+        a checkpoint taken at that time.
+
+        The dump is either a path or an open text file, such as a dump
+        streamed from S3, which can't be cached as it can't be hashed.
+        `convert` returns the path of the dump converted to `dump_format`,
+        such as with mysql2sqlite. The cache is keyed by the unconverted
+        dump, so the conversion only runs when the cache is built.
+        """
+        super().__init__()
+        if dump_format not in DUMP_FORMATS:
+            raise Exception(f"Unsupported dump format {dump_format}.")
+        if cache_dir and not isinstance(sql_dump_location, str):
+            raise Exception("Only dumps read from a file can be cached.")
+
+        if cache_dir:
+            self.db_nova = self._open_cached_database(
+                sql_dump_location, cache_dir, dump_format, convert
             )
+        else:
+            if convert:
+                sql_dump_location = convert(sql_dump_location)
+            self.db_nova = sqlite3.connect(":memory:")
+            self._load_dump(self.db_nova, sql_dump_location, dump_format)
+        self.db_nova.row_factory = sqlite3.Row
+        self.start = start
+        self.end = end
+        self.events_since = events_since
+
+        self._projects = None
+        self._events = None
+
+    @classmethod
+    def _load_dump(cls, connection, sql_dump_location, dump_format="sqlite"):
+        for pragma in cls.BULK_LOAD_PRAGMAS:
+            connection.execute(pragma)
+
+        with metrics.stage("load_dump"):
+            if dump_format == "mysqldump":
+                mysqldump.load_mysqldump_into_sqlite(sql_dump_location, connection)
+            else:
+                if not isinstance(sql_dump_location, str):
+                    sql = sql_dump_location
+                elif sql_dump_location.endswith(".gz"):
+                    sql = gzip.open(sql_dump_location, "rt")
+                else:
+                    sql = open(sql_dump_location, "r")
+
+                with sql:
+                    connection.executescript(sql.read())
+
+        for table in mysqldump.BILLING_TABLES:
+            (rows,) = connection.execute(f'select count(*) from "{table}"').fetchone()
+            metrics.count("rows_loaded", rows, table=table)
+
+        with metrics.stage("create_indexes"):
+            cls._create_indexes(connection)
+
+    @classmethod
+    def _create_indexes(cls, connection):
+        logger.info("Creating indexes and gathering statistics.")
+        for index in cls.INDEXES:
+            connection.execute(index)
+        connection.execute("analyze")
+        connection.commit()
+
+    def log_query_plans(self):
+        """Logs the query plans of the queries used during billing.
+
+        Warns about any step that reads a whole billing table. An index only
+        orders such a SCAN, while a SEARCH reads the rows its index matches.
+        """
+        queries = {
+            "projects": (
+                self.PROJECTS_QUERY,
+                {"start": self._format_time(self.start)},
+            ),
+            "events": self._get_events_query(),
+            "project events": self._get_project_events_query(),
+            "fingerprints": (
+                self.FINGERPRINTS_QUERY,
+                {"start": self._format_time(self.start)},
+            ),
+        }
+        for name, (query, parameters) in queries.items():
+            cursor = self.db_nova.execute(f"explain query plan {query}", parameters)
+            for step in cursor.fetchall():
+                detail = step["detail"]
+                scanned = re.match(r"SCAN (\w+)", detail)
+                if scanned and scanned.group(1) in mysqldump.BILLING_TABLES:
+                    logger.warning(f"Query plan for {name}: {detail}")
+                else:
+                    logger.info(f"Query plan for {name}: {detail}")
 
-            i = Instance(
-                uuid=instance["uuid"],
-                name=instance["hostname"],
-                flavor=flavor,
-                events=self.get_events(instance["uuid"]),
-                deleted_at=instance["deleted_at"],
+    @staticmethod
+    def get_cache_key(sql_dump_location, dump_format="sqlite", converted=False) -> str:
+        """Returns a content hash of the dump, used to name its cache file."""
+        loading = f"{dump_format}-converted" if converted else dump_format
+        digest = hashlib.sha256(f"v{CACHE_VERSION}-{loading}".encode())
+        with open(sql_dump_location, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @classmethod
+    def _open_cached_database(
+        cls, sql_dump_location, cache_dir, dump_format, convert=None
+    ):
+        """Opens a read-only SQLite file built from the dump.
+
+        The file is built on the first run for a given dump and reused by
+        every later run, skipping the conversion and the replay of the dump.
+        """
+        cache_key = cls.get_cache_key(
+            sql_dump_location, dump_format, converted=convert is not None
+        )
+        cache_location = os.path.join(cache_dir, f"nova-{cache_key}.sqlite")
+
+        if os.path.exists(cache_location):
+            logger.info(f"Using cached database {cache_location}.")
+        else:
+            logger.info(f"Building cached database {cache_location}.")
+            os.makedirs(cache_dir, exist_ok=True)
+
+            # Build under a temporary name, so that an interrupted run never
+            # leaves behind a partial cache that later runs would trust.
+            partial_location = f"{cache_location}.{os.getpid()}.partial"
+            if convert:
+                sql_dump_location = convert(sql_dump_location)
+            connection = sqlite3.connect(partial_location)
+            try:
+                cls._load_dump(connection, sql_dump_location, dump_format)
+                connection.commit()
+            except Exception:
+                connection.close()
+                os.remove(partial_location)
+                raise
+            connection.close()
+            os.replace(partial_location, cache_location)
+
+        return sqlite3.connect(f"file:{cache_location}?mode=ro", uri=True)
+
+    @property
+    def projects(self) -> list[Project]:
+        if not self._projects:
+            self._projects = self.get_projects()
+
+        return self._projects
+
+    @property
+    def events(self) -> dict[str, list[InstanceEvent]]:
+        if self._events is None:
+            self._events = self.get_all_events()
+
+        return self._events
+
+    EVENTS_QUERY = """
+        select rowid as action_id, instance_uuid, created_at, action, message
+        from instance_actions
+        order by instance_uuid, created_at, action_id
+    """
+
+    # Orders of the events queries below: by instance, or by project first,
+    # so that events can be read side by side with PROJECTS_QUERY.
+    INSTANCE_ORDER = "instance_uuid, created_at, action_id"
+    PROJECT_ORDER = f"project_id, {INSTANCE_ORDER}"
+
+    # Events of billable instances. Driving from the instances gives the
+    # project of each event, and seeks the events of each instance in the
+    # index on (instance_uuid, created_at).
+    _BILLABLE_EVENTS_QUERY = """
+        select
+            instances.project_id,
+            instance_actions.rowid as action_id,
+            instance_actions.instance_uuid,
+            instance_actions.created_at,
+            instance_actions.action,
+            instance_actions.message
+        from instances
+        join instance_actions on {join}
+        where
+            (instances.deleted_at > :start or instances.deleted = 0)
+    """
+
+    _STATE_CHANGING_ACTIONS_SQL = ", ".join(f"'{a}'" for a in STATE_CHANGING_ACTIONS)
+
+    # Events before the window are all clamped to its start, and events
+    # after it to its end, so only the last state-changing event on either
+    # side affects the runtime within the window. All events inside the
+    # window are kept. Each of those is sought per billable instance, so
+    # that the events outside the window are never read.
+    _LAST_STATE_CHANGE_JOIN = f"""
+        instance_actions.rowid = (
+            select rowid
+            from instance_actions
+            where
+                instance_uuid = instances.uuid
+                and {{condition}}
+                and (message = 'Error' or action in ({_STATE_CHANGING_ACTIONS_SQL}))
+            order by created_at desc, rowid desc
+            limit 1
+        )
+    """
+    WINDOW_EVENTS_QUERY = f"""
+        {
+        _BILLABLE_EVENTS_QUERY.format(
+            join="instances.uuid = instance_actions.instance_uuid"
+        )
+    }
+            and instance_actions.created_at >= :start
+            and instance_actions.created_at < :end
+        union all
+        {
+        _BILLABLE_EVENTS_QUERY.format(
+            join=_LAST_STATE_CHANGE_JOIN.format(condition="created_at < :start")
+        )
+    }
+        union all
+        {
+        _BILLABLE_EVENTS_QUERY.format(
+            join=_LAST_STATE_CHANGE_JOIN.format(condition="created_at >= :end")
+        )
+    }
+        order by {{order}}
+    """
+
+    EVENTS_SINCE_QUERY = f"""
+        {
+        _BILLABLE_EVENTS_QUERY.format(
+            join="instances.uuid = instance_actions.instance_uuid"
+        )
+    }
+            and instance_actions.created_at >= :since
+        order by {{order}}
+    """
+
+    def _get_events_query(self, order=INSTANCE_ORDER):
+        if self.events_since is not None:
+            return self.EVENTS_SINCE_QUERY.format(order=order), {
+                "start": self._format_time(self.start),
+                "since": self._format_time(self.events_since),
+            }
+        if self.end is None:
+            return self.EVENTS_QUERY, {}
+        return self.WINDOW_EVENTS_QUERY.format(order=order), {
+            "start": self._format_time(self.start),
+            "end": self._format_time(self.end),
+        }
+
+    def get_all_events(self) -> dict[str, list[InstanceEvent]]:
+        """Returns the events of every instance, keyed by instance uuid.
+
+        Events are loaded with a single ordered query, rather than one query
+        per instance. When the database has an `end` or `events_since`, only
+        the events of billable instances are read, sought in the index of
+        instance_actions.
+        """
+        cursor = self.db_nova.cursor()
+        cursor.execute(*self._get_events_query())
+        return {
+            instance_uuid: [self._get_event_from_row(event) for event in events]
+            for instance_uuid, events in itertools.groupby(
+                cursor, key=lambda event: event["instance_uuid"]
             )
-            instances.append(i)
-        return instances
+        }
+
+    # Events of the instances returned by PROJECTS_QUERY, in the same order
+    # of projects, for EVENTS_QUERY, which reads every event.
+    PROJECT_EVENTS_QUERY = f"""
+        select instances.project_id, events.*
+        from ({EVENTS_QUERY}) as events
+        join instances on instances.uuid = events.instance_uuid
+        where
+            (instances.deleted_at > :start or instances.deleted = 0)
+        order by
+            instances.project_id,
+            events.instance_uuid,
+            events.created_at,
+            events.action_id
+    """
+
+    def select_events_of(self, uuids: set[str]):
+        """Reads only the events of these instances from then on.
+
+        Their events are copied, in order, to a temporary table named like
+        the events table. SQLite looks unqualified names up in the temporary
+        schema first, so every events query reads that table instead.
+        """
+        self.db_nova.execute("drop table if exists temp.instance_actions")
+        self.db_nova.execute("drop table if exists temp.selected_instances")
+        self.db_nova.execute(
+            "create temp table selected_instances (uuid text primary key)"
+        )
+        self.db_nova.executemany(
+            "insert into temp.selected_instances values (?)",
+            [(uuid,) for uuid in uuids],
+        )
+        self.db_nova.execute(
+            "create temp table instance_actions as"
+            " select * from main.instance_actions where instance_uuid in"
+            " (select uuid from temp.selected_instances) order by rowid"
+        )
+        self.db_nova.execute(
+            "create index temp.instance_actions_instance_uuid_created_at_idx"
+            " on instance_actions (instance_uuid, created_at)"
+        )
+        self._events = None
+        self._projects = None
+
+    def get_fingerprints(self) -> dict[str, InstanceFingerprint]:
+        cursor = self.db_nova.cursor()
+        cursor.execute(
+            self.FINGERPRINTS_QUERY, {"start": self._format_time(self.start)}
+        )
+        return {row["uuid"]: self._get_fingerprint_from_row(row) for row in cursor}
 
     def get_projects(self) -> list[Project]:
+        """Returns every project with billable instances.
+
+        All instances are loaded with a single query ordered by project,
+        and grouped into projects as they are read.
+        """
+        events = self.events
         cursor = self.db_nova.cursor()
-        cursor.execute("select distinct project_id from instances")
+        cursor.execute(self.PROJECTS_QUERY, {"start": self._format_time(self.start)})
         return [
-            Project(uuid=project[0], instances=self.get_instances(project[0]))
-            for project in cursor.fetchall()
+            Project(
+                uuid=project_id,
+                instances=[
+                    self._get_instance_from_row(i, events.get(i["uuid"], []))
+                    for i in instances
+                ],
+            )
+            for project_id, instances in itertools.groupby(
+                cursor, key=lambda instance: instance["project_id"]
+            )
         ]
+
+    def _get_project_events_query(self):
+        if self.end is None and self.events_since is None:
+            return self.PROJECT_EVENTS_QUERY, {"start": self._format_time(self.start)}
+        return self._get_events_query(order=self.PROJECT_ORDER)
+
+    def iter_projects(self) -> Iterator[Project]:
+        """Yields every project with billable instances, one at a time.
+
+        Unlike `projects`, nothing is kept once a project has been yielded.
+        Instances and their events are read with two queries ordered by
+        project, advancing through the events as the projects are read.
+        """
+        events_cursor = self.db_nova.cursor()
+        events_cursor.execute(*self._get_project_events_query())
+        events = itertools.groupby(events_cursor, key=lambda e: e["project_id"])
+        next_events = next(events, None)
+
+        cursor = self.db_nova.cursor()
+        cursor.execute(self.PROJECTS_QUERY, {"start": self._format_time(self.start)})
+        for project_id, rows in itertools.groupby(
+            cursor, key=lambda instance: instance["project_id"]
+        ):
+            project_events = {}
+            if next_events and next_events[0] == project_id:
+                project_events = {
+                    instance_uuid: [
+                        self._get_event_from_row(e) for e in instance_events
+                    ]
+                    for instance_uuid, instance_events in itertools.groupby(
+                        next_events[1], key=lambda e: e["instance_uuid"]
+                    )
+                }
+                next_events = next(events, None)
+
+            instances = [
+                self._get_instance_from_row(row, project_events.get(row["uuid"], []))
+                for row in rows
+            ]
+            yield Project(uuid=project_id, instances=instances)
@@ -0,0 +1,150 @@
+import gzip
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Tables of the Nova database that are read during billing.
+BILLING_TABLES = ("instances", "instance_extra", "instance_actions")
+
+_CREATE_TABLE = re.compile(r"^CREATE TABLE `(?P<table>[^`]+)` \(")
+_COLUMN = re.compile(r"^\s+`(?P<column>[^`]+)` ")
+_INSERT = re.compile(
+    r"^INSERT INTO `(?P<table>[^`]+)`\s*(?:\((?P<columns>[^)]*)\)\s*)?VALUES\s*"
+)
+_VALUE = re.compile(
+    r"""
+    '(?P<string>[^'\\]*(?:(?:\\.|'')[^'\\]*)*)'
+    | (?P<null>NULL)
+    | (?P<hex>0x[0-9A-Fa-f]*)
+    | (?P<number>[-+]?[0-9][0-9.eE+-]*)
+    | (?P<open>\()
+    | (?P<close>\))
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+_ESCAPE = re.compile(r"\\(.)", re.DOTALL)
+_ESCAPES = {
+    "0": "\0",
+    "b": "\b",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "Z": "\x1a",
+}
+
+
+def _unescape(value: str) -> str:
+    if "\\" in value:
+        value = _ESCAPE.sub(lambda m: _ESCAPES.get(m.group(1), m.group(1)), value)
+    return value.replace("''", "'")
+
+
+def _parse_number(value: str):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def parse_values(values: str) -> list[tuple]:
+    """Parses the row tuples following VALUES in a mysqldump INSERT."""
+    rows = []
+    row = None
+    for token in _VALUE.finditer(values):
+        kind = token.lastgroup
+        if kind == "open":
+            row = []
+        elif kind == "close":
+            rows.append(tuple(row))
+            row = None
+        elif row is None:
+            raise Exception(f"Unexpected value outside of row: {token.group()}.")
+        elif kind == "string":
+            row.append(_unescape(token.group("string")))
+        elif kind == "null":
+            row.append(None)
+        elif kind == "hex":
+            row.append(bytes.fromhex(token.group()[2:]))
+        else:
+            row.append(_parse_number(token.group()))
+    return rows
+
+
+def _open_dump(path_to_dump):
+    if not isinstance(path_to_dump, str):
+        # Already an open text file, such as a dump streamed from S3.
+        return path_to_dump
+    if path_to_dump.endswith(".gz"):
+        return gzip.open(path_to_dump, "rt", encoding="utf-8")
+    return open(path_to_dump, "r", encoding="utf-8")
+
+
+def load_mysqldump_into_sqlite(
+    path_to_dump, connection, tables=BILLING_TABLES
+) -> dict[str, int]:
+    """Loads the given tables of a mysqldump generated SQL file into SQLite.
+
+    The dump, optionally gzipped, is streamed line by line from its path or
+    from an open text file, which is closed once read. Statements for
+    every other table are skipped without being parsed, and the rows of each
+    INSERT are added with a single executemany.
+
+    Returns the number of rows loaded per table.
+    """
+    columns = {}
+    rows_loaded = {table: 0 for table in tables}
+
+    create_table = None
+    with _open_dump(path_to_dump) as dump:
+        for line in dump:
+            if create_table is not None:
+                if match := _COLUMN.match(line):
+                    columns[create_table].append(match.group("column"))
+                elif line.startswith(")"):
+                    column_list = ", ".join(f'"{c}"' for c in columns[create_table])
+                    connection.execute(f'create table "{create_table}" ({column_list})')
+                    create_table = None
+                continue
+
+            if line.startswith("CREATE TABLE"):
+                match = _CREATE_TABLE.match(line)
+                if match and match.group("table") in tables:
+                    create_table = match.group("table")
+                    columns[create_table] = []
+                continue
+
+            if not line.startswith("INSERT INTO"):
+                continue
+
+            match = _INSERT.match(line)
+            if not match or match.group("table") not in tables:
+                continue
+
+            table = match.group("table")
+            if match.group("columns"):
+                insert_columns = [
+                    c.strip().strip("`") for c in match.group("columns").split(",")
+                ]
+            elif table in columns:
+                insert_columns = columns[table]
+            else:
+                raise Exception(f"INSERT into {table} before its CREATE TABLE.")
+
+            rows = parse_values(line[match.end() :])
+            column_list = ", ".join(f'"{c}"' for c in insert_columns)
+            placeholders = ", ".join("?" for _ in insert_columns)
+            connection.executemany(
+                f'insert into "{table}" ({column_list}) values ({placeholders})',
+                rows,
+            )
+            rows_loaded[table] += len(rows)
+
+    missing = [table for table in tables if table not in columns]
+    if missing:
+        raise Exception(f"Tables {missing} not found in {path_to_dump}.")
+
+    connection.commit()
+    for table, count in rows_loaded.items():
+        logger.info(f"Loaded {count} rows into {table}.")
+    return rows_loaded
@@ -0,0 +1,199 @@
+from dataclasses import dataclass
+from dataclasses_json import dataclass_json
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+from nerc_rates import outages, rates
+import requests
+
+from openstack_billing_db import utils
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join("~", ".cache", "openstack-billing-db")
+
+# Seconds for which a cached snapshot is used without revalidating it.
+DEFAULT_TTL = 3600
+
+SOURCES = {
+    "rates": rates.DEFAULT_RATES_URL,
+    "outages": outages.DEFAULT_OUTAGES_URL,
+}
+
+
+class SnapshotUnavailable(Exception):
+    """No snapshot of the data can be used."""
+
+
+@dataclass_json()
+@dataclass()
+class Snapshot(object):
+    """Identifies the content of a data source fetched at some point."""
+
+    name: str
+    url: str
+    sha256: str
+    fetched_at: float
+    etag: Optional[str] = None
+
+
+class SnapshotCache(object):
+    """Caches the rates and outages from nerc-rates on disk.
+
+    Contents are stored by their sha256, next to the latest snapshot of
+    each source. A snapshot younger than the TTL is used as is, an older
+    one is revalidated with its ETag. When offline, or when the source
+    cannot be reached, the latest cached snapshot is used regardless of
+    its age. Snapshots can also be pinned to a given content, as recorded
+    in the manifest of an earlier run.
+    """
+
+    def __init__(
+        self,
+        cache_dir=DEFAULT_CACHE_DIR,
+        ttl=DEFAULT_TTL,
+        offline=False,
+        pinned: Optional[dict[str, str]] = None,
+    ):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.ttl = ttl
+        self.offline = offline
+        self.pinned = pinned or {}
+
+        # Snapshots used during this run, by source name.
+        self.used: dict[str, Snapshot] = {}
+
+    def _content_path(self, sha256):
+        return os.path.join(self.cache_dir, f"{sha256}.yaml")
+
+    def _snapshot_path(self, name):
+        return os.path.join(self.cache_dir, f"{name}.json")
+
+    def _read_content(self, sha256) -> Optional[bytes]:
+        try:
+            with open(self._content_path(sha256), "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        if hashlib.sha256(content).hexdigest() != sha256:
+            logger.warning(f"Cached content {sha256} is corrupted, ignoring it.")
+            return None
+        return content
+
+    def _get_cached(self, name, url) -> tuple[Optional[Snapshot], Optional[bytes]]:
+        try:
+            with open(self._snapshot_path(name), "r") as f:
+                snapshot = Snapshot.from_json(f.read())
+        except FileNotFoundError:
+            return None, None
+        if snapshot.url != url:
+            return None, None
+
+        content = self._read_content(snapshot.sha256)
+        if content is None:
+            return None, None
+        return snapshot, content
+
+    def _store(self, snapshot: Snapshot, content: Optional[bytes] = None):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if content is not None:
+            utils.write_atomically(self._content_path(snapshot.sha256), content)
+        utils.write_atomically(self._snapshot_path(snapshot.name), snapshot.to_json())
+
+    def _fetch(self, name, url, cached: Optional[Snapshot]):
+        headers = {}
+        if cached and cached.etag:
+            headers["If-None-Match"] = cached.etag
+
+        r = requests.get(url, headers=headers, allow_redirects=True, timeout=30)
+        if r.status_code == 304:
+            logger.info(f"Cached {name} snapshot {cached.sha256} is still current.")
+            cached.fetched_at = time.time()
+            self._store(cached)
+            return cached, None
+        r.raise_for_status()
+
+        content = r.content
+        snapshot = Snapshot(
+            name=name,
+            url=url,
+            sha256=hashlib.sha256(content).hexdigest(),
+            fetched_at=time.time(),
+            etag=r.headers.get("ETag"),
+        )
+        self._store(snapshot, content)
+        logger.info(f"Fetched {name} snapshot {snapshot.sha256} from {url}.")
+        return snapshot, content
+
+    def get(self, name, url=None) -> bytes:
+        """Returns the content of a source, fetching it only when needed."""
+        url = url or SOURCES[name]
+
+        if name in self.pinned:
+            sha256 = self.pinned[name]
+            content = self._read_content(sha256)
+            if content is None:
+                raise SnapshotUnavailable(
+                    f"Pinned {name} snapshot {sha256} not cached."
+                )
+            self.used[name] = Snapshot(
+                name=name, url=url, sha256=sha256, fetched_at=time.time()
+            )
+            return content
+
+        snapshot, content = self._get_cached(name, url)
+        is_fresh = snapshot and time.time() - snapshot.fetched_at < self.ttl
+        if not (is_fresh or self.offline):
+            try:
+                snapshot, new_content = self._fetch(name, url, snapshot)
+                content = new_content or content
+            except requests.RequestException as e:
+                if snapshot is None:
+                    raise
+                logger.warning(
+                    f"Could not fetch {name} from {url}, using cached snapshot"
+                    f" {snapshot.sha256} fetched at {snapshot.fetched_at}: {e}"
+                )
+
+        if snapshot is None:
+            raise SnapshotUnavailable(f"No cached {name} snapshot, cannot be offline.")
+        self.used[name] = snapshot
+        return content
+
+    def load_rates(self):
+        self.get("rates")
+        return rates.load_from_file(self._content_path(self.used["rates"].sha256))
+
+    def load_outages(self):
+        self.get("outages")
+        return outages.load_from_file(self._content_path(self.used["outages"].sha256))
+
+    def write_manifest(self, path):
+        """Writes the snapshots used during this run to a JSON file."""
+        manifest = {name: s.to_dict() for name, s in sorted(self.used.items())}
+        utils.write_atomically(path, json.dumps(manifest, indent=2) + "\n")
+        logger.info(f"Recorded snapshots {list(manifest)} in {path}.")
+
+    @staticmethod
+    def read_manifest(path) -> dict[str, str]:
+        """Returns the content hashes of the snapshots recorded in a manifest."""
+        with open(path, "r") as f:
+            return {name: s["sha256"] for name, s in json.load(f).items()}
+
+
+def load_rates(cache: Optional[SnapshotCache] = None):
+    """Loads the rates through the cache if given, else from nerc-rates."""
+    if cache is None:
+        return rates.load_from_url()
+    return cache.load_rates()
+
+
+def load_outages(cache: Optional[SnapshotCache] = None):
+    """Loads the outages through the cache if given, else from nerc-rates."""
+    if cache is None:
+        return outages.load_from_url()
+    return cache.load_outages()
@@ -0,0 +1,251 @@
+from datetime import datetime, timedelta
+import gzip
+import json
+import logging
+import random
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# The tables and columns of the Nova database that are read during billing.
+NOVA_SCHEMA = """
+CREATE TABLE instances (
+    id INTEGER PRIMARY KEY,
+    uuid VARCHAR(36),
+    hostname VARCHAR(255),
+    project_id VARCHAR(255),
+    instance_type_id INTEGER,
+    memory_mb INTEGER,
+    vcpus INTEGER,
+    deleted INTEGER,
+    deleted_at DATETIME
+);
+CREATE TABLE instance_extra (
+    id INTEGER PRIMARY KEY,
+    instance_uuid VARCHAR(36),
+    pci_requests TEXT
+);
+CREATE TABLE instance_actions (
+    id INTEGER PRIMARY KEY,
+    instance_uuid VARCHAR(36),
+    action VARCHAR(255),
+    message VARCHAR(255),
+    created_at DATETIME
+);
+"""
+
+# Flavors as (instance_type_id, vcpus, memory_mb), by how common they are.
+FLAVORS = (
+    ((1, 1, 4096), 0.35),
+    ((2, 2, 8192), 0.25),
+    ((3, 4, 16384), 0.2),
+    ((4, 8, 32768), 0.12),
+    ((5, 16, 65536), 0.08),
+)
+
+# Fraction of instances with each type of GPU, by PCI alias name.
+DEFAULT_GPU_MIX = {"A100": 0.02, "A100-SXM4": 0.01, "V100": 0.02, "K80": 0.01}
+
+# Actions after the creation of an instance, by how common they are. Most
+# don't change the state of the instance.
+ACTIONS = (
+    ("stop", 0.2),
+    ("start", 0.2),
+    ("reboot", 0.15),
+    ("shelve", 0.05),
+    ("unshelve", 0.05),
+    ("resize", 0.05),
+    ("confirmResize", 0.05),
+    ("migrate", 0.05),
+    ("live-migration", 0.05),
+    ("attach_interface", 0.1),
+    ("lock", 0.05),
+)
+
+# Fraction of the instances existing during an outage that are stopped
+# when it starts and started when it ends.
+OUTAGE_STOPPED_FRACTION = 0.5
+
+# Rows per INSERT statement.
+BATCH_SIZE = 500
+
+
+def sql_value(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def _format_time(time: datetime) -> str:
+    # Nova stores times with a precision of seconds.
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def get_pci_requests(alias_name, count) -> str:
+    return json.dumps(
+        [
+            {
+                "count": count,
+                "spec": [{"alias_name": alias_name}],
+                "alias_name": alias_name,
+                "is_new": False,
+                "numa_policy": "legacy",
+                "request_id": None,
+                "requester_id": None,
+            }
+        ]
+    )
+
+
+class _TableWriter(object):
+    """Writes the rows of a table as batched INSERT statements."""
+
+    def __init__(self, f, table, columns):
+        self.f = f
+        self.statement = f"INSERT INTO {table} ({', '.join(columns)}) VALUES\n"
+        self.rows = []
+        self.count = 0
+
+    def add(self, row):
+        self.rows.append("(" + ",".join(sql_value(v) for v in row) + ")")
+        self.count += 1
+        if len(self.rows) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.f.write(self.statement + ",\n".join(self.rows) + ";\n")
+            self.rows = []
+
+
+def generate_nova_dump(
+    path,
+    projects=100,
+    instances=1000,
+    actions_per_instance=10,
+    gpu_mix=None,
+    start=datetime(year=2024, month=1, day=1),
+    end=datetime(year=2024, month=2, day=1),
+    outages=(),
+    seed=0,
+) -> dict[str, int]:
+    """Writes a SQLite compatible dump of a synthetic Nova database.
+
+    Instances are spread over projects with a long tail, as a few large
+    projects hold most instances in practice. Each instance is created up
+    to a year before `start`, gets a random number of actions averaging
+    `actions_per_instance` up to `end`, and some instances are deleted.
+    `gpu_mix` maps PCI alias names to the fraction of instances with GPUs
+    of that type. During each of the `outages`, given as (start, end)
+    windows, some instances are stopped and then started again. Gzips the
+    dump if `path` ends with .gz.
+
+    Returns the number of rows written per table.
+    """
+    rng = random.Random(seed)
+    gpu_mix = DEFAULT_GPU_MIX if gpu_mix is None else gpu_mix
+    flavors, flavor_weights = zip(*FLAVORS)
+    actions, action_weights = zip(*ACTIONS)
+    project_ids = [uuid.UUID(int=rng.getrandbits(128)).hex for _ in range(projects)]
+    project_weights = [1 / (n + 1) for n in range(projects)]
+    period = (end - start).total_seconds()
+
+    if path.endswith(".gz"):
+        f = gzip.open(path, "wt")
+    else:
+        f = open(path, "w")
+
+    with f:
+        f.write("BEGIN TRANSACTION;\n")
+        f.write(NOVA_SCHEMA)
+        tables = {
+            "instances": _TableWriter(
+                f,
+                "instances",
+                [
+                    "uuid",
+                    "hostname",
+                    "project_id",
+                    "instance_type_id",
+                    "memory_mb",
+                    "vcpus",
+                    "deleted",
+                    "deleted_at",
+                ],
+            ),
+            "instance_extra": _TableWriter(
+                f, "instance_extra", ["instance_uuid", "pci_requests"]
+            ),
+            "instance_actions": _TableWriter(
+                f,
+                "instance_actions",
+                ["instance_uuid", "action", "message", "created_at"],
+            ),
+        }
+
+        for n in range(instances):
+            instance_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+            project_id = rng.choices(project_ids, project_weights)[0]
+            flavor_id, vcpus, memory_mb = rng.choices(flavors, flavor_weights)[0]
+
+            pci_requests = "[]"
+            gpu = rng.random()
+            for alias_name, fraction in gpu_mix.items():
+                if gpu < fraction:
+                    pci_requests = get_pci_requests(alias_name, rng.choice([1, 2, 4]))
+                    break
+                gpu -= fraction
+
+            created_at = start - timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+            lifetime = (end - created_at).total_seconds()
+            action_count = rng.randint(0, 2 * max(actions_per_instance - 1, 0))
+            times = sorted(
+                created_at + timedelta(seconds=rng.randint(0, int(lifetime)))
+                for _ in range(action_count)
+            )
+            events = [("create", created_at)] + [
+                (rng.choices(actions, action_weights)[0], time) for time in times
+            ]
+            for outage_start, outage_end in outages:
+                if created_at < outage_start and rng.random() < OUTAGE_STOPPED_FRACTION:
+                    events += [("stop", outage_start), ("start", outage_end)]
+            events.sort(key=lambda event: event[1])
+
+            deleted_at = None
+            if rng.random() < 0.3:
+                deleted_at = events[-1][1] + timedelta(
+                    seconds=rng.randint(0, int(period))
+                )
+                if deleted_at < end:
+                    events.append(("delete", deleted_at))
+                else:
+                    deleted_at = None
+
+            tables["instances"].add(
+                (
+                    instance_uuid,
+                    f"vm-{n}",
+                    project_id,
+                    flavor_id,
+                    memory_mb,
+                    vcpus,
+                    int(deleted_at is not None),
+                    _format_time(deleted_at) if deleted_at else None,
+                )
+            )
+            tables["instance_extra"].add((instance_uuid, pci_requests))
+            for action, time in events:
+                message = "Error" if rng.random() < 0.01 else None
+                tables["instance_actions"].add(
+                    (instance_uuid, action, message, _format_time(time))
+                )
+
+        for table in tables.values():
+            table.flush()
+        f.write("COMMIT;\n")
+
+    rows = {name: table.count for name, table in tables.items()}
+    logger.info(f"Generated {path} with {rows}.")
+    return rows
@@ -0,0 +1,95 @@
+import csv
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from openstack_billing_db import backfill, billing, model
+from openstack_billing_db.tests.unit.utils import get_rates, write_nova_dump
+
+INSTANCES = [
+    ("uuid-1", "vm-1", "project-1", 1, 4096, 1, 0, None),
+    ("uuid-2", "vm-2", "project-1", 1, 8192, 2, 1, "2000-02-10 00:00:00"),
+    ("uuid-3", "vm-3", "project-2", 1, 4096, 4, 0, None),
+]
+
+EVENTS = [
+    ("uuid-1", "create", None, "1999-11-15 00:00:00"),
+    ("uuid-1", "stop", None, "2000-01-20 12:00:00"),
+    ("uuid-1", "start", None, "2000-03-02 00:00:00"),
+    ("uuid-2", "create", None, "1999-12-20 06:00:00"),
+    ("uuid-2", "delete", None, "2000-02-10 00:00:00"),
+    ("uuid-3", "create", None, "2000-02-05 00:00:00"),
+]
+
+OUTAGES = [(datetime(2000, 1, 31, 12), datetime(2000, 2, 2))]
+
+
+def get_monthly_rates(invoice_month):
+    return get_rates(Decimal("0.01") if invoice_month < "2000-02" else Decimal("0.02"))
+
+
+def read_invoice(path):
+    with open(path, newline="") as f:
+        # Without the generation time.
+        return [row[:-1] for row in csv.reader(f, quotechar="|")]
+
+
+def test_parse_months():
+    assert backfill.parse_months("1999-11..2000-02") == [
+        "1999-11",
+        "1999-12",
+        "2000-01",
+        "2000-02",
+    ]
+    assert backfill.parse_months("2000-03, 2000-01") == ["2000-03", "2000-01"]
+    assert backfill.get_month_period("1999-12") == (
+        datetime(1999, 12, 1),
+        datetime(2000, 1, 1),
+    )
+    with pytest.raises(Exception):
+        backfill.parse_months("2000-03..2000-01")
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_backfill_matches_monthly_runs(tmp_path, monkeypatch, workers):
+    dump_file = write_nova_dump(str(tmp_path / "nova.sql"), INSTANCES, EVENTS)
+    months = backfill.parse_months("1999-12..2000-03")
+    monkeypatch.setattr(
+        billing,
+        "get_excluded_intervals",
+        lambda start, end, outages_data=None: [
+            (max(s, start), min(e, end)) for s, e in OUTAGES if s < end and start < e
+        ],
+    )
+
+    loaded = []
+
+    def load_database(start, end):
+        loaded.append((start, end))
+        return model.Database(start, dump_file, end=end)
+
+    outputs = backfill.backfill(
+        months,
+        load_database,
+        get_monthly_rates,
+        output_file=str(tmp_path / "backfill-{invoice_month}.csv"),
+        runtime_engine="sweep",
+        workers=workers,
+    )
+    assert loaded == [(datetime(1999, 12, 1), datetime(2000, 4, 1))]
+
+    for invoice_month, output in zip(months, outputs):
+        start, end = backfill.get_month_period(invoice_month)
+        monthly_output = str(tmp_path / f"monthly-{invoice_month}.csv")
+        billing.generate_billing(
+            start,
+            end,
+            monthly_output,
+            get_monthly_rates(invoice_month),
+            invoice_month=invoice_month,
+            sql_dump_file=dump_file,
+            runtime_engine="sweep",
+        )
+        assert read_invoice(output) == read_invoice(monthly_output)
+        assert len(read_invoice(output)) > 1
@@ -1,10 +1,34 @@
+import random
 import uuid
 from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from types import SimpleNamespace
+import boto3
+import moto
 import pytest
 
-from openstack_billing_db import billing
-from openstack_billing_db.model import Instance, InstanceEvent
-from openstack_billing_db.tests.unit.utils import FLAVORS, HOUR, DAY
+from openstack_billing_db import billing, metrics
+from openstack_billing_db.model import (
+    Database,
+    Flavor,
+    Instance,
+    InstanceEvent,
+    Project,
+)
+from openstack_billing_db.tests.unit.utils import (
+    FLAVORS,
+    HOUR,
+    DAY,
+    START,
+    END,
+    EVENTS,
+    INSTANCES,
+    get_rates,
+    get_ticking_clock,
+    random_instance,
+    random_outages,
+    write_nova_dump,
+)
 
 
 def test_instance_simple_runtime():
@@ -48,10 +72,388 @@ def test_billing_add_su_hours():
         rates=None,
     )
     invoice = billing.set_invoice_su_hours(invoice, "cpu", 24)
-    assert invoice.cpu_su_hours == 24
+    assert invoice.su_hours["cpu"] == 24
 
     invoice = billing.set_invoice_su_hours(invoice, "gpu_a100", 48)
-    assert invoice.gpu_a100_su_hours == 48
+    assert invoice.su_hours["gpu_a100"] == 48
 
     with pytest.raises(Exception):
         invoice = billing.set_invoice_su_hours(invoice, "gpu_fake", 72)
+
+
+def test_new_su_type_is_loaded_and_invoiced(monkeypatch):
+    monkeypatch.setitem(
+        billing.INVOICE_SU_TYPES, "gpu_fake", ("OpenStack GPUFAKE", "GPUFAKE SU Rate")
+    )
+    nerc_repo_rates = SimpleNamespace(
+        get_value_at=lambda name, month, type_: type_(name == "GPUFAKE SU Rate")
+    )
+    rates = billing.Rates.from_nerc_rates(nerc_repo_rates, "2000-01")
+    assert rates.get_rate("gpu_fake") == 1
+    assert rates.include_stopped_runtime is False
+
+    invoice = billing.ProjectInvoice(
+        project_name="foo",
+        project_id="foo",
+        pi="foo",
+        institution="foo",
+        invoice_start="foo",
+        invoice_end="bar",
+        instances=[],
+        rates=rates,
+    )
+    invoice = billing.set_invoice_su_hours(invoice, "cpu", 24)
+    invoice = billing.set_invoice_su_hours(invoice, "gpu_fake", 72)
+    assert list(billing.get_invoice_lines(invoice)) == [
+        (24, "OpenStack CPU", 0, Decimal(0)),
+        (72, "OpenStack GPUFAKE", 1, Decimal(72)),
+    ]
+
+
+def test_cost_in_cents_matches_decimal_rounding():
+    rng = random.Random(0)
+    rates = [Decimal("0.013"), Decimal("1.803"), Decimal("0.005"), Decimal(2)]
+    rates += [
+        Decimal(rng.randint(0, 10**7)).scaleb(-rng.randint(0, 9)) for _ in range(200)
+    ]
+    for rate in rates:
+        for su_hours in [0, 1, 5, 744, rng.randint(0, 10**6)]:
+            expected = (rate * su_hours).quantize(
+                Decimal(".01"), rounding=ROUND_HALF_UP
+            )
+            cost = Decimal(billing.get_cost_in_cents(su_hours, rate)).scaleb(-2)
+            assert str(cost) == str(expected)
+
+
+def test_usage_timeseries(tmp_path):
+    time = datetime(year=2000, month=1, day=1, hour=0, minute=0, second=0)
+    instances = [
+        Instance(
+            uuid=f"instance-{n}",
+            name=f"instance-{n}",
+            flavor=Flavor(
+                id=1, service_unit_type="cpu", vcpus=1, memory=4096, storage=20
+            ),
+            events=[
+                InstanceEvent(time=time + timedelta(hours=n), name="create", message="")
+            ],
+            deleted_at=time + timedelta(days=1, hours=1),
+        )
+        for n in range(2)
+    ]
+    database = SimpleNamespace(projects=[Project(uuid="foo", instances=instances)])
+    rates = get_rates()
+
+    usage = billing.collect_usage_timeseries(
+        database,
+        time,
+        time + timedelta(days=3),
+        rates,
+        bucket="daily",
+        excluded_intervals=[],
+    )
+    assert [(u.instance_uuid, u.bucket_start, u.su_hours) for u in usage] == [
+        ("instance-0", "2000-01-01T00:00:00+00:00", 24),
+        ("instance-0", "2000-01-02T00:00:00+00:00", 1),
+        ("instance-1", "2000-01-01T00:00:00+00:00", 23),
+        ("instance-1", "2000-01-02T00:00:00+00:00", 1),
+    ]
+
+    billing.write_usage_timeseries(
+        usage, rates, tmp_path / "instances.csv", tmp_path / "projects.csv"
+    )
+    with open(tmp_path / "projects.csv") as f:
+        assert f.read().splitlines() == [
+            "Interval Start,Project - Allocation ID,Cluster Name,SU Type,"
+            "SU Hours (GBhr or SUhr)",
+            "2000-01-01T00:00:00+00:00,foo,stack,OpenStack CPU,47",
+            "2000-01-02T00:00:00+00:00,foo,stack,OpenStack CPU,2",
+        ]
+    with open(tmp_path / "instances.csv") as f:
+        assert len(f.read().splitlines()) == 5
+
+
+@pytest.mark.parametrize("runtime_engine", billing.RUNTIME_ENGINES)
+def test_instance_details(tmp_path, runtime_engine):
+    time = datetime(year=2000, month=1, day=1)
+    instances = [
+        Instance(
+            uuid=f"instance-{n}",
+            name=f"vm-{n}",
+            flavor=Flavor(
+                id=1, service_unit_type="cpu", vcpus=1 + n, memory=4096, storage=20
+            ),
+            events=[
+                InstanceEvent(
+                    time=time + timedelta(hours=n), name="create", message=""
+                ),
+                InstanceEvent(time=time + timedelta(days=2), name="stop", message=""),
+            ],
+        )
+        for n in range(3)
+    ]
+    # The last instance is only running during the outage.
+    instances[2].events = [
+        InstanceEvent(
+            time=time + timedelta(days=1, hours=2), name="create", message=""
+        ),
+        InstanceEvent(time=time + timedelta(days=1, hours=3), name="stop", message=""),
+    ]
+    database = SimpleNamespace(projects=[Project(uuid="foo", instances=instances)])
+    rates = get_rates()
+    outages = [(time + timedelta(days=1), time + timedelta(days=1, hours=6))]
+
+    details = []
+    invoices = billing.collect_invoice_data_from_openstack(
+        database,
+        time,
+        time + timedelta(days=3),
+        rates,
+        runtime_engine=runtime_engine,
+        excluded_intervals=outages,
+        details=details,
+    )
+    assert [(d.instance_name, d.seconds_excluded, d.su_hours) for d in details] == [
+        ("vm-0", 6 * HOUR, 42),
+        ("vm-1", 6 * HOUR, 41 * 2),
+        ("vm-2", HOUR, 0),
+    ]
+    assert sum(d.su_hours for d in details) == invoices[0].su_hours["cpu"]
+
+    billing.write_instance_details(details, rates, tmp_path / "details.csv")
+    with open(tmp_path / "details.csv") as f:
+        rows = [line.split(",") for line in f.read().splitlines()[1:]]
+    assert [row[:9] for row in rows] == [
+        ["instance-0", "vm-0", "foo", "stack", "1", "1", "4096", "0", "OpenStack CPU"],
+        ["instance-1", "vm-1", "foo", "stack", "1", "2", "4096", "0", "OpenStack CPU"],
+        ["instance-2", "vm-2", "foo", "stack", "1", "3", "4096", "0", "OpenStack CPU"],
+    ]
+    assert [[float(value) for value in row[9:]] for row in rows] == [
+        [42 * HOUR, DAY, 6 * HOUR, 42],
+        [41 * HOUR, DAY, 6 * HOUR, 82],
+        [0, 42 * HOUR, HOUR, 0],
+    ]
+
+
+@pytest.mark.parametrize("runtime_engine", billing.RUNTIME_ENGINES)
+def test_parallel_invoices_match_serial(tmp_path, runtime_engine):
+    rng = random.Random(0)
+    database = SimpleNamespace(
+        projects=[
+            Project(
+                uuid=f"project-{n}",
+                instances=[random_instance(rng) for _ in range(rng.randint(1, 20))],
+            )
+            for n in range(30)
+        ]
+    )
+    for project in database.projects:
+        for i in project.instances:
+            i.flavor = Flavor(
+                id=1, service_unit_type="cpu", vcpus=1, memory=4096, storage=20
+            )
+    outages = random_outages(rng)
+    rates = get_rates(Decimal("0.013"), include_stopped_runtime=True)
+
+    outputs = []
+    for workers in (1, 3):
+        invoices = billing.collect_invoice_data_from_openstack(
+            database,
+            datetime(year=2000, month=1, day=1),
+            datetime(year=2000, month=2, day=1),
+            rates,
+            runtime_engine=runtime_engine,
+            excluded_intervals=outages,
+            workers=workers,
+        )
+        output = tmp_path / f"invoices-{workers}.csv"
+        billing.write(invoices, output, "2000-01", generated_at="2000-02-01")
+        with open(output, "rb") as f:
+            outputs.append(f.read())
+
+    assert outputs[0] == outputs[1]
+    assert len(outputs[0].splitlines()) > 1
+
+
+def test_shard_projects():
+    projects = [
+        Project(
+            uuid=f"project-{n}",
+            instances=[
+                Instance(
+                    uuid=f"instance-{n}",
+                    name=f"instance-{n}",
+                    flavor=FLAVORS[1],
+                    events=[],
+                )
+            ]
+            * n,
+        )
+        for n in range(10)
+    ]
+    shards = billing.shard_projects(projects, 3)
+
+    assert 1 < len(shards) <= 3
+    assert [i[0] for _, instances in shards for i in instances] == [
+        i.uuid for project in projects for i in project.instances
+    ]
+    # Instances refer to the flavors of their shard by position.
+    assert all(flavors == [FLAVORS[1]] for flavors, _ in shards)
+    assert all(i[1] == 0 for _, instances in shards for i in instances)
+
+
+def test_shard_events_rebuild_runtimes():
+    rng = random.Random(0)
+    instances = [random_instance(rng) for _ in range(50)]
+    outages = random_outages(rng)
+    ((flavors, shard),) = billing.shard_projects(
+        [Project(uuid="project-1", instances=instances)], 1
+    )
+
+    for runtime_engine in billing.RUNTIME_ENGINES:
+        runtimes = billing.get_runtimes(instances, START, END, outages, runtime_engine)
+        assert billing._get_runtimes_of_shard(
+            (flavors, shard), START, END, outages, runtime_engine
+        ) == [(r.total_seconds_running, r.total_seconds_stopped) for r in runtimes]
+
+
+@pytest.mark.parametrize(
+    "options", [{"usage_timeseries": "daily"}, {"instance_details": True}]
+)
+def test_stream_rejects_whole_database_outputs(tmp_path, options):
+    with pytest.raises(Exception, match="Streaming cannot be combined"):
+        billing.generate_billing(
+            datetime(year=2000, month=1, day=1),
+            datetime(year=2000, month=2, day=1),
+            str(tmp_path / "invoice.csv"),
+            None,
+            stream=True,
+            **options,
+        )
+
+
+def test_streamed_invoices_match_collected(tmp_path):
+    start = datetime(year=2000, month=1, day=1)
+    end = datetime(year=2000, month=2, day=1)
+    instances = [
+        (f"uuid-{n}", f"vm-{n}", f"project-{n % 3}", 1, 4096, 1 + n, 0, None)
+        for n in range(6)
+    ]
+    events = [
+        (f"uuid-{n}", "create", None, str(start + timedelta(days=n))) for n in range(6)
+    ] + [("uuid-1", "stop", None, str(start + timedelta(days=10)))]
+    database = Database(
+        start, write_nova_dump(str(tmp_path / "nova.sql"), instances, events)
+    )
+    rates = get_rates(Decimal("0.013"))
+
+    streamed = billing.iter_invoice_data_from_openstack(
+        database, start, end, rates, excluded_intervals=[]
+    )
+    collected = billing.collect_invoice_data_from_openstack(
+        database, start, end, rates, excluded_intervals=[]
+    )
+    assert list(streamed) == collected
+    assert [i.su_hours["cpu"] for i in collected] == [
+        (31 - 0) * 24 * 1 + (31 - 3) * 24 * 4,
+        (10 - 1) * 24 * 2 + (31 - 4) * 24 * 5,
+        (31 - 2) * 24 * 3 + (31 - 5) * 24 * 6,
+    ]
+
+
+def test_invoice_counters(tmp_path):
+    database = Database(
+        START, write_nova_dump(str(tmp_path / "nova.sql"), INSTANCES, EVENTS)
+    )
+    metrics.reset()
+    billing.collect_invoice_data_from_openstack(
+        database, START, END, get_rates(), excluded_intervals=[]
+    )
+    counters = {c["name"]: c["value"] for c in metrics.get_summary()["counters"]}
+    assert counters == {
+        "projects_invoiced": 1,
+        "instances_billed": 2,
+        "events_processed": 4,
+    }
+
+
+def test_upload_with_copies(tmp_path, monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    output = tmp_path / "invoice.csv"
+    output.write_text("invoice\n")
+
+    with moto.mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="invoices")
+        s3.put_object(Bucket="invoices", Key="daily", Body=b"older invoice\n")
+
+        copied = billing.upload_with_copies(
+            s3, str(output), "invoices", "archive-1", ["primary", "daily"]
+        )
+        assert copied == ["primary", "daily"]
+        for key in ["archive-1", "primary", "daily"]:
+            body = s3.get_object(Bucket="invoices", Key=key)["Body"].read()
+            assert body == b"invoice\n"
+
+        # Unchanged content is only uploaded to the new archive key.
+        copied = billing.upload_with_copies(
+            s3, str(output), "invoices", "archive-2", ["primary", "daily"]
+        )
+        assert copied == []
+
+        output.write_text("updated invoice\n")
+        copied = billing.upload_with_copies(
+            s3, str(output), "invoices", "archive-3", ["primary", "daily"]
+        )
+        assert copied == ["primary", "daily"]
+        body = s3.get_object(Bucket="invoices", Key="primary")["Body"].read()
+        assert body == b"updated invoice\n"
+
+
+def test_generate_billing_skips_unchanged_upload(tmp_path, monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("S3_OUTPUT_ENDPOINT_URL", "https://s3.amazonaws.com")
+    monkeypatch.setenv("S3_OUTPUT_ACCESS_KEY_ID", "key")
+    monkeypatch.setenv("S3_OUTPUT_SECRET_ACCESS_KEY", "secret")
+    monkeypatch.setattr(billing, "get_excluded_intervals", lambda *args: [])
+
+    # Every run happens later than the previous one.
+    monkeypatch.setattr(billing, "datetime", get_ticking_clock(datetime(2000, 2, 1)))
+
+    start = datetime(year=2000, month=1, day=1)
+    dump_file = write_nova_dump(
+        str(tmp_path / "nova.sql"),
+        [("uuid-1", "vm-1", "project-1", 1, 4096, 1, 0, None)],
+        [("uuid-1", "create", None, "2000-01-02 00:00:00")],
+    )
+    primary_key = "Invoices/2000-01/Service Invoices/NERC OpenStack 2000-01.csv"
+
+    with moto.mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="nerc-invoicing")
+
+        bodies, hashes = [], []
+        for _ in range(2):
+            output = tmp_path / "invoice.csv"
+            billing.generate_billing(
+                start,
+                datetime(year=2000, month=2, day=1),
+                str(output),
+                get_rates(),
+                invoice_month="2000-01",
+                upload_to_s3=True,
+                sql_dump_file=dump_file,
+            )
+            bodies.append(output.read_bytes())
+            hashes.append(billing.get_invoice_sha256(output))
+            primary = s3.get_object(Bucket="nerc-invoicing", Key=primary_key)
+            assert primary["Body"].read() == bodies[0]
+
+        archives = s3.list_objects_v2(
+            Bucket="nerc-invoicing", Prefix="Invoices/2000-01/Archive/"
+        )["Contents"]
+        assert len(archives) == 2
+
+    # Only when the invoices were generated differs.
+    assert bodies[0] != bodies[1]
+    assert hashes[0] == hashes[1]
@@ -0,0 +1,248 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from openstack_billing_db import billing, checkpoint, metrics, model, utils
+from openstack_billing_db.model import Instance
+from openstack_billing_db.tests.unit.utils import (
+    START,
+    END,
+    random_instance,
+    random_outages,
+    write_nova_dump,
+)
+
+
+def events_since(instance, since) -> Instance:
+    """Returns the instance with only the events a resumed run would load."""
+    return Instance(
+        uuid=instance.uuid,
+        name=instance.name,
+        flavor=instance.flavor,
+        events=[e for e in instance.events if e.time >= since],
+        deleted_at=instance.deleted_at,
+    )
+
+
+def dumped_at(instance, time) -> Instance:
+    """Returns the instance as a dump taken at `time` would hold it."""
+    return Instance(
+        uuid=instance.uuid,
+        name=instance.name,
+        flavor=instance.flavor,
+        events=[e for e in instance.events if e.time < time],
+        deleted_at=(
+            instance.deleted_at
+            if instance.deleted_at and instance.deleted_at < time
+            else None
+        ),
+    )
+
+
+def get_fingerprints(instances) -> dict[str, model.InstanceFingerprint]:
+    """Returns fingerprints like the ones a database reads with SQL."""
+    fingerprints = {}
+    for i in instances:
+        times = [e.timestamp for e in i.events]
+        if i.deleted_at:
+            times.append(utils.to_timestamp(i.deleted_at))
+        errors = sum(e.message == "Error" for e in i.events)
+        fingerprints[i.uuid] = model.InstanceFingerprint(
+            digest=repr((len(i.events), errors, i.deleted_at)),
+            changed_at=max(times, default=None),
+        )
+    return fingerprints
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_resumed_runtimes_match_full_sweep(seed):
+    rng = random.Random(seed)
+    outages = random_outages(rng)
+    instances = [random_instance(rng) for _ in range(25)]
+    # Instances with events after their deletion cannot be resumed.
+    instances = [
+        i for i in instances if not i.deleted_at or i.deleted_at >= i.events[-1].time
+    ]
+
+    # Bill the month one day at a time, resuming from the previous day.
+    previous = None
+    for day in range(1, 32):
+        end = START + timedelta(days=day)
+        resumed = instances
+        if previous:
+            since = START + timedelta(days=day - 1)
+            resumed = [events_since(i, since) for i in instances]
+
+        runtimes, previous = checkpoint.get_runtimes(
+            resumed, START, end, outages, previous
+        )
+        previous = checkpoint.Checkpoint.from_json(previous.to_json())
+        assert runtimes == billing.get_runtimes(instances, START, end, outages, "sweep")
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_differential_runtimes_match_full_sweep(seed):
+    rng = random.Random(seed)
+    outages = random_outages(rng)
+    instances = [random_instance(rng) for _ in range(25)]
+
+    # Bill the month from a nightly dump, reprocessing the previous day's.
+    previous = None
+    for day in range(1, 32):
+        end = START + timedelta(days=day)
+        if rng.random() < 0.3:
+            # Events are sometimes archived from the database.
+            archived = rng.choice(instances)
+            archived.events.pop(rng.randrange(len(archived.events)))
+        dump = [dumped_at(i, end) for i in instances]
+        dump = [i for i in dump if i.events]
+
+        runtimes, previous = checkpoint.get_runtimes_differential(
+            dump, get_fingerprints(dump), START, end, outages, previous
+        )
+        previous = checkpoint.Checkpoint.from_json(previous.to_json())
+        assert runtimes == billing.get_runtimes(dump, START, end, outages, "sweep")
+
+
+def test_resuming_after_deletion_mismatch():
+    instance = random_instance(random.Random(0))
+    instance.deleted_at = START + timedelta(days=1)
+    instance.events.append(
+        model.InstanceEvent(time=START + timedelta(days=3), name="stop", message="")
+    )
+    _, previous = checkpoint.get_runtimes(
+        [instance], START, START + timedelta(days=2), []
+    )
+
+    resumed = events_since(instance, START + timedelta(days=2))
+    with pytest.raises(checkpoint.CheckpointMismatch):
+        checkpoint.get_runtimes([resumed], START, END, [], previous)
+
+
+def test_checkpoint_mismatch():
+    outages = [(START + timedelta(days=1), START + timedelta(days=2))]
+    _, previous = checkpoint.get_runtimes([], START, START + timedelta(days=5), outages)
+
+    with pytest.raises(checkpoint.CheckpointMismatch):
+        checkpoint.get_runtimes([], START - timedelta(days=1), END, outages, previous)
+    with pytest.raises(checkpoint.CheckpointMismatch):
+        checkpoint.get_runtimes([], START, START + timedelta(days=4), outages, previous)
+    with pytest.raises(checkpoint.CheckpointMismatch):
+        checkpoint.get_runtimes([], START, END, [], previous)
+
+    # Outages after the checkpoint do not matter.
+    later_outages = outages + [(START + timedelta(days=6), START + timedelta(days=7))]
+    checkpoint.get_runtimes([], START, END, later_outages, previous)
+
+    previous.version = 0
+    with pytest.raises(checkpoint.CheckpointMismatch):
+        checkpoint.get_runtimes([], START, END, outages, previous)
+
+
+INSTANCES = [
+    ("uuid-1", "vm-1", "project-1", 1, 4096, 1, 0, None),
+    ("uuid-2", "vm-2", "project-1", 1, 4096, 1, 0, None),
+    ("uuid-3", "vm-3", "project-2", 1, 4096, 1, 1, "2000-01-03 00:00:00"),
+]
+
+EVENTS = [
+    ("uuid-1", "create", None, "1999-06-01 00:00:00"),
+    ("uuid-1", "stop", None, "2000-01-03 12:00:00"),
+    ("uuid-2", "create", None, "2000-01-02 06:00:00"),
+    ("uuid-3", "create", None, "1999-12-01 00:00:00"),
+    ("uuid-3", "delete", None, "2000-01-03 00:00:00"),
+]
+
+
+def test_load_database_from_checkpoint(tmp_path):
+    checkpoint_file = str(tmp_path / "checkpoint.json")
+    loaded_since = []
+
+    def runtimes_until(end, events):
+        dump_file = write_nova_dump(str(tmp_path / f"{end}.sql"), INSTANCES, events)
+
+        def load_database(events_since):
+            loaded_since.append(events_since)
+            return model.Database(START, dump_file, events_since=events_since)
+
+        database, runtimes = billing.load_database_from_checkpoint(
+            load_database, START, end, [], checkpoint_file
+        )
+        assert runtimes == billing.get_runtimes(
+            billing.get_all_instances(model.Database(START, dump_file)),
+            START,
+            end,
+            [],
+            "sweep",
+        )
+        return runtimes
+
+    runtimes_until(datetime(2000, 1, 2), EVENTS[:1] + EVENTS[3:4])
+    runtimes = runtimes_until(datetime(2000, 1, 4), EVENTS)
+    assert [r.total_seconds_running for r in runtimes] == [
+        (2 * 24 + 12) * 3600,
+        42 * 3600,
+        2 * 24 * 3600,
+    ]
+    assert loaded_since == [None, datetime(2000, 1, 2)]
+
+    # A checkpoint that ends after the billing period is not resumed from.
+    runtimes_until(datetime(2000, 1, 3), EVENTS)
+    assert loaded_since[-1] is None
+
+
+def test_get_runtimes_differentially(tmp_path):
+    checkpoint_file = str(tmp_path / "checkpoint.json")
+    # Instances whose events were loaded by each run.
+    loaded = []
+
+    def runtimes_until(end, events):
+        metrics.reset()
+        dump_file = write_nova_dump(str(tmp_path / f"{end}.sql"), INSTANCES, events)
+        database = model.Database(START, dump_file)
+        runtimes = billing.get_runtimes_differentially(
+            database, START, end, [], checkpoint_file
+        )
+        assert runtimes == billing.get_runtimes(
+            billing.get_all_instances(model.Database(START, dump_file)),
+            START,
+            end,
+            [],
+            "sweep",
+        )
+        loaded.append([i.uuid for i in billing.get_all_instances(database) if i.events])
+        return runtimes, {
+            c["name"]: c["value"]
+            for c in metrics.get_summary()["counters"]
+            if c["name"].startswith("instances_")
+        }
+
+    _, counters = runtimes_until(datetime(2000, 1, 2), EVENTS[:1] + EVENTS[3:4])
+    assert counters == {"instances_recomputed": 3}
+
+    # The second and the last instance have new events.
+    _, counters = runtimes_until(datetime(2000, 1, 4), EVENTS[:1] + EVENTS[2:])
+    assert counters == {"instances_recomputed": 2, "instances_carried_forward": 1}
+
+    # The first instance has an event before the checkpoint that was missing,
+    # inserted after the others.
+    runtimes, counters = runtimes_until(
+        datetime(2000, 1, 5), EVENTS[:1] + EVENTS[2:] + EVENTS[1:2]
+    )
+    assert counters == {"instances_recomputed": 1, "instances_carried_forward": 2}
+    assert [r.total_seconds_running for r in runtimes] == [
+        (2 * 24 + 12) * 3600,
+        (2 * 24 + 18) * 3600,
+        2 * 24 * 3600,
+    ]
+    # Only the events of the instances measured again are read.
+    assert loaded == [["uuid-1", "uuid-3"], ["uuid-2", "uuid-3"], ["uuid-1"]]
+
+    # An event marked as an error since is told apart too.
+    errored = [(*EVENTS[1][:2], "Error", EVENTS[1][3])]
+    _, counters = runtimes_until(
+        datetime(2000, 1, 6), EVENTS[:1] + EVENTS[2:] + errored
+    )
+    assert counters == {"instances_recomputed": 1, "instances_carried_forward": 2}
+    metrics.reset()
@@ -0,0 +1,107 @@
+import csv
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pyarrow.feather
+import pyarrow.parquet
+import pytest
+
+from openstack_billing_db import billing
+from openstack_billing_db.tests.unit.utils import (
+    get_rates,
+    get_ticking_clock,
+    write_nova_dump,
+)
+
+START = datetime(year=2000, month=1, day=1)
+END = datetime(year=2000, month=2, day=1)
+
+RATES = get_rates(Decimal("0.013"))
+
+
+@pytest.fixture
+def dump_file(tmp_path):
+    instances = [
+        (f"uuid-{n}", f"vm-{n}", f"project-{n % 3}", 1, 4096, 1 + n, 0, None)
+        for n in range(6)
+    ]
+    events = [
+        (f"uuid-{n}", "create", None, str(START + timedelta(days=n))) for n in range(6)
+    ] + [("uuid-1", "stop", None, str(START + timedelta(days=10, hours=5)))]
+    return write_nova_dump(str(tmp_path / "nova.sql"), instances, events)
+
+
+@pytest.mark.parametrize("stream", [False, True])
+@pytest.mark.parametrize("columnar_format", ["parquet", "arrow"])
+def test_columnar_invoice_matches_csv(
+    tmp_path, monkeypatch, dump_file, stream, columnar_format
+):
+    monkeypatch.setattr(billing, "get_excluded_intervals", lambda *args: [])
+    monkeypatch.setattr(billing, "datetime", get_ticking_clock(END))
+    billing.generate_billing(
+        START,
+        END,
+        str(tmp_path / "invoice.csv"),
+        RATES,
+        invoice_month="2000-01",
+        sql_dump_file=dump_file,
+        stream=stream,
+        columnar_format=columnar_format,
+    )
+
+    if columnar_format == "parquet":
+        table = pyarrow.parquet.read_table(tmp_path / "invoice.parquet")
+    else:
+        table = pyarrow.feather.read_table(tmp_path / "invoice.arrow")
+    assert str(table.schema.field("cost").type) == "decimal128(38, 2)"
+    assert str(table.schema.field("su_hours").type) == "int64"
+
+    with open(tmp_path / "invoice.csv", newline="") as f:
+        rows = list(csv.DictReader(f, quotechar="|"))
+    assert table.num_rows == len(rows) == 3
+    for row, line in zip(rows, table.to_pylist()):
+        assert line["invoice_month"] == row["Invoice Month"]
+        assert line["invoice_start"].isoformat() == row["Report Start Time"]
+        assert line["project_id"] == row["Project - Allocation ID"]
+        assert line["su_hours"] == int(row["SU Hours (GBhr or SUhr)"])
+        assert line["su_type"] == row["SU Type"]
+        assert line["rate"] == Decimal(row["Rate"])
+        assert line["cost"] == Decimal(row["Cost"])
+        assert line["generated_at"].isoformat() == row["Generated At"]
+
+
+def test_columnar_usage_and_details_match_csv(tmp_path, monkeypatch, dump_file):
+    monkeypatch.setattr(billing, "get_excluded_intervals", lambda *args: [])
+    billing.generate_billing(
+        START,
+        END,
+        str(tmp_path / "invoice.csv"),
+        RATES,
+        sql_dump_file=dump_file,
+        usage_timeseries="daily",
+        columnar_format="parquet",
+        instance_details=True,
+    )
+
+    details = pyarrow.parquet.read_table(tmp_path / "invoice_instance_details.parquet")
+    with open(tmp_path / "invoice_instance_details.csv", newline="") as f:
+        rows = list(csv.DictReader(f, quotechar="|"))
+    assert [d["instance_id"] for d in details.to_pylist()] == [
+        row["Instance ID"] for row in rows
+    ]
+    assert sum(details.column("su_hours").to_pylist()) == sum(
+        int(row["SU Hours (GBhr or SUhr)"]) for row in rows
+    )
+
+    table = pyarrow.parquet.read_table(
+        tmp_path / "invoice_daily_instance_usage.parquet"
+    )
+    with open(tmp_path / "invoice_daily_instance_usage.csv", newline="") as f:
+        rows = list(csv.DictReader(f, quotechar="|"))
+    assert table.num_rows == len(rows)
+    for row, usage in zip(rows, table.to_pylist()):
+        assert usage["interval_start"].isoformat() == row["Interval Start"]
+        assert usage["instance_id"] == row["Instance ID"]
+        assert usage["su_type"] == row["SU Type"]
+        assert usage["seconds_running"] == float(row["Running Seconds"])
+        assert usage["su_hours"] == int(row["SU Hours (GBhr or SUhr)"])
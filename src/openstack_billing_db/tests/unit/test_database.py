@@ -0,0 +1,327 @@
+import logging
+import os
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+from openstack_billing_db.model import Database
+from openstack_billing_db.synthetic import get_pci_requests
+from openstack_billing_db.tests.unit.utils import (
+    START,
+    END,
+    HOUR,
+    INSTANCES,
+    EVENTS,
+    write_nova_dump,
+)
+
+
+@pytest.fixture
+def dump_file(tmp_path):
+    return write_nova_dump(str(tmp_path / "nova.sql"), INSTANCES, EVENTS)
+
+
+def _summarize(database):
+    return {
+        project.uuid: {
+            i.uuid: [(str(e.time), e.name) for e in i.events] for i in project.instances
+        }
+        for project in database.projects
+    }
+
+
+def test_database_loads_billable_instances(dump_file):
+    database = Database(START, dump_file)
+    summary = _summarize(database)
+
+    assert summary["project-1"] == {
+        "uuid-1": [("1999-06-01 00:00:00", "create"), ("2000-01-05 00:00:00", "stop")],
+        "uuid-2": [
+            ("2000-01-02 00:00:00", "create"),
+            ("2000-01-10 00:00:00", "delete"),
+        ],
+    }
+    # Projects without billable instances are left out.
+    assert list(summary) == ["project-1"]
+
+    # Streamed projects are read with other queries, to the same result.
+    assert list(database.iter_projects()) == database.projects
+
+
+def test_database_bills_instances_deleted_on_the_first_day(tmp_path):
+    # Nova stores times with a space, which sorts before the "T" of
+    # start.isoformat(), so such instances were once compared as deleted
+    # before the period.
+    dump_file = write_nova_dump(
+        str(tmp_path / "nova.sql"),
+        [("uuid-1", "vm-1", "project-1", 1, 4096, 1, 1, "2000-01-01 08:57:48")],
+        [("uuid-1", "create", None, "1999-12-01 00:00:00")],
+    )
+    database = Database(START, dump_file, end=END)
+
+    assert [p.uuid for p in database.projects] == ["project-1"]
+    assert [p.uuid for p in database.iter_projects()] == ["project-1"]
+    assert list(database.get_fingerprints()) == ["uuid-1"]
+    (instance,) = database.projects[0].instances
+    runtime = instance.get_runtime_during(START, END)
+    assert runtime.total_seconds_running == 8 * HOUR + 57 * 60 + 48
+
+
+def test_database_cache(dump_file, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    uncached = _summarize(Database(START, dump_file))
+
+    database = Database(START, dump_file, cache_dir=cache_dir)
+    cache_files = os.listdir(cache_dir)
+    assert cache_files == [f"nova-{Database.get_cache_key(dump_file)}.sqlite"]
+    assert _summarize(database) == uncached
+
+    # The second run reuses the cache, which is opened read-only.
+    database = Database(START, dump_file, cache_dir=cache_dir)
+    assert os.listdir(cache_dir) == cache_files
+    assert _summarize(database) == uncached
+    with pytest.raises(sqlite3.OperationalError):
+        database.db_nova.execute("delete from instances")
+
+
+def test_database_cache_skips_conversion(dump_file, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    converted = []
+
+    def convert(path):
+        converted.append(path)
+        return path
+
+    uncached = _summarize(Database(START, dump_file))
+    for _ in range(2):
+        database = Database(START, dump_file, cache_dir=cache_dir, convert=convert)
+        assert _summarize(database) == uncached
+
+    # The cache is keyed by the unconverted dump, so it is converted once.
+    assert converted == [dump_file]
+    assert os.listdir(cache_dir) == [
+        f"nova-{Database.get_cache_key(dump_file, converted=True)}.sqlite"
+    ]
+
+
+def test_database_shares_flavors(tmp_path):
+    instances = [
+        (f"uuid-{n}", f"vm-{n}", "project-1", 1, 4096, 1, 0, None) for n in range(4)
+    ]
+    dump_file = write_nova_dump(
+        str(tmp_path / "nova.sql"),
+        instances,
+        [],
+        pci_requests={
+            "uuid-2": get_pci_requests("V100", 2),
+            "uuid-3": get_pci_requests("V100", 2),
+        },
+    )
+    flavors = [i.flavor for i in Database(START, dump_file).projects[0].instances]
+
+    assert flavors[0] is flavors[1]
+    assert flavors[2] is flavors[3]
+    assert flavors[0].service_unit_type == "cpu"
+    assert (flavors[2].service_unit_type, flavors[2].service_units) == ("gpu_v100", 2)
+    # Another database reads its own flavors.
+    other = Database(START, dump_file).projects[0].instances[0].flavor
+    assert other == flavors[0] and other is not flavors[0]
+
+
+def test_database_warns_of_unparsed_flavor_once_per_load(tmp_path, caplog):
+    instances = [
+        (f"uuid-{n}", f"vm-{n}", "project-1", 1, 4096, 1, 0, None) for n in range(2)
+    ]
+    dump_file = write_nova_dump(
+        str(tmp_path / "nova.sql"),
+        instances,
+        [],
+        pci_requests={"uuid-0": None, "uuid-1": None},
+    )
+
+    for _ in range(2):
+        Database(START, dump_file).projects
+    warnings = [r for r in caplog.records if "Could not parse pci" in r.message]
+    assert len(warnings) == 2
+
+
+def test_database_cache_key_changes_with_contents(dump_file, tmp_path):
+    key = Database.get_cache_key(dump_file)
+    other_dump = write_nova_dump(str(tmp_path / "other.sql"), INSTANCES, EVENTS[:1])
+    assert Database.get_cache_key(other_dump) != key
+
+
+def test_database_get_all_events(tmp_path):
+    # Events are read in order whatever the order they were inserted in.
+    dump_file = write_nova_dump(str(tmp_path / "nova.sql"), INSTANCES, EVENTS[::-1])
+    events = Database(START, dump_file).get_all_events()
+
+    assert {
+        instance_uuid: [(str(e.time), e.name, e.message) for e in instance_events]
+        for instance_uuid, instance_events in events.items()
+    } == {
+        "uuid-1": [
+            ("1999-06-01 00:00:00", "create", None),
+            ("2000-01-05 00:00:00", "stop", None),
+        ],
+        "uuid-2": [
+            ("2000-01-02 00:00:00", "create", None),
+            ("2000-01-10 00:00:00", "delete", None),
+        ],
+        "uuid-3": [
+            ("1999-11-01 00:00:00", "create", None),
+            ("1999-12-01 00:00:00", "delete", None),
+        ],
+    }
+
+
+@pytest.fixture(scope="module")
+def large_dump_file(tmp_path_factory):
+    """Returns a dump large enough for SQLite to plan its queries as for Nova.
+
+    As in Nova, most instances were deleted before the billing period.
+    """
+    rng = random.Random(5)
+    instances = []
+    events = []
+    for n in range(5000):
+        instance_uuid = f"uuid-{n}"
+        created_at = START - timedelta(days=rng.randint(1, 700))
+        events.append((instance_uuid, "create", None, str(created_at)))
+        for _ in range(2):
+            time = created_at + timedelta(hours=rng.randint(0, 24 * 700))
+            events.append(
+                (instance_uuid, rng.choice(["stop", "start"]), None, str(time))
+            )
+        deleted_at = None
+        if rng.random() < 0.8:
+            deleted_at = str(START - timedelta(days=rng.randint(1, 300)))
+        instances.append(
+            (
+                instance_uuid,
+                f"vm-{n}",
+                f"project-{n % 50}",
+                1,
+                4096,
+                1,
+                int(deleted_at is not None),
+                deleted_at,
+            )
+        )
+    path = str(tmp_path_factory.mktemp("large") / "nova.sql")
+    return write_nova_dump(path, instances, events)
+
+
+def test_database_query_plans_have_no_full_scans(large_dump_file, tmp_path, caplog):
+    for database in [
+        Database(START, large_dump_file, end=END),
+        Database(START, large_dump_file, cache_dir=str(tmp_path / "cache"), end=END),
+        Database(START, large_dump_file, end=END, events_since=START + timedelta(3)),
+    ]:
+        indexes = database.db_nova.execute(
+            "select name from sqlite_master where type = 'index'"
+        ).fetchall()
+        assert len(indexes) == len(Database.INDEXES)
+
+        caplog.clear()
+        with caplog.at_level(logging.INFO):
+            database.log_query_plans()
+        plans = [r.getMessage() for r in caplog.records]
+        assert not [r for r in caplog.records if r.levelno == logging.WARNING]
+        # Billable instances are found through the index of either side of
+        # the condition on their deletion.
+        assert "Query plan for projects: MULTI-INDEX OR" in plans
+        # The events of each billable instance are sought in the index.
+        assert any(
+            plan.startswith("Query plan for project events: SEARCH instance_actions")
+            for plan in plans
+        )
+        if database.events_since is None:
+            # As are the last state changes on either side of the window.
+            for condition in ["created_at<?", "created_at>?"]:
+                assert (
+                    "Query plan for events: SEARCH instance_actions USING INDEX"
+                    " instance_actions_instance_uuid_created_at_idx"
+                    f" (instance_uuid=? AND {condition})"
+                ) in plans
+
+    # Every event is read when the database has no end, which is reported.
+    caplog.clear()
+    Database(START, large_dump_file).log_query_plans()
+    assert (
+        "Query plan for events: SCAN instance_actions USING INDEX"
+        " instance_actions_instance_uuid_created_at_idx"
+    ) in [r.getMessage() for r in caplog.records if r.levelno == logging.WARNING]
+
+
+def test_database_window_event_pruning(tmp_path):
+    rng = random.Random(42)
+    actions = ["create", "start", "stop", "shelve", "unshelve", "reboot", "resize"]
+    start = datetime(year=2000, month=1, day=1)
+    end = datetime(year=2000, month=2, day=1)
+
+    instances = []
+    events = []
+    for n in range(200):
+        instance_uuid = f"uuid-{n}"
+        times = sorted(
+            start + timedelta(days=rng.uniform(-60, 60))
+            for _ in range(rng.randint(1, 8))
+        )
+        # Every instance is created first, and some share timestamps.
+        for position, time in enumerate(times):
+            action = "create" if position == 0 else rng.choice(actions)
+            message = "Error" if rng.random() < 0.1 else None
+            time = time.replace(microsecond=0, second=0, minute=0)
+            events.append((instance_uuid, action, message, str(time)))
+        deleted_at = None
+        if rng.random() < 0.3:
+            deleted_at = str((times[-1] + timedelta(hours=1)).replace(microsecond=0))
+        instances.append(
+            (instance_uuid, f"vm-{n}", "project-1", 1, 4096, 1, 0, deleted_at)
+        )
+    dump_file = write_nova_dump(str(tmp_path / "nova.sql"), instances, events)
+
+    full = Database(start, dump_file).projects[0].instances
+    pruned = Database(start, dump_file, end=end).projects[0].instances
+    assert sum(len(i.events) for i in pruned) < sum(len(i.events) for i in full)
+
+    windows = [(start, end), (start + timedelta(days=3), start + timedelta(days=9))]
+    for full_instance, pruned_instance in zip(full, pruned):
+        for window_start, window_end in windows:
+            assert full_instance.get_runtime_during(
+                window_start, window_end
+            ) == pruned_instance.get_runtime_during(window_start, window_end)
+
+
+@pytest.mark.parametrize("end", [None, datetime(year=2000, month=1, day=20)])
+def test_database_iter_projects(tmp_path, end):
+    rng = random.Random(7)
+    instances = []
+    events = []
+    for n in range(100):
+        instance_uuid = f"uuid-{rng.randint(0, 10**6)}"
+        for position in range(rng.randint(0, 5)):
+            action = "create" if position == 0 else rng.choice(["stop", "start"])
+            time = START + timedelta(days=rng.randint(-30, 30))
+            events.append((instance_uuid, action, None, str(time)))
+        deleted = int(rng.random() < 0.3)
+        deleted_at = str(START + timedelta(days=rng.randint(-30, 30)))
+        instances.append(
+            (
+                instance_uuid,
+                f"vm-{n}",
+                f"project-{rng.randint(0, 9)}",
+                1,
+                4096,
+                1,
+                deleted,
+                deleted_at if deleted else None,
+            )
+        )
+    dump_file = write_nova_dump(str(tmp_path / "nova.sql"), instances, events)
+
+    database = Database(START, dump_file, end=end)
+    assert list(database.iter_projects()) == database.projects
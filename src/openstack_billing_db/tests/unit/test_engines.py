@@ -0,0 +1,115 @@
+import random
+import uuid
+from datetime import timedelta
+
+import pytest
+
+from openstack_billing_db import billing, engines
+from openstack_billing_db.model import Instance, InstanceEvent
+from openstack_billing_db.tests.unit.utils import (
+    FLAVORS,
+    HOUR,
+    DAY,
+    START,
+    END,
+    random_instance,
+    random_outages,
+)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_sweep_matches_reference(seed):
+    rng = random.Random(seed)
+    for _ in range(25):
+        instance = random_instance(rng)
+        outages = random_outages(rng)
+
+        expected = billing.get_runtime_for_instance(instance, START, END, outages)
+        window = engines.BillableWindow(START, END, outages)
+        assert engines.get_runtime_sweep(instance, window) == expected
+
+
+def test_billable_window_coalesces_excluded_intervals():
+    window = engines.BillableWindow(
+        START,
+        END,
+        [
+            (START + timedelta(days=2), START + timedelta(days=4)),
+            (START + timedelta(days=3), START + timedelta(days=5)),
+            (START - timedelta(days=1), START + timedelta(days=1)),
+            (END - timedelta(hours=1), END + timedelta(days=1)),
+        ],
+    )
+    assert len(window.excluded) == 3
+    assert window.billable_until(window.end) == (31 - 1 - 3) * DAY - HOUR
+
+    instance = Instance(
+        uuid=uuid.uuid4().hex,
+        name=uuid.uuid4().hex,
+        flavor=FLAVORS[1],
+        events=[
+            InstanceEvent(time=START, name="create", message=""),
+            InstanceEvent(time=START + timedelta(days=10), name="stop", message=""),
+        ],
+    )
+    r = engines.get_runtime_sweep(instance, window)
+    assert r.total_seconds_running == (10 - 1 - 3) * DAY
+    assert r.total_seconds_stopped == 21 * DAY - HOUR
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_vectorized_matches_reference(seed):
+    rng = random.Random(seed)
+    instances = [random_instance(rng) for _ in range(25)]
+    # Overlapping outages are subtracted once each, as by the reference.
+    outages = random_outages(rng) + random_outages(rng)
+
+    expected = [
+        billing.get_runtime_for_instance(i, START, END, outages) for i in instances
+    ]
+    assert engines.get_runtimes_vectorized(instances, START, END, outages) == expected
+
+
+def test_vectorized_no_instances():
+    assert engines.get_runtimes_vectorized([], START, END, []) == []
+
+
+@pytest.mark.parametrize("bucket_seconds", [HOUR, DAY, 7 * DAY])
+def test_runtime_per_bucket_sums_to_total(bucket_seconds):
+    rng = random.Random(bucket_seconds)
+    for _ in range(100):
+        instance = random_instance(rng)
+        window = engines.BillableWindow(START, END, random_outages(rng))
+
+        buckets = engines.get_runtime_per_bucket(instance, window, bucket_seconds)
+        assert len(buckets) == -(-31 * DAY // bucket_seconds)
+        assert all(0 <= b.total_seconds_running <= bucket_seconds for b in buckets)
+
+        total = engines.get_runtime_sweep(instance, window)
+        assert sum(b.total_seconds_running for b in buckets) == pytest.approx(
+            total.total_seconds_running
+        )
+        assert sum(b.total_seconds_stopped for b in buckets) == pytest.approx(
+            total.total_seconds_stopped
+        )
+
+
+def test_runtime_per_bucket():
+    instance = Instance(
+        uuid=uuid.uuid4().hex,
+        name=uuid.uuid4().hex,
+        flavor=FLAVORS[1],
+        events=[
+            InstanceEvent(time=START - timedelta(days=1), name="create", message=""),
+            InstanceEvent(time=START + timedelta(hours=30), name="stop", message=""),
+        ],
+        deleted_at=START + timedelta(days=2, hours=12),
+    )
+    window = engines.BillableWindow(
+        START, END, [(START + timedelta(hours=1), START + timedelta(hours=2))]
+    )
+
+    buckets = engines.get_runtime_per_bucket(instance, window, DAY)
+    assert [b.total_seconds_running for b in buckets[:3]] == [23 * HOUR, 6 * HOUR, 0]
+    assert [b.total_seconds_stopped for b in buckets[:3]] == [0, 18 * HOUR, 12 * HOUR]
+    assert all(b.total_seconds_running == 0 for b in buckets[3:])
@@ -0,0 +1,88 @@
+from datetime import datetime
+import gzip
+import os
+
+import boto3
+import botocore.exceptions
+import moto
+import pytest
+
+from openstack_billing_db import fetch
+from openstack_billing_db.model import Database
+from openstack_billing_db.tests.unit.utils import (
+    START,
+    INSTANCES,
+    EVENTS,
+    write_nova_mysqldump,
+)
+
+BUCKET = "nerc-osp-backups"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("S3_INPUT_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("S3_INPUT_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.delenv("S3_INPUT_ENDPOINT_URL", raising=False)
+    monkeypatch.delenv("S3_INPUT_BUCKET", raising=False)
+    with moto.mock_aws():
+        # The client of the code under test targets the default endpoint
+        # while mocked, instead of the NERC one.
+        monkeypatch.setattr(fetch, "get_s3_input_client", lambda: boto3.client("s3"))
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=BUCKET)
+        yield s3
+
+
+def test_open_latest_dump_from_s3(s3, tmp_path):
+    dump_file = write_nova_mysqldump(
+        str(tmp_path / "nova.sql.gz"), INSTANCES, EVENTS * 50
+    )
+    today = datetime.today().strftime("%Y%m%d")
+    key = f"dbs/nerc-ctl-1/nova-{today}000002.sql.gz"
+    s3.upload_file(dump_file, BUCKET, key)
+    assert fetch.find_latest_dump_key(s3, BUCKET) == key
+
+    chunk_size = 256
+    assert os.path.getsize(dump_file) > 4 * chunk_size
+    with fetch.open_latest_dump_from_s3(chunk_size=chunk_size, concurrency=3) as f:
+        streamed = Database(START, f, dump_format="mysqldump")
+
+    expected = Database(START, dump_file, dump_format="mysqldump")
+    assert streamed.projects == expected.projects
+
+
+def test_iter_object_chunks(s3):
+    content = os.urandom(3000)
+    s3.put_object(Bucket=BUCKET, Key="object", Body=content)
+
+    for chunk_size, concurrency in [(7, 1), (999, 4), (3000, 2), (5000, 8)]:
+        chunks = list(
+            fetch.iter_object_chunks(s3, BUCKET, "object", chunk_size, concurrency)
+        )
+        assert b"".join(chunks) == content
+        assert max(len(c) for c in chunks) == min(chunk_size, len(content))
+
+
+def test_open_s3_object_fails_if_replaced(s3):
+    s3.put_object(Bucket=BUCKET, Key="object", Body=b"a\n" * 10_000)
+
+    with fetch.open_s3_object(s3, BUCKET, "object", 100, 1) as f:
+        f.readline()
+        s3.put_object(Bucket=BUCKET, Key="object", Body=b"b\n" * 10_000)
+        with pytest.raises(botocore.exceptions.ClientError):
+            f.read()
+
+
+def test_open_s3_object_decompresses_gzip_members(s3):
+    body = gzip.compress(b"first\n") + gzip.compress(b"second\n" * 1000)
+    s3.put_object(Bucket=BUCKET, Key="object.gz", Body=body)
+
+    with fetch.open_s3_object(s3, BUCKET, "object.gz", 7, 2) as f:
+        assert f.read() == "first\n" + "second\n" * 1000
+
+    s3.put_object(Bucket=BUCKET, Key="truncated.gz", Body=body[:-10])
+    with fetch.open_s3_object(s3, BUCKET, "truncated.gz", 7, 2) as f:
+        with pytest.raises(Exception, match="Truncated"):
+            f.read()
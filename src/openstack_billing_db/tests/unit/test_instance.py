@@ -1,7 +1,13 @@
 import uuid
 from datetime import datetime, timedelta
 
-from openstack_billing_db.model import Instance, InstanceEvent, Database
+from openstack_billing_db.model import (
+    Database,
+    Instance,
+    InstanceEvent,
+    NO_STATE,
+    STATE_CODES,
+)
 from openstack_billing_db.tests.unit.utils import FLAVORS, MINUTE, HOUR, DAY, MONTH
 
 
@@ -360,3 +366,26 @@ def test_error_event_outside_window():
     r_after = i.get_runtime_during(start, end)
     assert r_after.total_seconds_running == 1 * MONTH
     assert r_after.total_seconds_stopped == 0
+
+
+def test_instance_event_parsed_once():
+    event = InstanceEvent(time="2000-01-02 00:00:00", name="stop", message=None)
+    assert event.time == datetime(year=2000, month=1, day=2)
+    assert event.timestamp == 946771200
+    assert event.state == STATE_CODES["Stopped"]
+    assert not hasattr(event, "__dict__")
+
+    event = InstanceEvent(time=event.time, name="stop", message="Error")
+    assert event.state == STATE_CODES["Error"]
+
+    event = InstanceEvent(time=event.time, name="reboot", message="")
+    assert event.state == NO_STATE
+
+    i = Instance(
+        uuid=uuid.uuid4().hex,
+        name=uuid.uuid4().hex,
+        flavor=FLAVORS[1],
+        events=[],
+        deleted_at="2000-01-03 00:00:00",
+    )
+    assert i.deleted_at == datetime(year=2000, month=1, day=3)
@@ -0,0 +1,208 @@
+import random
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from openstack_billing_db import billing, live
+from openstack_billing_db.model import Database
+from openstack_billing_db.tests.unit.utils import get_rates, write_nova_dump
+
+START = datetime(year=2000, month=1, day=1)
+END = datetime(year=2000, month=2, day=1)
+
+
+def random_nova_dump(path, seed=7):
+    rng = random.Random(seed)
+    instances = []
+    events = []
+    for n in range(100):
+        instance_uuid = f"uuid-{rng.randint(0, 10**6)}"
+        for position in range(rng.randint(0, 5)):
+            action = "create" if position == 0 else rng.choice(["stop", "start"])
+            time = START + timedelta(
+                days=rng.randint(-30, 45), hours=rng.randint(0, 23)
+            )
+            events.append((instance_uuid, action, None, str(time)))
+        deleted = int(rng.random() < 0.3)
+        deleted_at = str(
+            START + timedelta(days=rng.randint(-30, 45), hours=rng.randint(0, 23))
+        )
+        instances.append(
+            (
+                instance_uuid,
+                f"vm-{n}",
+                f"project-{rng.randint(0, 9)}",
+                1,
+                4096,
+                1 + n % 4,
+                deleted,
+                deleted_at if deleted else None,
+            )
+        )
+    return write_nova_dump(path, instances, events)
+
+
+def to_sqlite(dump_file, path):
+    connection = sqlite3.connect(path)
+    with open(dump_file) as f:
+        connection.executescript(f.read())
+    connection.close()
+    return path
+
+
+@pytest.fixture
+def nova_sqlite(tmp_path):
+    dump_file = random_nova_dump(str(tmp_path / "nova.sql"))
+    return dump_file, to_sqlite(dump_file, str(tmp_path / "nova.sqlite"))
+
+
+def get_runtimes_by_uuid(database):
+    instances = billing.get_all_instances(database)
+    runtimes = billing.get_runtimes(instances, START, END, [], "sweep")
+    return {i.uuid: r for i, r in zip(instances, runtimes)}
+
+
+@pytest.mark.parametrize("paramstyle", ["qmark", "named"])
+def test_live_database_matches_dump(nova_sqlite, paramstyle):
+    dump_file, path = nova_sqlite
+    connections = []
+
+    def connect():
+        connections.append(sqlite3.connect(f"file:{path}?mode=ro", uri=True))
+        return connections[-1]
+
+    database = live.LiveDatabase(START, connect, paramstyle=paramstyle, batch_size=7)
+    projects = list(database.iter_projects())
+    assert [p.uuid for p in projects] == [p.uuid for p in database.projects]
+    assert get_runtimes_by_uuid(database) == get_runtimes_by_uuid(
+        Database(START, dump_file)
+    )
+    assert database.get_fingerprints() == Database(START, dump_file).get_fingerprints()
+
+    # Connections are reused by later reads.
+    list(database.iter_projects())
+    assert len(connections) == 2
+    database.close()
+
+
+def test_live_database_matches_dump_with_deletion_in_period(tmp_path):
+    dump_file = write_nova_dump(
+        str(tmp_path / "nova.sql"),
+        [
+            ("uuid-1", "vm-1", "p1", 1, 4096, 1, 1, "2000-01-01 12:00:00"),
+            ("uuid-2", "vm-2", "p2", 1, 4096, 1, 1, "1999-12-31 12:00:00"),
+        ],
+        [("uuid-1", "create", None, "1999-12-01 00:00:00")],
+    )
+    path = to_sqlite(dump_file, str(tmp_path / "nova.sqlite"))
+
+    def get_projects(database):
+        return [(p.uuid, len(p.instances)) for p in database.iter_projects()]
+
+    database = live.LiveDatabase(
+        START, lambda: sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    )
+    assert get_projects(database) == get_projects(Database(START, dump_file))
+    assert get_projects(database) == [("p1", 1)]
+    assert [p.uuid for p in Database(START, dump_file).projects] == ["p1"]
+    database.close()
+
+
+def test_live_database_from_url(nova_sqlite):
+    dump_file, path = nova_sqlite
+    connect, paramstyle, cursor_factory = live.connect_from_url(f"sqlite://{path}")
+    database = live.LiveDatabase(
+        START, connect, paramstyle=paramstyle, cursor_factory=cursor_factory
+    )
+
+    rates = get_rates()
+    invoices = billing.collect_invoice_data_from_openstack(
+        database, START, END, rates, runtime_engine="sweep", excluded_intervals=[]
+    )
+    expected = billing.collect_invoice_data_from_openstack(
+        Database(START, dump_file),
+        START,
+        END,
+        rates,
+        runtime_engine="sweep",
+        excluded_intervals=[],
+    )
+    assert [(i.project_id, i.su_hours["cpu"]) for i in invoices] == [
+        (i.project_id, i.su_hours["cpu"]) for i in expected
+    ]
+
+    with pytest.raises(Exception):
+        live.connect_from_url("postgresql://localhost/nova")
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_connection_pool_close():
+    connections = []
+
+    def connect():
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    pool = live.ConnectionPool(connect, size=2)
+    with pool.connection():
+        pass
+    idle = connections[0]
+
+    waiting = []
+
+    def wait_for_connection():
+        with pytest.raises(Exception, match="closed"):
+            with pool.connection():
+                pass
+        waiting.append(True)
+
+    with pool.connection() as first, pool.connection() as second:
+        assert first is idle and not second.closed
+        waiter = threading.Thread(target=wait_for_connection)
+        waiter.start()
+        # Closing does not wait for the connections in use, but closes
+        # them once they are returned, and wakes the callers waiting.
+        pool.close()
+        waiter.join(timeout=10)
+        assert waiting == [True]
+        assert not first.closed and not second.closed
+    assert first.closed and second.closed
+
+    with pytest.raises(Exception, match="closed"):
+        with pool.connection():
+            pass
+    pool.close()
+
+
+def test_connection_pool_closes_idle_connections():
+    connection = FakeConnection()
+    pool = live.ConnectionPool(lambda: connection)
+    with pool.connection():
+        pass
+    pool.close()
+    assert connection.closed
+
+
+def test_format_query():
+    query = "select * from t where a > :start and b < :end and c = :start"
+    parameters = {"start": 1, "end": 2}
+    assert live.format_query(query, "qmark") == (
+        "select * from t where a > ? and b < ? and c = ?"
+    )
+    assert live.get_parameters(query, parameters, "qmark") == [1, 2, 1]
+    assert live.format_query(query, "format") == (
+        "select * from t where a > %s and b < %s and c = %s"
+    )
+    assert live.format_query(query, "pyformat") == (
+        "select * from t where a > %(start)s and b < %(end)s and c = %(start)s"
+    )
+    assert live.get_parameters(query, parameters, "pyformat") == parameters
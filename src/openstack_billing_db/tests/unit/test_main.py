@@ -0,0 +1,59 @@
+import pytest
+
+from openstack_billing_db import main
+
+
+def parse_args(*args):
+    return main.get_parser().parse_args(["--sql-dump-file", "nova.sql", *args])
+
+
+@pytest.mark.parametrize("runtime_engine", ["reference", "vectorized"])
+def test_checkpoint_rejects_other_runtime_engines(runtime_engine):
+    args = parse_args(
+        "--checkpoint-file", "checkpoint", "--runtime-engine", runtime_engine
+    )
+    with pytest.raises(Exception, match="--checkpoint-file cannot be combined"):
+        main.check_modes(args)
+
+
+@pytest.mark.parametrize(
+    "args,error",
+    [
+        (["--differential"], "--differential requires --checkpoint-file"),
+        (
+            ["--differential", "--checkpoint-file", "checkpoint", "--workers", "2"],
+            "--differential cannot be combined with --workers",
+        ),
+        (
+            ["--differential", "--checkpoint-file", "checkpoint"]
+            + ["--runtime-engine", "reference"],
+            "--checkpoint-file cannot be combined",
+        ),
+        (
+            ["--stream", "--checkpoint-file", "checkpoint"],
+            "--stream cannot be combined",
+        ),
+        (["--stream", "--workers", "2"], "--stream cannot be combined"),
+        (["--stream", "--usage-timeseries", "daily"], "--stream cannot be combined"),
+        (["--stream", "--instance-details"], "--stream cannot be combined"),
+    ],
+)
+def test_check_modes_rejects(args, error):
+    with pytest.raises(Exception, match=error):
+        main.check_modes(parse_args(*args))
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        [],
+        ["--runtime-engine", "vectorized"],
+        ["--checkpoint-file", "checkpoint"],
+        ["--checkpoint-file", "checkpoint", "--runtime-engine", "sweep"],
+        ["--differential", "--checkpoint-file", "checkpoint"],
+        ["--stream", "--runtime-engine", "sweep"],
+        ["--workers", "2", "--usage-timeseries", "hourly"],
+    ],
+)
+def test_check_modes_accepts(args):
+    main.check_modes(parse_args(*args))
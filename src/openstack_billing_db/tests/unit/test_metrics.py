@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+from openstack_billing_db import metrics
+from openstack_billing_db.model import Database
+from openstack_billing_db.tests.unit.utils import (
+    START,
+    INSTANCES,
+    EVENTS,
+    write_nova_dump,
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_metrics_summary(tmp_path):
+    for _ in range(2):
+        with metrics.stage("download"):
+            pass
+    with pytest.raises(ValueError):
+        with metrics.stage("failing"):
+            raise ValueError()
+    metrics.count("bytes_downloaded", 100)
+    metrics.count("bytes_downloaded", 20)
+    metrics.count("rows_loaded", 3, table="instances")
+
+    metrics.write_json(str(tmp_path / "metrics.json"), success=False)
+    with open(tmp_path / "metrics.json") as f:
+        summary = json.load(f)
+
+    assert summary["success"] is False
+    assert sorted(summary["stages"]) == ["download", "failing"]
+    assert summary["counters"] == [
+        {"name": "bytes_downloaded", "labels": {}, "value": 120},
+        {"name": "rows_loaded", "labels": {"table": "instances"}, "value": 3},
+    ]
+    assert summary["peak_rss_bytes"]["self"] > 0
+
+
+def test_metrics_prometheus(tmp_path):
+    with metrics.stage("load_dump"):
+        pass
+    metrics.count("rows_loaded", 3, table='odd "name"')
+
+    metrics.write_prometheus(str(tmp_path / "billing.prom"))
+    with open(tmp_path / "billing.prom") as f:
+        lines = f.read().splitlines()
+
+    assert "openstack_billing_last_run_success 1" in lines
+    assert "# TYPE openstack_billing_stage_duration_seconds gauge" in lines
+    assert any(
+        line.startswith('openstack_billing_stage_duration_seconds{stage="load_dump"} ')
+        for line in lines
+    )
+    assert 'openstack_billing_rows_loaded{table="odd \\"name\\""} 3' in lines
+    # Every sample follows the declaration of its type.
+    declared = set()
+    for line in lines:
+        if line.startswith("# TYPE "):
+            declared.add(line.split()[2])
+        else:
+            assert line.split("{")[0].split()[0] in declared
+
+
+def test_database_counts_rows_loaded(tmp_path):
+    Database(START, write_nova_dump(str(tmp_path / "nova.sql"), INSTANCES, EVENTS))
+
+    counters = {
+        tuple(c["labels"].values()): c["value"]
+        for c in metrics.get_summary()["counters"]
+    }
+    assert counters == {
+        ("instances",): 3,
+        ("instance_extra",): 3,
+        ("instance_actions",): 6,
+    }
+    assert "load_dump" in metrics.get_summary()["stages"]
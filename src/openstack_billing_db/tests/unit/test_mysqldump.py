@@ -0,0 +1,83 @@
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from openstack_billing_db import mysqldump
+from openstack_billing_db.model import Database
+from openstack_billing_db.tests.unit.utils import (
+    write_nova_dump,
+    write_nova_mysqldump,
+)
+
+START = datetime(year=2000, month=1, day=1)
+
+INSTANCES = [
+    ("uuid-1", "vm-1", "project-1", 1, 4096, 1, 0, None),
+    ("uuid-2", "it's \\ vm-2", "project-1", 2, 8192, 2, 1, "2000-01-10 00:00:00"),
+    ("uuid-3", "vm-3", "project-2", 3, 4096, 1, 0, None),
+]
+
+EVENTS = [
+    ("uuid-1", "create", None, "1999-06-01 00:00:00"),
+    ("uuid-1", "stop", "Error", "2000-01-05 00:00:00"),
+    ("uuid-2", "create", None, "2000-01-02 00:00:00"),
+    ("uuid-2", "delete", None, "2000-01-10 00:00:00"),
+    ("uuid-3", "create", None, "2000-01-03 00:00:00"),
+]
+
+PCI_REQUESTS = {"uuid-3": '[{"count": 1, "alias_name": "V100"}]'}
+
+
+def test_parse_values():
+    rows = mysqldump.parse_values(
+        "(1,'a\\'b','c\\\\d\\n',NULL,-2.5,0x0aff),(2,'it''s','',NULL,3,'x,(y)');\n"
+    )
+    assert rows == [
+        (1, "a'b", "c\\d\n", None, -2.5, b"\n\xff"),
+        (2, "it's", "", None, 3, "x,(y)"),
+    ]
+
+
+def test_load_only_billing_tables(tmp_path):
+    dump = write_nova_mysqldump(str(tmp_path / "nova.sql"), INSTANCES, EVENTS)
+    connection = sqlite3.connect(":memory:")
+
+    rows_loaded = mysqldump.load_mysqldump_into_sqlite(dump, connection)
+    assert rows_loaded == {
+        "instances": 3,
+        "instance_extra": 3,
+        "instance_actions": 5,
+    }
+
+    tables = connection.execute("select name from sqlite_master where type='table'")
+    assert sorted(t[0] for t in tables) == sorted(mysqldump.BILLING_TABLES)
+    assert connection.execute(
+        "select hostname from instances where uuid = 'uuid-2'"
+    ).fetchone() == ("it's \\ vm-2",)
+
+
+def test_load_missing_table(tmp_path):
+    dump = tmp_path / "nova.sql"
+    dump.write_text("CREATE TABLE `instances` (\n  `id` int(11)\n);\n")
+    with pytest.raises(Exception):
+        mysqldump.load_mysqldump_into_sqlite(str(dump), sqlite3.connect(":memory:"))
+
+
+@pytest.mark.parametrize("filename", ["nova.sql", "nova.sql.gz"])
+def test_database_from_mysqldump(tmp_path, filename):
+    sqlite_dump = write_nova_dump(
+        str(tmp_path / "converted.sql"), INSTANCES, EVENTS, PCI_REQUESTS
+    )
+    dump = write_nova_mysqldump(
+        str(tmp_path / filename), INSTANCES, EVENTS, PCI_REQUESTS
+    )
+
+    expected = Database(START, sqlite_dump).projects
+    assert Database(START, dump, dump_format="mysqldump").projects == expected
+    assert (
+        Database(
+            START, dump, dump_format="mysqldump", cache_dir=str(tmp_path / "cache")
+        ).projects
+        == expected
+    )
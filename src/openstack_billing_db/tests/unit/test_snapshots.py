@@ -0,0 +1,153 @@
+from datetime import datetime
+import hashlib
+import time
+
+import pytest
+import requests
+
+from openstack_billing_db import billing, snapshots
+from openstack_billing_db.model import Database
+from openstack_billing_db.tests.unit.utils import get_rates, write_nova_dump
+
+URL = "https://example.org/outages.yaml"
+
+OUTAGES = b"""
+- url: https://example.org/outage
+  timeframes:
+    - from: "2024-05-22T12:00:00Z"
+      until: "2024-05-29T03:00:00Z"
+      affected_services: ["NERC OpenStack"]
+"""
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code}")
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Serves OUTAGES at URL with an ETag, recording the requests made."""
+    state = {"content": OUTAGES, "requests": [], "down": False}
+
+    def get(url, headers=None, **kwargs):
+        state["requests"].append(headers or {})
+        if state["down"]:
+            raise requests.ConnectionError("down")
+        etag = '"' + hashlib.sha256(state["content"]).hexdigest() + '"'
+        if (headers or {}).get("If-None-Match") == etag:
+            return FakeResponse(304)
+        return FakeResponse(200, state["content"], {"ETag": etag})
+
+    monkeypatch.setattr(requests, "get", get)
+    return state
+
+
+def test_fetch_then_cached(tmp_path, server):
+    cache = snapshots.SnapshotCache(str(tmp_path), ttl=3600)
+    assert cache.get("outages", URL) == OUTAGES
+    assert cache.get("outages", URL) == OUTAGES
+    assert len(server["requests"]) == 1
+
+    sha256 = hashlib.sha256(OUTAGES).hexdigest()
+    assert cache.used["outages"].sha256 == sha256
+    assert (tmp_path / f"{sha256}.yaml").read_bytes() == OUTAGES
+
+
+def test_revalidate_expired(tmp_path, server):
+    cache = snapshots.SnapshotCache(str(tmp_path), ttl=0)
+    cache.get("outages", URL)
+    assert cache.get("outages", URL) == OUTAGES
+    assert "If-None-Match" in server["requests"][-1]
+
+    server["content"] = OUTAGES + b"\n"
+    assert cache.get("outages", URL) == OUTAGES + b"\n"
+    assert cache.used["outages"].sha256 == hashlib.sha256(OUTAGES + b"\n").hexdigest()
+
+
+def test_offline(tmp_path, server):
+    offline = snapshots.SnapshotCache(str(tmp_path), offline=True)
+    with pytest.raises(snapshots.SnapshotUnavailable):
+        offline.get("outages", URL)
+
+    snapshots.SnapshotCache(str(tmp_path)).get("outages", URL)
+    requests_made = len(server["requests"])
+    offline.ttl = 0
+    assert offline.get("outages", URL) == OUTAGES
+    assert len(server["requests"]) == requests_made
+
+
+def test_stale_on_network_error(tmp_path, server):
+    cache = snapshots.SnapshotCache(str(tmp_path), ttl=0)
+    server["down"] = True
+    with pytest.raises(requests.ConnectionError):
+        cache.get("outages", URL)
+
+    server["down"] = False
+    fetched_at = time.time()
+    cache.get("outages", URL)
+    server["down"] = True
+    assert cache.get("outages", URL) == OUTAGES
+    assert cache.used["outages"].fetched_at >= fetched_at
+
+
+def test_pinned_from_manifest(tmp_path, server):
+    cache = snapshots.SnapshotCache(str(tmp_path))
+    cache.get("outages", URL)
+    manifest = str(tmp_path / "manifest.json")
+    cache.write_manifest(manifest)
+
+    server["content"] = b"[]\n"
+    pinned = snapshots.SnapshotCache(
+        str(tmp_path), ttl=0, pinned=snapshots.SnapshotCache.read_manifest(manifest)
+    )
+    assert pinned.get("outages", URL) == OUTAGES
+    assert pinned.used["outages"].sha256 == cache.used["outages"].sha256
+
+    missing = snapshots.SnapshotCache(str(tmp_path), pinned={"outages": "0" * 64})
+    with pytest.raises(snapshots.SnapshotUnavailable):
+        missing.get("outages", URL)
+
+
+def test_load_outages(tmp_path, server, monkeypatch):
+    monkeypatch.setitem(snapshots.SOURCES, "outages", URL)
+    cache = snapshots.SnapshotCache(str(tmp_path))
+    outages = cache.load_outages()
+    assert (
+        len(outages.get_outages_during("2024-05-01", "2024-06-01", "NERC OpenStack"))
+        == 1
+    )
+
+
+@pytest.mark.parametrize("record", [False, True])
+def test_manifest_written_only_when_recorded(tmp_path, server, monkeypatch, record):
+    monkeypatch.setitem(snapshots.SOURCES, "outages", URL)
+    start = datetime(year=2000, month=1, day=1)
+    database = Database(
+        start,
+        write_nova_dump(
+            str(tmp_path / "nova.sql"),
+            [("uuid-1", "vm-1", "project-1", 1, 4096, 1, 0, None)],
+            [("uuid-1", "create", None, "2000-01-02 00:00:00")],
+        ),
+    )
+
+    billing.generate_billing(
+        start,
+        datetime(year=2000, month=2, day=1),
+        str(tmp_path / "invoice.csv"),
+        get_rates(),
+        snapshot_cache=snapshots.SnapshotCache(str(tmp_path / "cache")),
+        record_snapshots=record,
+        database=database,
+    )
+    manifest = tmp_path / "invoice_snapshots.json"
+    assert manifest.exists() == record
+    if record:
+        assert list(snapshots.SnapshotCache.read_manifest(str(manifest))) == ["outages"]
@@ -0,0 +1,105 @@
+import argparse
+
+import pytest
+
+from openstack_billing_db import benchmark, synthetic
+from openstack_billing_db.model import Database
+
+
+def test_generate_nova_dump(tmp_path):
+    dump_file = str(tmp_path / "nova.sql.gz")
+    rows = synthetic.generate_nova_dump(
+        dump_file,
+        projects=20,
+        instances=500,
+        actions_per_instance=5,
+        start=benchmark.START,
+        end=benchmark.END,
+    )
+    assert rows["instances"] == rows["instance_extra"] == 500
+    assert rows["instance_actions"] >= 500
+
+    database = Database(benchmark.START, dump_file, end=benchmark.END)
+    instances = [i for project in database.projects for i in project.instances]
+    assert 1 < len(database.projects) <= 20
+    assert 0 < len(instances) <= 500
+    assert {i.service_unit_type for i in instances} == {
+        "cpu",
+        "gpu_a100",
+        "gpu_a100sxm4",
+        "gpu_v100",
+        "gpu_k80",
+    }
+
+    # The same seed generates the same dump.
+    for name in ["a.sql", "b.sql"]:
+        synthetic.generate_nova_dump(str(tmp_path / name), projects=20, instances=50)
+    with open(tmp_path / "a.sql") as a, open(tmp_path / "b.sql") as b:
+        assert a.read() == b.read()
+
+
+def test_generate_nova_dump_with_outages(tmp_path):
+    outages = benchmark.generate_outages(2)
+    dump_file = str(tmp_path / "nova.sql")
+    synthetic.generate_nova_dump(
+        dump_file, projects=5, instances=100, outages=outages, seed=3
+    )
+    database = Database(benchmark.START, dump_file)
+    instances = [i for project in database.projects for i in project.instances]
+
+    for outage_start, outage_end in outages:
+        stopped = [
+            i
+            for i in instances
+            if ("stop", outage_start) in [(e.name, e.time) for e in i.events]
+        ]
+        assert 0 < len(stopped) < len(instances)
+        for instance in stopped:
+            assert ("start", outage_end) in [(e.name, e.time) for e in instance.events]
+    for instance in instances:
+        assert instance.events[0].name == "create"
+        assert [e.time for e in instance.events] == sorted(
+            e.time for e in instance.events
+        )
+
+
+def test_benchmark_pipeline_baseline(tmp_path):
+    dump_file = str(tmp_path / "nova.sql")
+    synthetic.generate_nova_dump(dump_file, projects=5, instances=50)
+    result = benchmark.time_pipeline(
+        dump_file, benchmark.generate_outages(2), str(tmp_path / "invoices.csv")
+    )
+    assert set(result["seconds"]) == set(benchmark.PIPELINE_STAGES)
+
+    results = {"50": result}
+    assert benchmark.compare_to_baseline(results, results) == []
+    assert benchmark.compare_to_baseline(results, {}) == []
+
+    slower = {
+        "50": {
+            "seconds": {
+                stage: seconds * 2 for stage, seconds in result["seconds"].items()
+            },
+            "invoice_sha256": "other",
+        }
+    }
+    assert benchmark.compare_to_baseline(results, slower) == [
+        "50 instances: invoices differ from baseline."
+    ]
+    assert len(benchmark.compare_to_baseline(slower, results)) == 4
+
+
+def test_parse_gpu_mix(tmp_path):
+    gpu_mix = benchmark.parse_gpu_mix("A100=0.5, V100=0.25")
+    assert gpu_mix == {"A100": 0.5, "V100": 0.25}
+    assert benchmark.parse_gpu_mix("") == {}
+    for arg in ["A2=0.1", "A100=half", "A100=-0.1", "A100=0.6,V100=0.6"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            benchmark.parse_gpu_mix(arg)
+
+    dump_file = str(tmp_path / "nova.sql")
+    synthetic.generate_nova_dump(dump_file, projects=5, instances=200, gpu_mix=gpu_mix)
+    database = Database(benchmark.START, dump_file)
+    assert {
+        i.service_unit_type for project in database.projects for i in project.instances
+    } == {"cpu", "gpu_a100", "gpu_v100"}
@@ -1,4 +1,11 @@
-from openstack_billing_db import model
+import gzip
+import itertools
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from openstack_billing_db import billing, model
+from openstack_billing_db.synthetic import NOVA_SCHEMA
 
 FLAVORS = {
     1: model.Flavor(
@@ -10,3 +17,215 @@ MINUTE = 60
 HOUR = 60 * MINUTE
 DAY = HOUR * 24
 MONTH = 31 * DAY
+
+START = datetime(year=2000, month=1, day=1)
+END = datetime(year=2000, month=2, day=1)
+ACTIONS = ["create", "start", "stop", "shelve", "unshelve", "delete", "reboot"]
+
+# A small Nova database, for `write_nova_dump` and `write_nova_mysqldump`.
+INSTANCES = [
+    ("uuid-1", "vm-1", "project-1", 1, 4096, 1, 0, None),
+    ("uuid-2", "vm-2", "project-1", 1, 8192, 2, 1, "2000-01-10 00:00:00"),
+    ("uuid-3", "vm-3", "project-2", 1, 4096, 1, 1, "1999-12-01 00:00:00"),
+]
+
+EVENTS = [
+    ("uuid-1", "create", None, "1999-06-01 00:00:00"),
+    ("uuid-1", "stop", None, "2000-01-05 00:00:00"),
+    ("uuid-2", "create", None, "2000-01-02 00:00:00"),
+    ("uuid-2", "delete", None, "2000-01-10 00:00:00"),
+    ("uuid-3", "create", None, "1999-11-01 00:00:00"),
+    ("uuid-3", "delete", None, "1999-12-01 00:00:00"),
+]
+
+
+def get_rates(cpu=1, include_stopped_runtime=False) -> billing.Rates:
+    """Returns rates of `cpu` per CPU SU hour, and of 1 per GPU SU hour."""
+    rates = {
+        service_unit_type: Decimal(1) for service_unit_type in billing.INVOICE_SU_TYPES
+    }
+    return billing.Rates(
+        rates={**rates, "cpu": Decimal(cpu)},
+        include_stopped_runtime=include_stopped_runtime,
+    )
+
+
+def get_ticking_clock(start: datetime, tick=timedelta(hours=1)):
+    """Returns a datetime class whose now() advances by a tick on each call."""
+    ticks = itertools.count()
+
+    class Clock(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return (start + next(ticks) * tick).replace(tzinfo=tz)
+
+    return Clock
+
+
+def random_instance(rng):
+    time = START + timedelta(hours=rng.randint(-24 * 40, 24 * 40))
+    events = [model.InstanceEvent(time=time, name="create", message="")]
+    for _ in range(rng.randint(0, 10)):
+        time += timedelta(minutes=rng.randint(0, 5 * 24 * 60))
+        message = "Error" if rng.random() < 0.1 else ""
+        events.append(
+            model.InstanceEvent(time=time, name=rng.choice(ACTIONS), message=message)
+        )
+
+    deleted_at = None
+    if rng.random() < 0.3:
+        deleted_at = time + timedelta(minutes=rng.randint(0, 24 * 60))
+
+    return model.Instance(
+        uuid=uuid.uuid4().hex,
+        name=uuid.uuid4().hex,
+        flavor=FLAVORS[1],
+        events=events,
+        deleted_at=deleted_at,
+    )
+
+
+def random_outages(rng):
+    """Returns disjoint outages within the billing period."""
+    boundaries = sorted(
+        START + timedelta(minutes=rng.randint(0, 31 * 24 * 60))
+        for _ in range(2 * rng.randint(0, 4))
+    )
+    return list(zip(boundaries[::2], boundaries[1::2]))
+
+
+def _sql_value(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def write_nova_dump(path, instances, events, pci_requests=None):
+    """Writes a SQLite compatible dump of a minimal Nova database.
+
+    `instances` contains tuples of
+    (uuid, hostname, project_id, instance_type_id, memory_mb, vcpus,
+    deleted, deleted_at), `events` contains tuples of
+    (instance_uuid, action, message, created_at) and `pci_requests`
+    maps instance uuids to the JSON of their PCI requests.
+    """
+    pci_requests = pci_requests or {}
+    lines = ["BEGIN TRANSACTION;", NOVA_SCHEMA]
+    for instance in instances:
+        values = ",".join(_sql_value(v) for v in instance)
+        lines.append(
+            "INSERT INTO instances (uuid, hostname, project_id,"
+            " instance_type_id, memory_mb, vcpus, deleted, deleted_at)"
+            f" VALUES ({values});"
+        )
+        lines.append(
+            "INSERT INTO instance_extra (instance_uuid, pci_requests)"
+            f" VALUES ({_sql_value(instance[0])},"
+            f" {_sql_value(pci_requests.get(instance[0], '[]'))});"
+        )
+    for event in events:
+        values = ",".join(_sql_value(v) for v in event)
+        lines.append(
+            "INSERT INTO instance_actions (instance_uuid, action, message,"
+            f" created_at) VALUES ({values});"
+        )
+    lines.append("COMMIT;")
+
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+    return path
+
+
+def _mysql_value(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, str):
+        value = value.replace("\\", "\\\\").replace("'", "\\'").replace("\n", "\\n")
+        return f"'{value}'"
+    return str(value)
+
+
+def _mysql_table(name, columns, rows):
+    column_lines = ",\n".join(f"  `{c}` {t}" for c, t in columns)
+    lines = [
+        f"DROP TABLE IF EXISTS `{name}`;",
+        "/*!40101 SET @saved_cs_client     = @@character_set_client */;",
+        f"CREATE TABLE `{name}` (",
+        f"{column_lines},",
+        "  PRIMARY KEY (`id`)",
+        ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb3;",
+        f"LOCK TABLES `{name}` WRITE;",
+    ]
+    if rows:
+        values = ",".join(
+            "(" + ",".join(_mysql_value(v) for v in row) + ")" for row in rows
+        )
+        lines.append(f"INSERT INTO `{name}` VALUES {values};")
+    lines.append("UNLOCK TABLES;")
+    return lines
+
+
+def write_nova_mysqldump(path, instances, events, pci_requests=None):
+    """Writes the same database as `write_nova_dump`, formatted by mysqldump.
+
+    Also includes a table which isn't used for billing. Gzips the dump if
+    `path` ends with .gz.
+    """
+    pci_requests = pci_requests or {}
+    lines = [
+        "-- MySQL dump 10.19  Distrib 10.3.39-MariaDB, for Linux (x86_64)",
+        "/*!40101 SET NAMES utf8mb4 */;",
+    ]
+    lines += _mysql_table(
+        "migrations",
+        [("id", "int(11) NOT NULL"), ("name", "varchar(255)")],
+        [(1, "it's a 'migration'")],
+    )
+    lines += _mysql_table(
+        "instances",
+        [
+            ("id", "int(11) NOT NULL AUTO_INCREMENT"),
+            ("uuid", "varchar(36) NOT NULL"),
+            ("hostname", "varchar(255) DEFAULT NULL"),
+            ("project_id", "varchar(255) DEFAULT NULL"),
+            ("instance_type_id", "int(11) DEFAULT NULL"),
+            ("memory_mb", "int(11) DEFAULT NULL"),
+            ("vcpus", "int(11) DEFAULT NULL"),
+            ("deleted", "int(11) DEFAULT NULL"),
+            ("deleted_at", "datetime DEFAULT NULL"),
+        ],
+        [(n, *instance) for n, instance in enumerate(instances, start=1)],
+    )
+    lines += _mysql_table(
+        "instance_extra",
+        [
+            ("id", "int(11) NOT NULL AUTO_INCREMENT"),
+            ("instance_uuid", "varchar(36) NOT NULL"),
+            ("pci_requests", "text"),
+        ],
+        [
+            (n, instance[0], pci_requests.get(instance[0], "[]"))
+            for n, instance in enumerate(instances, start=1)
+        ],
+    )
+    lines += _mysql_table(
+        "instance_actions",
+        [
+            ("id", "int(11) NOT NULL AUTO_INCREMENT"),
+            ("instance_uuid", "varchar(36) DEFAULT NULL"),
+            ("action", "varchar(255) DEFAULT NULL"),
+            ("message", "varchar(255) DEFAULT NULL"),
+            ("created_at", "datetime DEFAULT NULL"),
+        ],
+        [(n, *event) for n, event in enumerate(events, start=1)],
+    )
+
+    if path.endswith(".gz"):
+        f = gzip.open(path, "wt")
+    else:
+        f = open(path, "w")
+    with f:
+        f.write("\n".join(lines) + "\n")
+    return path
@@ -1,5 +1,30 @@
-from datetime import datetime
+from datetime import datetime, timezone
+import os
 
 
 def parse_time_from_string(time_str: str) -> datetime:
     return datetime.fromisoformat(time_str)
+
+
+def to_timestamp(time) -> float:
+    """Returns seconds since the epoch of a time, assuming UTC if naive.
+
+    Accepts datetimes and ISO 8601 strings, as returned by SQLite.
+    """
+    if isinstance(time, str):
+        time = datetime.fromisoformat(time)
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return time.timestamp()
+
+
+def write_atomically(path, content):
+    """Writes text or bytes to a file, replacing it only once fully written.
+
+    Readers never see a partially written file, even if the writer is
+    interrupted.
+    """
+    partial_path = f"{path}.{os.getpid()}.partial"
+    with open(partial_path, "wb" if isinstance(content, bytes) else "w") as f:
+        f.write(content)
+    os.replace(partial_path, path)